@@ -59,6 +59,7 @@ def run_mel_tests():
         'rotomap-automark',
         'rotomap-automask',
         'rotomap-automask-svm',
+        'rotomap-convert-moles',
         'rotomap-diff',
         'rotomap-edit',
         'rotomap-list',
@@ -66,6 +67,7 @@ def run_mel_tests():
         'rotomap-overview',
         'rotomap-relate',
         'rotomap-show',
+        'rotomap-sync',
         'rotomap-udiff',
         'rotomap-uuid',
     ]
@@ -84,6 +86,7 @@ def run_mel_debug_tests():
     subcommands = [
         'bench-relate',
         'render-valuefield',
+        'tune-relate',
     ]
 
     for s in subcommands:
@@ -14,6 +14,7 @@ import mel.cmd.microview
 import mel.cmd.rotomapautomark
 import mel.cmd.rotomapautomask
 import mel.cmd.rotomapautomasksvm
+import mel.cmd.rotomapconvertmoles
 import mel.cmd.rotomapdiff
 import mel.cmd.rotomapedit
 import mel.cmd.rotomaplist
@@ -22,6 +23,7 @@ import mel.cmd.rotomaporganise
 import mel.cmd.rotomapoverview
 import mel.cmd.rotomaprelate
 import mel.cmd.rotomapshow
+import mel.cmd.rotomapsync
 import mel.cmd.rotomapudiff
 import mel.cmd.rotomapuuid
 
@@ -57,6 +59,8 @@ def main():
         subparsers, mel.cmd.rotomapautomask, 'rotomap-automask')
     _setup_parser_for_module(
         subparsers, mel.cmd.rotomapautomasksvm, 'rotomap-automask-svm')
+    _setup_parser_for_module(
+        subparsers, mel.cmd.rotomapconvertmoles, 'rotomap-convert-moles')
     _setup_parser_for_module(subparsers, mel.cmd.rotomapdiff, 'rotomap-diff')
     _setup_parser_for_module(subparsers, mel.cmd.rotomapedit, 'rotomap-edit')
     _setup_parser_for_module(
@@ -70,6 +74,7 @@ def main():
     _setup_parser_for_module(
         subparsers, mel.cmd.rotomaprelate, 'rotomap-relate')
     _setup_parser_for_module(subparsers, mel.cmd.rotomapshow, 'rotomap-show')
+    _setup_parser_for_module(subparsers, mel.cmd.rotomapsync, 'rotomap-sync')
     _setup_parser_for_module(subparsers, mel.cmd.rotomapudiff, 'rotomap-udiff')
     _setup_parser_for_module(subparsers, mel.cmd.rotomapuuid, 'rotomap-uuid')
 
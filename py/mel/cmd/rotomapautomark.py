@@ -1,7 +1,11 @@
-"""Automatically mark moles on rotomap images."""
+"""Automatically mark moles on rotomap images.
 
-import cv2
+Detected moles are cached, see 'mel.lib.cache', so re-running on unchanged
+images and masks is quick.
 
+"""
+
+import mel.lib.cache
 import mel.rotomap.detectmoles
 import mel.rotomap.mask
 import mel.rotomap.moles
@@ -17,13 +21,20 @@ def setup_parser(parser):
         '-v',
         action='store_true',
         help="Print information about the processing.")
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Don't use or update the cache of previous results.")
 
 
 def process_args(args):
+    cache = None
+    if not args.no_cache:
+        cache = mel.lib.cache.Cache(mel.lib.cache.default_path())
+
     for path in args.IMAGES:
         if args.verbose:
             print(path)
-        image = cv2.imread(path)
         mask = mel.rotomap.mask.load(path)
-        moles = mel.rotomap.detectmoles.moles(image, mask)
+        moles = mel.rotomap.detectmoles.moles_cached(cache, path, mask)
         mel.rotomap.moles.save_image_moles(moles, path)
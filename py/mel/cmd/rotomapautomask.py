@@ -1,7 +1,11 @@
-"""Automatically mask rotomap images."""
+"""Automatically mask rotomap images.
 
-import cv2
+Masks are cached, see 'mel.lib.cache', so re-running on unchanged images is
+quick.
 
+"""
+
+import mel.lib.cache
 import mel.lib.common
 import mel.lib.fs
 import mel.lib.ui
@@ -24,19 +28,25 @@ def setup_parser(parser):
         '-v',
         action='store_true',
         help="Print information about the processing.")
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Don't use or update the cache of previous results.")
 
 
 def process_args(args):
 
     if args.verbose:
         print('Source:', args.source)
-    skin_hist = mel.rotomap.mask.histogram_from_image_mask(
-        cv2.imread(args.source),
-        mel.rotomap.mask.load(args.source))
+    cache = None
+    if not args.no_cache:
+        cache = mel.lib.cache.Cache(mel.lib.cache.default_path())
+
+    skin_hist = mel.rotomap.mask.histogram_from_image_mask_cached(
+        cache, args.source)
 
     for path in args.target:
         if args.verbose:
             print('Target:', path)
-        image = cv2.imread(path)
-        mask = mel.rotomap.mask.guess_mask(image, skin_hist)
-        cv2.imwrite(path + '.mask.png', mask)
+        mask = mel.rotomap.mask.guess_mask_cached(cache, path, skin_hist)
+        mel.rotomap.mask.save(path, mask)
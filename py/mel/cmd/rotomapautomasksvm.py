@@ -1,8 +1,31 @@
-"""Automatically mask rotomap images."""
+"""Automatically mask rotomap images.
+
+A classifier is trained to tell skin from not skin, using the masks of the
+'--source' images. It can then be used to mask the '--target' images.
+
+Images are classified in square tiles. Only whole tiles are used as samples
+for training and trial. When masking, the pixels along the right and bottom
+that don't make up a whole tile take the class of the neighbouring tile.
+
+Training takes a while, so the classifier may be saved with '--save-model' and
+used again later with '--load-model', instead of training.
+
+The accuracy of the classifier depends a lot on the 'C' and 'gamma' parameters
+of the SVM. With '--grid-search', each combination of the '--grid-c' and
+'--grid-gamma' values is tried with k-fold cross-validation on the '--source'
+images. The accuracy of each is printed, and the best is used to train the
+classifier.
+
+"""
+
+import itertools
+import json
+import multiprocessing
 
 import cv2
 import numpy
 
+import mel.cmd.error
 import mel.lib.common
 import mel.lib.fs
 import mel.lib.svm
@@ -10,13 +33,58 @@ import mel.lib.ui
 import mel.rotomap.mask
 
 
+# The width and height of the tiles to classify as skin or not.
+_TILE_SIZE = 40
+
+# The number of bins in the hue histogram of each tile, and how many of them
+# are used as features for the classifier.
+_HIST_WIDTH = 32
+_SAMPLE_BINS = 12
+
+# The histogram counts are divided by this, to bring them closer to [0, 1].
+_SAMPLE_SCALE = 100.0
+
+# The default values to try with '--grid-search', as recommended by the paper
+# referred to in mel.lib.svm.
+_GRID_C = tuple(2.0 ** e for e in range(-5, 16, 2))
+_GRID_GAMMA = tuple(2.0 ** e for e in range(-15, 4, 2))
+
+# Saved with models, which are only valid for the same features.
+_FEATURES = {
+    'tile_size': _TILE_SIZE,
+    'hist_width': _HIST_WIDTH,
+    'sample_bins': _SAMPLE_BINS,
+    'sample_scale': _SAMPLE_SCALE,
+}
+
+# Fold the samples the same way each time, so that results are repeatable.
+_GRID_SEARCH_SEED = 0
+
+# The samples that the worker processes cross-validate with, and the
+# parameters to try, set once per worker by _init_worker().
+_WORKER_SAMPLES = None
+_WORKER_CLASS_NUMS = None
+_WORKER_FOLDS = None
+_WORKER_CANDIDATES = None
+
+
 def setup_parser(parser):
     parser.add_argument(
         '--source',
         '-s',
         nargs='*',
+        default=[],
         help="Path to the masked images to train on.",
     )
+    parser.add_argument(
+        '--save-model',
+        metavar='PATH',
+        help="Save the trained classifier to this file.")
+    parser.add_argument(
+        '--load-model',
+        metavar='PATH',
+        help="Load a classifier saved with '--save-model', instead of "
+             "training one from '--source' images.")
     parser.add_argument(
         '--trial',
         nargs='*',
@@ -43,28 +111,99 @@ def setup_parser(parser):
         type=float,
         default=0.03125,
         help="'gamma' parameter to the RBF SVM.")
+    parser.add_argument(
+        '--grid-search',
+        action='store_true',
+        help="Choose the 'C' and 'gamma' parameters to the RBF SVM by "
+             "cross-validating each combination on the '--source' images, "
+             "instead of using '--svm-c' and '--svm-gamma'.")
+    parser.add_argument(
+        '--grid-c',
+        type=float,
+        nargs='+',
+        default=_GRID_C,
+        help="'C' parameters to try with '--grid-search', defaults to odd "
+             "powers of two from 2^-5 to 2^15.")
+    parser.add_argument(
+        '--grid-gamma',
+        type=float,
+        nargs='+',
+        default=_GRID_GAMMA,
+        help="'gamma' parameters to try with '--grid-search', defaults to "
+             "odd powers of two from 2^-15 to 2^3.")
+    parser.add_argument(
+        '--folds',
+        type=int,
+        default=5,
+        help="Number of folds to cross-validate with in '--grid-search', "
+             "defaults to '%(default)s'.")
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=None,
+        help="Number of processes to use for '--grid-search', defaults to "
+             "the number of processors on the machine.")
 
 
 def process_args(args):
 
-    classifier = mel.lib.svm.NamedClassifier(
-        mel.lib.svm.Classifier(
-            c=args.svm_c,
-            gamma=args.svm_gamma))
+    if args.load_model is not None:
+        if args.source:
+            raise mel.cmd.error.UsageError(
+                "Supply '--source' or '--load-model', not both.")
+        if args.grid_search:
+            raise mel.cmd.error.UsageError(
+                "Supply '--source' images to '--grid-search' with.")
+        if args.verbose:
+            print('Loading model:', args.load_model)
+        try:
+            classifier = load_model(args.load_model)
+        except ValueError as e:
+            raise mel.cmd.error.UsageError(
+                'Could not load model "{}": {}'.format(args.load_model, e))
+    else:
+        if not args.source:
+            raise mel.cmd.error.UsageError(
+                "Supply '--source' or '--load-model' to classify with.")
+        if args.grid_search and args.folds < 2:
+            raise mel.cmd.error.UsageError(
+                "Supply at least 2 '--folds' to cross-validate with.")
+
+        samples, classes = source_samples(args.source, args.verbose)
+
+        svm_c = args.svm_c
+        svm_gamma = args.svm_gamma
+        if args.grid_search:
+            if args.verbose:
+                print('Grid search ..')
+            svm_c, svm_gamma = grid_search(
+                samples,
+                classes,
+                args.grid_c,
+                args.grid_gamma,
+                args.folds,
+                args.jobs)
+
+        classifier = mel.lib.svm.NamedClassifier(
+            mel.lib.svm.Classifier(
+                c=svm_c,
+                gamma=svm_gamma))
+        classifier.add_samples(samples, classes)
 
-    for path in args.source:
         if args.verbose:
-            print('Source:', path)
-        train(classifier, path)
+            print('Training ..')
+        classifier.train()
 
-    if args.verbose:
-        print('Training ..')
-    classifier.train()
+    if args.save_model is not None:
+        if args.verbose:
+            print('Saving model:', args.save_model)
+        save_model(classifier, args.save_model)
 
     for path in args.trial:
         if args.verbose:
             print('Trial on:', path)
-        trial(classifier, path, args.svm_c, args.svm_gamma)
+        trial(classifier, path)
 
     for path in args.target:
         if args.verbose:
@@ -72,62 +211,234 @@ def process_args(args):
         target(classifier, path)
 
 
-def train(classifier, path):
-    image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2HSV)
-    mask = mel.rotomap.mask.load(path)
-    yield_regions = mel.rotomap.mask.yield_regions
+def save_model(classifier, path):
+    """Save a trained NamedClassifier and the features it classifies."""
+    model = classifier.to_dict()
+    model['features'] = _FEATURES
+    with mel.lib.fs.replacing_open(path) as f:
+        json.dump(model, f)
+
+
+def load_model(path):
+    """Return a NamedClassifier saved with save_model().
+
+    :raises ValueError: if the file is not a model, or the model was made
+                        with different features.
+
+    """
+    with open(path) as f:
+        model = json.load(f)
+    if model.get('features') != _FEATURES:
+        raise ValueError(
+            'it was saved with different features, save a new one.')
+    return mel.lib.svm.NamedClassifier.from_dict(model)
+
+
+def source_samples(paths, is_verbose):
+    """Return (samples, classes) of all the masked images at 'paths'."""
+    sample_list = []
+    classes = []
+    for path in paths:
+        if is_verbose:
+            print('Source:', path)
+        image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2HSV)
+        mask = mel.rotomap.mask.load(path)
+        samples, image_classes = labelled_samples(image, mask)
+        sample_list.append(samples)
+        classes.extend(image_classes)
+    return numpy.concatenate(sample_list), classes
+
 
-    for image_frag, mask_frag in yield_regions(image, mask):
-        hist = mel.rotomap.mask.calc_hist(image_frag, width=32)
-        coverage = mask_frag.mean()
-        if coverage == 0 or coverage == 255:
-            region_class = "not skin"
-            if coverage == 255:
-                region_class = "skin"
-            classifier.add_sample(
-                hist_to_sample(hist),
-                region_class)
+def grid_search(samples, classes, c_values, gamma_values, num_folds, jobs):
+    """Return the (c, gamma) with the best cross-validated accuracy.
 
+    The samples are split randomly into 'num_folds' folds. Each combination of
+    parameters is trained on all but one fold and tested on the remaining
+    one, for each fold in turn, in a pool of 'jobs' processes. The accuracy
+    of each combination is printed as a table.
 
-def trial(classifier, path, svm_c, svm_gamma):
+    """
+    class_names = sorted(set(classes))
+    class_nums = numpy.array(
+        [class_names.index(c) for c in classes], dtype=numpy.int32)
+    random_state = numpy.random.RandomState(_GRID_SEARCH_SEED)
+    folds = random_state.permutation(len(classes)) % num_folds
+
+    # Share the samples with the worker processes, rather than copying them to
+    # each.
+    shared_samples = multiprocessing.RawArray('f', samples.size)
+    numpy.frombuffer(shared_samples, dtype=numpy.float32)[:] = samples.ravel()
+
+    candidates = list(itertools.product(c_values, gamma_values))
+    tasks = list(itertools.product(range(len(candidates)), range(num_folds)))
+
+    num_hits = [0] * len(candidates)
+    initargs = (
+        shared_samples, samples.shape, class_nums, folds, candidates)
+    with multiprocessing.Pool(jobs, _init_worker, initargs) as pool:
+        for candidate_index, hits in pool.imap_unordered(
+                _cross_validate_task, tasks):
+            num_hits[candidate_index] += hits
+
+    accuracies = [hits / max(len(classes), 1) for hits in num_hits]
+    print_accuracy_surface(candidates, accuracies)
+
+    svm_c, svm_gamma = best_candidate(candidates, accuracies)
+    print('Best: C {}, gamma {}.'.format(svm_c, svm_gamma))
+    return svm_c, svm_gamma
+
+
+def print_accuracy_surface(candidates, accuracies):
+    """Print a table of accuracies, with a row per gamma and column per C.
+
+    Usage example:
+
+        >>> print_accuracy_surface(
+        ...     [(1, 0.5), (1, 2), (8, 0.5), (8, 2)],
+        ...     [0.5, 0.75, 0.875, 1])
+           gamma \\ C           1           8
+                 0.5       0.500       0.875
+                   2       0.750       1.000
+
+    """
+    accuracy_of = dict(zip(candidates, accuracies))
+    c_values = sorted({c for c, _ in candidates})
+    gamma_values = sorted({gamma for _, gamma in candidates})
+
+    print('{:>12}'.format('gamma \\ C') + ''.join(
+        '{:>12g}'.format(c) for c in c_values))
+    for gamma in gamma_values:
+        print('{:>12g}'.format(gamma) + ''.join(
+            '{:>12.3f}'.format(accuracy_of[(c, gamma)]) for c in c_values))
+
+
+def best_candidate(candidates, accuracies):
+    """Return the (c, gamma) candidate with the best accuracy.
+
+    Ties are broken in favour of the earliest candidate.
+
+    Usage example:
+
+        >>> best_candidate([(1, 1), (2, 1), (4, 1)], [0.5, 0.9, 0.9])
+        (2, 1)
+
+    """
+    return max(zip(candidates, accuracies), key=lambda x: x[1])[0]
+
+
+def _init_worker(shared_samples, shape, class_nums, folds, candidates):
+    global _WORKER_SAMPLES
+    global _WORKER_CLASS_NUMS
+    global _WORKER_FOLDS
+    global _WORKER_CANDIDATES
+    _WORKER_SAMPLES = numpy.frombuffer(
+        shared_samples, dtype=numpy.float32).reshape(shape)
+    _WORKER_CLASS_NUMS = class_nums
+    _WORKER_FOLDS = folds
+    _WORKER_CANDIDATES = candidates
+
+
+def _cross_validate_task(task):
+    candidate_index, fold = task
+    svm_c, svm_gamma = _WORKER_CANDIDATES[candidate_index]
+    is_test = _WORKER_FOLDS == fold
+
+    classifier = mel.lib.svm.Classifier(c=svm_c, gamma=svm_gamma)
+    classifier.add_samples(
+        _WORKER_SAMPLES[~is_test], _WORKER_CLASS_NUMS[~is_test])
+    classifier.train()
+
+    predictions = classifier.predict_batch(_WORKER_SAMPLES[is_test])
+    hits = int(numpy.count_nonzero(
+        predictions == _WORKER_CLASS_NUMS[is_test]))
+    return candidate_index, hits
+
+
+def trial(classifier, path):
     image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2HSV)
     mask = mel.rotomap.mask.load(path)
-    yield_regions = mel.rotomap.mask.yield_regions
-
-    hits = 0
-    misses = 0
-    for image_frag, mask_frag in yield_regions(image, mask):
-        hist = mel.rotomap.mask.calc_hist(image_frag, width=32)
-        coverage = mask_frag.mean()
-        if coverage == 0 or coverage == 255:
-            region_class = "not skin"
-            if coverage == 255:
-                region_class = "skin"
-            if classifier.predict(hist_to_sample(hist)) == region_class:
-                hits += 1
-            else:
-                misses += 1
-
-    success_rate = hits / max(hits + misses, 1)
-    print(svm_c, svm_gamma, success_rate, sep=',')
+
+    samples, classes = labelled_samples(image, mask)
+    predictions = classifier.predict_batch(samples)
+    hits = sum(1 for p, c in zip(predictions, classes) if p == c)
+
+    success_rate = hits / max(len(classes), 1)
+    print(classifier.c, classifier.gamma, success_rate, sep=',')
 
 
 def target(classifier, path):
     image = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2HSV)
-    mask = numpy.zeros((*image.shape[:2], 1), numpy.uint8)
-    yield_regions = mel.rotomap.mask.yield_regions
+    height, width = image.shape[:2]
+    rows = height // _TILE_SIZE
+    cols = width // _TILE_SIZE
+
+    if not rows or not cols:
+        # The image is smaller than a tile, so there is nothing to classify.
+        mask = numpy.zeros((height, width, 1), numpy.uint8)
+    else:
+        predictions = classifier.predict_batch(image_samples(image))
+        is_skin = numpy.array(
+            [p == "skin" for p in predictions], dtype=bool).reshape(
+                rows, cols)
 
-    for image_frag, mask_frag in yield_regions(image, mask):
-        hist = mel.rotomap.mask.calc_hist(image_frag, width=32)
-        if classifier.predict(hist_to_sample(hist)) == "skin":
-            mask_frag[:] = 255
-        else:
-            mask_frag[:] = 0
+        # Pixels that don't make up a whole tile along the right and bottom
+        # take the class of the neighbouring tile.
+        mask = numpy.repeat(
+            numpy.repeat(is_skin, _TILE_SIZE, axis=0), _TILE_SIZE, axis=1)
+        mask = numpy.pad(
+            mask,
+            ((0, height - mask.shape[0]), (0, width - mask.shape[1])),
+            'edge')
+        mask = mask[:, :, numpy.newaxis].astype(numpy.uint8) * 255
 
-    mask = mel.rotomap.mask.shrunk_to_largest_region(mask)
+        mask = mel.rotomap.mask.shrunk_to_largest_region(mask)
 
     cv2.imwrite(path + '.mask.png', mask)
 
 
-def hist_to_sample(hist):
-    return hist[:12, :12].flatten() / 100.0
+def image_samples(image):
+    """Return a (tiles, features) array of the samples of an HSV image.
+
+    There is a sample for each whole tile, in row-major order.
+
+    """
+    tiles = mel.rotomap.mask.tile_view(image, _TILE_SIZE)
+    return hists_to_samples(
+        mel.rotomap.mask.tile_hists(tiles, _HIST_WIDTH)).reshape(
+            -1, _SAMPLE_BINS * _SAMPLE_BINS)
+
+
+def labelled_samples(image, mask):
+    """Return (samples, classes) for the tiles of an image that have a class.
+
+    See image_samples() and mask_classes().
+
+    """
+    classes = mask_classes(mask)
+    has_class = numpy.array([c is not None for c in classes], dtype=bool)
+    samples = image_samples(image)[has_class]
+    return samples, [c for c in classes if c is not None]
+
+
+def mask_classes(mask):
+    """Return a list of the class of each tile of a mask, as image_samples().
+
+    Tiles that are entirely masked are "skin", tiles that are entirely
+    unmasked are "not skin", and the rest are None.
+
+    """
+    tiles = mel.rotomap.mask.tile_view(mask, _TILE_SIZE)
+    classes = numpy.full(tiles.shape[:2], None, dtype=object)
+    classes[tiles.max(axis=(2, 3, 4)) == 0] = "not skin"
+    classes[tiles.min(axis=(2, 3, 4)) == 255] = "skin"
+    return classes.ravel().tolist()
+
+
+def hists_to_samples(hists):
+    # Tile histograms are the diagonal of 2d hue histograms, the samples are
+    # the top-left of the 2d histograms.
+    bins = numpy.arange(_SAMPLE_BINS)
+    samples = numpy.zeros(
+        hists.shape[:-1] + (_SAMPLE_BINS, _SAMPLE_BINS), numpy.float32)
+    samples[..., bins, bins] = hists[..., :_SAMPLE_BINS]
+    return samples / _SAMPLE_SCALE
@@ -0,0 +1,62 @@
+"""Test suite for mel.cmd.rotomapautomasksvm."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] grid_search() cross-validates every candidate, printing the accuracies
+# [ B] grid_search() picks the earliest of the most accurate candidates
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_grid_search
+# =============================================================================
+
+
+import contextlib
+import io
+import unittest
+
+import numpy
+
+import mel.cmd.rotomapautomasksvm
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        pass
+
+    def test_b_grid_search(self):
+        # Two classes of samples that are far apart, so that every candidate
+        # separates them perfectly.
+        random_state = numpy.random.RandomState(0)
+        skin = random_state.uniform(0.0, 0.1, (20, 4))
+        not_skin = random_state.uniform(0.9, 1.0, (20, 4))
+        samples = numpy.vstack([skin, not_skin]).astype(numpy.float32)
+        classes = ['skin'] * 20 + ['not skin'] * 20
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = mel.cmd.rotomapautomasksvm.grid_search(
+                samples, classes, [1, 8], [0.5, 2], num_folds=2, jobs=1)
+
+        # [ B] grid_search() cross-validates every candidate, printing the
+        # accuracies
+        lines = output.getvalue().splitlines()
+        self.assertEqual(
+            ['gamma', '\\', 'C', '1', '8'], lines[0].split())
+        self.assertEqual(['0.5', '1.000', '1.000'], lines[1].split())
+        self.assertEqual(['2', '1.000', '1.000'], lines[2].split())
+
+        # [ B] grid_search() picks the earliest of the most accurate
+        # candidates
+        self.assertEqual((1, 0.5), result)
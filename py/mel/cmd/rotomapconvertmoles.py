@@ -0,0 +1,46 @@
+"""Convert the mole files of rotomaps between the json and binary formats.
+
+By default, the moles of each image are saved as indented json, in a file like
+'image.jpg.json'. This is easy to read and to compare with 'git diff', so it's
+the recommended format.
+
+The binary format is a compact array of fixed-size records, in a file like
+'image.jpg.moles'. It's much quicker to load, so may be useful for rotomaps
+that won't be edited again. Only moles with uuids made by mel, and without
+extra keys like 'radius', can be stored this way. Other commands keep the
+format of the files they update.
+
+Note that commands which take paths to json files, like 'rotomap-relate', will
+not work with the binary format.
+
+"""
+
+import mel.rotomap.moles
+
+
+def setup_parser(parser):
+    parser.add_argument(
+        'FORMAT',
+        choices=mel.rotomap.moles.MOLE_FILE_FORMATS,
+        help="The format to convert to.")
+    parser.add_argument(
+        'ROTOMAP',
+        type=mel.rotomap.moles.ArgparseRotomapDirectoryType,
+        nargs='+',
+        help="Paths to the rotomap directories to convert.")
+
+
+def process_args(args):
+    for rotomap in args.ROTOMAP:
+        for image_path in rotomap.image_paths:
+            mole_format = mel.rotomap.moles.mole_file_format(image_path)
+            if mole_format is None or mole_format == args.FORMAT:
+                continue
+            moles = mel.rotomap.moles.load_image_moles(image_path)
+            try:
+                mel.rotomap.moles.save_image_moles(
+                    moles, image_path, args.FORMAT)
+            except ValueError as e:
+                print('Could not convert {}: {}'.format(image_path, e))
+            else:
+                print('Converted', image_path)
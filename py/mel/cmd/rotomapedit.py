@@ -205,9 +205,10 @@ class MoleEditController():
             if flags & cv2.EVENT_FLAG_SHIFTKEY:
                 pass
             else:
-                editor.remap_uuid(
-                    editor.get_mole_uuid(mouse_x, mouse_y),
-                    self.mole_uuid_list[0])
+                editor.remap_uuids({
+                    editor.get_mole_uuid(mouse_x, mouse_y):
+                        self.mole_uuid_list[0]
+                })
         elif flags & cv2.EVENT_FLAG_SHIFTKEY:
             editor.set_mole_uuid(
                 mouse_x,
@@ -252,15 +253,18 @@ class MoleEditController():
                 editor.moledata.get_image())
             editor.set_moles(guessed_moles)
         elif key == ord('r'):
-            guessed_moles = mel.rotomap.detectmoles.moles(
-                editor.moledata.get_image(),
-                editor.moledata.mask)
+            guessed_moles = mel.rotomap.detectmoles.moles_cached(
+                editor.cache,
+                editor.moledata.current_image_path(),
+                editor.moledata.mask,
+                editor.moledata.get_image())
             editor.set_moles(guessed_moles)
             editor.moledata.save_moles()
         elif key == ord('t'):
             theory = mel.rotomap.relate.best_offset_theory(
                 self.previous_moles,
-                editor.moledata.moles)
+                editor.moledata.moles,
+                **editor.moledata.relate_config())
             if theory:
                 guessed_moles = copy.deepcopy(editor.moledata.moles)
                 for mole in guessed_moles:
@@ -306,7 +310,11 @@ class MaskEditController():
             image = editor.moledata.image
             mask = editor.moledata.mask
             hist = mel.rotomap.mask.histogram_from_image_mask(image, mask)
-            editor.moledata.mask = mel.rotomap.mask.guess_mask(image, hist)
+            editor.moledata.mask = mel.rotomap.mask.guess_mask_cached(
+                editor.cache,
+                editor.moledata.current_image_path(),
+                hist,
+                image)
             editor.moledata.save_mask()
             editor.show_current()
 
@@ -348,9 +356,10 @@ class ImageRelateController():
             else:
                 if self.copied_uuid:
                     if flags & cv2.EVENT_FLAG_ALTKEY:
-                        editor.remap_uuid(
-                            editor.get_mole_uuid(mouse_x, mouse_y),
-                            self.copied_uuid)
+                        editor.remap_uuids({
+                            editor.get_mole_uuid(mouse_x, mouse_y):
+                                self.copied_uuid
+                        })
                     else:
                         editor.set_mole_uuid(
                             mouse_x, mouse_y,
@@ -387,7 +396,8 @@ class ImageRelateController():
                 theory = mel.rotomap.relate.best_theory(
                     editor.from_moles,
                     editor.moledata.moles,
-                    iterate=False)
+                    iterate=True,
+                    **editor.moledata.relate_config())
 
                 if theory:
                     guessed_moles = copy.deepcopy(editor.moledata.moles)
@@ -406,12 +416,15 @@ class ImageRelateController():
                 theory = mel.rotomap.relate.best_theory(
                     editor.from_moles,
                     editor.moledata.moles,
-                    iterate=False)
+                    iterate=True,
+                    **editor.moledata.relate_config())
 
                 if theory:
-                    for from_uuid, to_uuid in theory:
-                        if from_uuid != to_uuid and from_uuid and to_uuid:
-                            editor.remap_uuid(to_uuid, from_uuid)
+                    editor.remap_uuids({
+                        to_uuid: from_uuid
+                        for from_uuid, to_uuid in theory
+                        if from_uuid != to_uuid and from_uuid and to_uuid
+                    })
 
                 editor.moledata.save_moles()
 
@@ -536,6 +549,7 @@ def process_args(args):
         return 1
     finally:
         editor.display.clear_mouse_callback()
+        editor.close()
 
 
 def update_follow(editor, follow_uuid, prev_moles, is_paste_mode):
@@ -545,10 +559,14 @@ def update_follow(editor, follow_uuid, prev_moles, is_paste_mode):
     if mel.rotomap.moles.uuid_mole_index(
             editor.moledata.moles, follow_uuid) is None:
 
-        guess_pos = mel.rotomap.relate.guess_mole_pos(
-            follow_uuid,
-            prev_moles,
-            editor.moledata.moles)
+        prev_index = mel.rotomap.moles.uuid_mole_index(
+            prev_moles, follow_uuid)
+        triangulation = make_mapping_triangulation(
+            prev_moles, editor.moledata.moles, editor.moledata.get_image())
+        if prev_index is not None and len(triangulation):
+            guess_pos = triangulation.map_points(
+                [mel.rotomap.moles.mole_to_point(prev_moles[prev_index])],
+                editor.moledata.moles)[0].astype(int)
 
         if guess_pos is not None:
             ellipse = mel.lib.moleimaging.find_mole_ellipse(
@@ -570,38 +588,48 @@ def update_follow(editor, follow_uuid, prev_moles, is_paste_mode):
 
 
 def guess_mole_positions(previous_moles, current_moles, current_image):
-    prev_uuids = set(m['uuid'] for m in previous_moles)
-    curr_uuids = set(m['uuid'] for m in current_moles)
-    matched_uuids = prev_uuids.intersection(curr_uuids)
+    triangulation = make_mapping_triangulation(
+        previous_moles, current_moles, current_image)
 
-    prev_moles_for_mapping = [
-        m for m in previous_moles
-        if m['uuid'] in matched_uuids
+    curr_uuids = set(m['uuid'] for m in current_moles)
+    guessed_moles = [
+        copy.deepcopy(m)
+        for m in previous_moles
+        if m['uuid'] not in curr_uuids
     ]
 
-    image_rect = (0, 0, current_image.shape[1], current_image.shape[0])
+    positions = triangulation.map_points(
+        [mel.rotomap.moles.mole_to_point(m) for m in guessed_moles],
+        current_moles)
 
     new_moles = copy.deepcopy(current_moles)
-    for mole in previous_moles:
-        if mole['uuid'] not in matched_uuids:
-            new_m = copy.deepcopy(mole)
-            pos = mel.rotomap.moles.mole_to_point(new_m)
+    for new_m, pos in zip(guessed_moles, positions.astype(int)):
+        mel.rotomap.moles.set_molepos_to_nparray(new_m, pos)
 
-            # XXX: assume that current_image and prev_image have the same
-            #      dimensions
-            moles_for_mapping = mel.rotomap.moles.get_best_moles_for_mapping(
-                pos, prev_moles_for_mapping, image_rect)
+        ellipse = mel.lib.moleimaging.find_mole_ellipse(
+            current_image, pos, _MAGIC_MOLE_FINDER_RADIUS)
+        if ellipse is not None:
+            mel.rotomap.moles.set_molepos_to_nparray(new_m, ellipse[0])
 
-            if moles_for_mapping:
-                pos = mel.rotomap.moles.mapped_pos(
-                    pos, moles_for_mapping, current_moles)
-                mel.rotomap.moles.set_molepos_to_nparray(new_m, pos)
+        new_moles.append(new_m)
 
-            ellipse = mel.lib.moleimaging.find_mole_ellipse(
-                current_image, pos, _MAGIC_MOLE_FINDER_RADIUS)
-            if ellipse is not None:
-                mel.rotomap.moles.set_molepos_to_nparray(new_m, ellipse[0])
+    return new_moles
 
-            new_moles.append(new_m)
 
-    return new_moles
+def make_mapping_triangulation(previous_moles, current_moles, current_image):
+    """Return a MoleTriangulation of the previous moles that are in current.
+
+    This is for mapping the positions of other previous moles into the current
+    image.
+
+    """
+    curr_uuids = set(m['uuid'] for m in current_moles)
+    prev_moles_for_mapping = [
+        m for m in previous_moles
+        if m['uuid'] in curr_uuids
+    ]
+
+    # XXX: assume that current_image and prev_image have the same dimensions
+    image_rect = (0, 0, current_image.shape[1], current_image.shape[0])
+    return mel.rotomap.moles.MoleTriangulation(
+        prev_moles_for_mapping, image_rect)
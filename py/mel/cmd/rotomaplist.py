@@ -1,20 +1,76 @@
-"""List the uuids of moles in supplied files."""
+"""List the uuids of moles in supplied files.
+
+Use '--store' to also list the moles in a database made by 'rotomap-sync', in
+the order that the rotomaps were taken. Use '--uuid' to list only the images a
+particular mole appears in, e.g. to see where it has appeared over time.
+
+Moles from the store are listed with the path of their mole file, or of the
+image if it no longer has one. Moles already listed from a FILE are not listed
+again.
+
+"""
 
 
 import argparse
 import json
+import os
+
+import mel.cmd.error
+import mel.rotomap.moles
+import mel.rotomap.store
 
 
 def setup_parser(parser):
     parser.add_argument(
         'FILE',
         type=argparse.FileType(),
-        nargs='+',
+        nargs='*',
         help="Path to the rotomap json file.")
+    parser.add_argument(
+        '--store',
+        help="Path to a database from 'rotomap-sync' to list from.")
+    parser.add_argument(
+        '--uuid',
+        help="Only list the mole with this uuid.")
 
 
 def process_args(args):
+    if not args.FILE and not args.store:
+        raise mel.cmd.error.UsageError('Supply FILE or --store to list.')
+
+    # The (uuid, absolute path) of each mole listed, so as not to list the
+    # same mole from both a FILE and the store.
+    listed = set()
+
     path_data_list = [(x.name, json.load(x)) for x in args.FILE]
     for path, data in path_data_list:
         for mole in data:
-            print(mole["uuid"], path)
+            if args.uuid is None or mole["uuid"] == args.uuid:
+                print(mole["uuid"], path)
+                listed.add((mole["uuid"], os.path.abspath(path)))
+
+    if args.store:
+        store = open_store(args.store)
+        try:
+            for _, image_path, uuid_, _, _ in store.uuid_history(args.uuid):
+                path = mole_file_or_image_path(image_path)
+                if (uuid_, os.path.abspath(path)) not in listed:
+                    print(uuid_, path)
+        finally:
+            store.close()
+
+
+def open_store(path):
+    """Return a read-only mel.rotomap.store.Store, for '--store'."""
+    if not os.path.isfile(path):
+        raise mel.cmd.error.UsageError(
+            '"{}" is not a database from rotomap-sync.'.format(path))
+    return mel.rotomap.store.Store(path, read_only=True)
+
+
+def mole_file_or_image_path(image_path):
+    """Return the path of the image's mole file, or the image if none."""
+    mole_format = mel.rotomap.moles.mole_file_format(image_path)
+    if mole_format is None:
+        return image_path
+    return mel.rotomap.moles.mole_file_path(image_path, mole_format)
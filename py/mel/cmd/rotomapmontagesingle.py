@@ -1,7 +1,13 @@
-"""Create a montage image for a single mole from a rotomap."""
+"""Create a montage image for a single mole from a rotomap.
+
+An index of the moles in the rotomap is cached, see 'mel.lib.cache', unless
+'--no-cache' is supplied.
+
+"""
 
 import cv2
 
+import mel.lib.cache
 import mel.lib.common
 import mel.lib.image
 import mel.rotomap.moles
@@ -24,20 +30,24 @@ def setup_parser(parser):
         type=str,
         help="Name of the image to write.")
 
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Don't use or update the cache of the moles in the rotomap.")
 
-def process_args(args):
 
-    path_moles_list = []
+def process_args(args):
 
     radius = 10
     montage_height = 1024
 
-    for imagepath, moles in args.ROTOMAP.yield_mole_lists():
-        for m in moles:
-            if m['uuid'] == args.UUID:
-                path_moles_list.append((imagepath, moles))
+    cache = None
+    if not args.no_cache:
+        cache = mel.lib.cache.Cache(mel.lib.cache.default_path())
+
+    locations = args.ROTOMAP.mole_index(cache).uuid_locations(args.UUID)
 
-    if not path_moles_list:
+    if not locations:
         raise mel.cmd.error.UsageError(
             'UUID "{}" not found in rotomap "{}".'.format(
                 args.UUID, args.ROTOMAP.path))
@@ -52,14 +62,9 @@ def process_args(args):
     # are 10 images, and the target mole appears in images 0, 1, 7, 8, 9 then
     # this rule will pick image 7 instead of 9.
     #
-    path, mole_list = path_moles_list[len(path_moles_list) // 2]
-
-    mole_dict = {m['uuid']: m for m in mole_list}
-    mole = mole_dict[args.UUID]
+    path, x, y = locations[len(locations) // 2]
 
     context_image = cv2.imread(path)
-    x = mole['x']
-    y = mole['y']
     mel.lib.common.indicate_mole(context_image, (x, y, radius))
 
     context_scale = montage_height / context_image.shape[0]
@@ -30,8 +30,8 @@ def make_overview(path, files):
     angles = {f: None for f in files if f.lower().endswith('.jpg')}
 
     for f in files:
-        if f.lower().endswith('.json'):
-            jpg_name = f[:-5]
+        jpg_name, ext = os.path.splitext(f)
+        if ext.lower() in ('.json', '.moles'):
             if jpg_name in angles:
                 angles[jpg_name] = f
 
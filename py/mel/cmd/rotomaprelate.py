@@ -1,8 +1,25 @@
-"""Guess the relationships between moles in a rotomap."""
+"""Guess the relationships between moles in a rotomap.
 
+By default, each file is related to the next in turn. The uuids of the 'from'
+file are written into the 'to' file before it is related to the next one.
 
+With '--global', all the files are loaded first. Neighbouring files are
+related in parallel, and the results are merged into consistent tracks of
+moles before writing any files. Conflicting relations, i.e. two moles from the
+same file or two different canonical uuids in one track, are discarded.
+
+If the directory of the 'from' file has a 'relate.cfg', as written by
+'mel-debug tune-relate', then the parameters in it are used for relating.
+
+"""
+
+
+import concurrent.futures
+import itertools
 import json
+import os
 
+import mel.lib.fs
 import mel.lib.math
 import mel.rotomap.relate
 
@@ -21,32 +38,52 @@ def setup_parser(parser):
         '--loop',
         action='store_true',
         help="Apply the relation as if the files specify a complete loop.")
+    parser.add_argument(
+        '--global',
+        dest='is_global',
+        action='store_true',
+        help="Relate all the files at once, instead of one pair at a time.")
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=None,
+        help="Number of processes to use with '--global', defaults to the "
+             "number of processors on the machine.")
 
 
 def process_args(args):
-    process_files(args.FROM, args.TO)
+    relate_config = mel.rotomap.relate.load_relate_config(
+        os.path.dirname(args.FROM))
+
+    if args.is_global:
+        process_files_global(
+            [args.FROM] + args.TO, args.loop, args.jobs, relate_config)
+        return
+
+    process_files(args.FROM, args.TO, relate_config)
     if args.loop:
-        process_files(args.FROM, reversed(args.TO))
+        process_files(args.FROM, reversed(args.TO), relate_config)
 
 
-def process_files(from_path, to_path_list):
+def process_files(from_path, to_path_list, relate_config):
     files = [from_path]
     files.extend(to_path_list)
     for from_path, to_path in pairwise(files):
-        process_pair(from_path, to_path)
+        process_pair(from_path, to_path, relate_config)
 
 
 def pairwise(iterable):
     return zip(iterable, iterable[1:])
 
 
-def process_pair(from_path, to_path):
+def process_pair(from_path, to_path, relate_config):
 
     from_moles = load_json(from_path)
     to_moles = load_json(to_path)
 
     pairs = mel.rotomap.relate.best_offset_theory(
-        from_moles, to_moles)
+        from_moles, to_moles, **relate_config)
 
     if pairs is None:
         return
@@ -58,9 +95,59 @@ def process_pair(from_path, to_path):
                     mole['uuid'] = p[0]
                     break
 
-    with open(to_path, 'w') as f:
+    save_json(to_path, to_moles)
+
+
+def process_files_global(path_list, is_loop, num_jobs, relate_config):
+
+    mole_lists = [load_json(path) for path in path_list]
+
+    index_pairs = list(pairwise(range(len(path_list))))
+    if is_loop and len(path_list) > 2:
+        index_pairs.append((len(path_list) - 1, 0))
+
+    # Images without moles can't be related.
+    index_pairs = [
+        (i, j) for i, j in index_pairs if mole_lists[i] and mole_lists[j]
+    ]
+
+    with concurrent.futures.ProcessPoolExecutor(num_jobs) as executor:
+        theories = list(executor.map(
+            relate_pair,
+            [mole_lists[i] for i, _ in index_pairs],
+            [mole_lists[j] for _, j in index_pairs],
+            itertools.repeat(relate_config)))
+
+    tracks = mel.rotomap.relate.MoleTracks(mole_lists)
+    for (from_index, to_index), theory in zip(index_pairs, theories):
+        for from_uuid, to_uuid in theory:
+            if from_uuid and to_uuid:
+                tracks.merge((from_index, from_uuid), (to_index, to_uuid))
+
+    for path, moles, remap in zip(
+            path_list, mole_lists, tracks.uuid_remaps()):
+        if remap:
+            for mole in moles:
+                mole['uuid'] = remap.get(mole['uuid'], mole['uuid'])
+            save_json(path, moles)
+
+
+def relate_pair(from_moles, to_moles, relate_config):
+    return mel.rotomap.relate.best_offset_theory(
+        from_moles, to_moles, **relate_config)
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(path, moles):
+    # Replace the file atomically, so that an interrupted run doesn't leave a
+    # truncated file.
+    with mel.lib.fs.replacing_open(path) as f:
         json.dump(
-            to_moles,
+            moles,
             f,
             indent=4,
             separators=(',', ': '),
@@ -68,8 +155,3 @@ def process_pair(from_path, to_path):
 
         # There's no newline after dump(), add one here for happier viewing
         print(file=f)
-
-
-def load_json(path):
-    with open(path) as f:
-        return json.load(f)
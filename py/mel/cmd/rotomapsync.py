@@ -0,0 +1,44 @@
+"""Update a database of the moles in rotomaps, for quicker querying.
+
+The database is an SQLite file, which is created if it doesn't exist. Only the
+images whose mole files have changed since the last sync are re-read, so it's
+cheap to sync all of the rotomaps regularly.
+
+Commands like 'rotomap-udiff', 'rotomap-uuid' and 'rotomap-list' can then be
+pointed at the database with their '--store' option.
+
+"""
+
+import mel.rotomap.moles
+import mel.rotomap.store
+
+
+def setup_parser(parser):
+    parser.add_argument(
+        'STORE',
+        help="Path to the database file to update.")
+    parser.add_argument(
+        'ROTOMAP',
+        type=mel.rotomap.moles.ArgparseRotomapDirectoryType,
+        nargs='*',
+        help="Paths to the rotomap directories to sync.")
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help="Remove rotomaps from the database if they no longer exist.")
+
+
+def process_args(args):
+    store = mel.rotomap.store.Store(args.STORE)
+    try:
+        if args.prune:
+            for path in store.prune():
+                print('Pruned', path)
+
+        for rotomap in args.ROTOMAP:
+            num_changed = store.sync_rotomap(rotomap.path)
+            if num_changed:
+                print('Synced {} images from {}'.format(
+                    num_changed, rotomap.path))
+    finally:
+        store.close()
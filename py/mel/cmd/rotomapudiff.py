@@ -18,6 +18,11 @@ Add UUIDs to a file 'ignore-new', or 'ignore-missing' in the rotomap dir to
 suppress messages about new or missing moles respectively. Blank lines and
 lines beginning with '#' are ignored in these files.
 
+Use '--store' to read the moles from a database made by 'rotomap-sync'. The
+rotomaps are synced to it first, which only re-reads changed mole files.
+Otherwise an index of the moles in each rotomap is cached, see
+'mel.lib.cache', unless '--no-cache' is supplied.
+
 Example output:
 
     New moles:
@@ -43,7 +48,9 @@ import collections
 import itertools
 import os
 
+import mel.lib.cache
 import mel.rotomap.moles
+import mel.rotomap.store
 
 
 IGNORE_NEW_FILENAME = 'ignore-new'
@@ -64,13 +71,20 @@ def setup_parser(parser):
         '--show-all', '-a',
         action='store_true',
         help="Show all mole UUIDs, even if ignored.")
+    parser.add_argument(
+        '--store',
+        help="Path to a database from 'rotomap-sync' to read moles from.")
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help="Don't use or update the cache of the moles in each rotomap.")
 
 
-def uuids_from_dir(rotomap_dir):
-    uuid_set = set()
-    for _, moles in rotomap_dir.yield_mole_lists():
-        uuid_set |= set(m['uuid'] for m in moles)
-    return uuid_set
+def uuids_from_dir(rotomap_dir, store, cache):
+    if store is None:
+        return rotomap_dir.mole_index(cache).uuids()
+    store.sync_rotomap(rotomap_dir.path)
+    return store.uuids(rotomap_dir.path)
 
 
 def print_category(text, uuids):
@@ -83,12 +97,25 @@ def print_category(text, uuids):
 
 
 def process_args(args):
+    store = None
+    if args.store:
+        store = mel.rotomap.store.Store(args.store)
+    cache = None
+    if not args.no_cache:
+        cache = mel.lib.cache.Cache(mel.lib.cache.default_path())
+    try:
+        print_udiff(args, store, cache)
+    finally:
+        if store is not None:
+            store.close()
+
+
+def print_udiff(args, store, cache):
 
     uuid_to_fromdirs = collections.defaultdict(set)
     for dir_ in args.OLD:
-        for _, mole_list in dir_.yield_mole_lists():
-            for mole in mole_list:
-                uuid_to_fromdirs[mole['uuid']].add(dir_.path)
+        for uuid_ in uuids_from_dir(dir_, store, cache):
+            uuid_to_fromdirs[uuid_].add(dir_.path)
 
     from_uuids = set(uuid_to_fromdirs.keys())
 
@@ -97,7 +124,7 @@ def process_args(args):
     ignore_missing = load_potential_set_file(
         args.NEW.path, IGNORE_MISSING_FILENAME)
 
-    to_uuids = uuids_from_dir(args.NEW)
+    to_uuids = uuids_from_dir(args.NEW, store, cache)
 
     print_category('New moles:', to_uuids - from_uuids - ignore_new)
 
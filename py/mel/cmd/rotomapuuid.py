@@ -1,8 +1,16 @@
-"""List the uuids of moles that match a prefix, from a list of json files."""
+"""List the uuids of moles that match a prefix, from a list of json files.
+
+Use '--store' to also search a database made by 'rotomap-sync'.
+
+"""
 
 
 import argparse
 import json
+import os
+
+import mel.cmd.error
+import mel.rotomap.store
 
 
 def setup_parser(parser):
@@ -12,11 +20,17 @@ def setup_parser(parser):
     parser.add_argument(
         'FILE',
         type=argparse.FileType(),
-        nargs='+',
+        nargs='*',
         help="Path to the rotomap json file.")
+    parser.add_argument(
+        '--store',
+        help="Path to a database from 'rotomap-sync' to search.")
 
 
 def process_args(args):
+    if not args.FILE and not args.store:
+        raise mel.cmd.error.UsageError('Supply FILE or --store to search.')
+
     mole_map_list = [json.load(x) for x in args.FILE]
     uuid_set = mole_uuid_set_from_map_list(mole_map_list)
     results = []
@@ -25,6 +39,13 @@ def process_args(args):
         if mole_uuid.startswith(args.PREFIX):
             results.append(mole_uuid)
 
+    if args.store:
+        store = open_store(args.store)
+        try:
+            results.extend(store.uuids(prefix=args.PREFIX) - uuid_set)
+        finally:
+            store.close()
+
     if results:
         print('\n'.join(results))
         return 0
@@ -32,6 +53,14 @@ def process_args(args):
         return 1
 
 
+def open_store(path):
+    """Return a read-only mel.rotomap.store.Store, for '--store'."""
+    if not os.path.isfile(path):
+        raise mel.cmd.error.UsageError(
+            '"{}" is not a database from rotomap-sync.'.format(path))
+    return mel.rotomap.store.Store(path, read_only=True)
+
+
 def mole_uuid_set_from_map_list(mole_map_list):
     uuid_set = set()
     for mole_map in mole_map_list:
@@ -1,9 +1,25 @@
-"""Benchmark the accuracy of rotomap.relate across a rotomap."""
+"""Benchmark the accuracy of rotomap.relate across a rotomap.
+
+A summary of the time taken to relate each pair is printed at the end, the
+time is for the relating only. Use '--report' to save the results, and
+'--compare' to check them against a previously saved report. Reports ending in
+'.csv' are written as CSV, otherwise as JSON; only JSON reports can be used
+with '--compare'.
+
+"""
 
 import copy
+import csv
 import itertools
+import json
+import math
+import multiprocessing
+import random
+import time
 import uuid
 
+import numpy
+
 import mel.lib.math
 import mel.rotomap.moles
 import mel.rotomap.relate
@@ -40,19 +56,109 @@ def setup_parser(parser):
         '--iterate-relate',
         action='store_true',
         help="Repeatedly relate the images, until no more changes are seen.")
+    parser.add_argument(
+        '--baseless-engine',
+        choices=mel.rotomap.relate.BASELESS_ENGINES,
+        default='exhaustive',
+        help="The engine to use for relating images with no known moles in "
+             "common, to compare accuracy and speed.")
+    parser.add_argument(
+        '--field-engine',
+        choices=mel.rotomap.relate.FIELD_ENGINES,
+        default='greedy',
+        help="The engine to use for relating images with some known moles "
+             "in common, to compare accuracy and speed.")
+    parser.add_argument(
+        '--field-error',
+        type=int,
+        default=None,
+        help="The distance in pixels within which moles may be related, "
+             "when relating images with some known moles in common. "
+             "Defaults to the built-in value, see 'mel-debug tune-relate'.")
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=1,
+        help="Number of processes to relate combinations with.")
+    parser.add_argument(
+        '--sample',
+        type=int,
+        default=None,
+        metavar='K',
+        help="Relate only K randomly chosen combinations of reset uuids per "
+             "pair of files, instead of all of them.")
+    parser.add_argument(
+        '--sample-seed',
+        type=int,
+        default=0,
+        help="Seed for choosing combinations with '--sample', so that runs "
+             "are comparable.")
+    parser.add_argument(
+        '--report',
+        metavar='PATH',
+        default=None,
+        help="Write the accuracy and timing results to this file, as CSV if "
+             "it ends in '.csv', otherwise JSON.")
+    parser.add_argument(
+        '--compare',
+        metavar='PATH',
+        default=None,
+        help="Compare the results with a JSON report from a previous run, "
+             "exit with an error if they have regressed.")
+    parser.add_argument(
+        '--max-flaw-rate-increase',
+        type=float,
+        default=0.01,
+        help="With '--compare', the largest acceptable increase in the "
+             "proportion of mappings that are flawed, e.g. 0.01 for one "
+             "percentage point.")
+    parser.add_argument(
+        '--max-latency-increase',
+        type=float,
+        default=0.25,
+        help="With '--compare', the largest acceptable increase in the p50 "
+             "and p95 time to relate a pair, e.g. 0.25 for 25%%.")
 
 
 def process_args(args):
-    process_files(args.FROM, args.TO, args)
+    start = time.perf_counter()
+
+    file_results = process_files(args.FROM, args.TO, args)
     if args.loop:
-        process_files(args.FROM, reversed(args.TO), args)
+        file_results.extend(process_files(args.FROM, reversed(args.TO), args))
+
+    wall_seconds = time.perf_counter() - start
+
+    report = make_report(file_results, wall_seconds, args)
+    print_timing_summary(report)
+
+    if args.report:
+        write_report(report, args.report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(
+            baseline,
+            report,
+            args.max_flaw_rate_increase,
+            args.max_latency_increase)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            return 1
 
 
 def process_files(from_path, to_path_list, args):
     files = [from_path]
     files.extend(to_path_list)
+    file_results = []
     for from_path, to_path in pairwise(files):
-        process_combinations(from_path, to_path, args)
+        result = process_combinations(from_path, to_path, args)
+        if result is not None:
+            file_results.append(result)
+    return file_results
 
 
 def pairwise(iterable):
@@ -65,12 +171,13 @@ def process_combinations(from_path, to_path, args):
     to_moles = mel.rotomap.moles.load_image_moles(to_path)
 
     if not from_moles or not to_moles:
-        return
+        return None
 
     expected_theory = make_default_map_theory(from_moles, to_moles)
 
     num_flaws = 0
     num_facts = 0
+    pair_seconds = []
 
     reset_uuids = 0
     if args.reset_uuids is not None:
@@ -78,12 +185,48 @@ def process_combinations(from_path, to_path, args):
     elif args.reset_all_uuids:
         reset_uuids = len(to_moles)
 
-    for params in yield_reset_combinations(
-            from_moles, to_moles, expected_theory, reset_uuids):
-        flaws, facts = process_pair(
-            from_path, to_path, *params, args.iterate_relate)
-        num_flaws += len(flaws)
-        num_facts += len(facts)
+    relate_args = (
+        args.iterate_relate,
+        args.baseless_engine,
+        args.field_engine,
+        args.field_error)
+
+    if args.jobs > 1:
+        # Send only the uuids to reset to the workers, they each have their
+        # own copy of the moles to work from.
+        uuid_combinations = yield_reset_uuid_combinations(
+            to_moles, reset_uuids, args.sample, args.sample_seed)
+        with multiprocessing.Pool(
+                args.jobs,
+                _init_worker,
+                (from_moles, to_moles, expected_theory, relate_args)) as pool:
+            for flaws, facts, seconds in pool.imap(
+                    _relate_reset_combination,
+                    uuid_combinations,
+                    chunksize=_WORKER_CHUNKSIZE):
+                print_pair_results(from_path, to_path, flaws, facts)
+                num_flaws += len(flaws)
+                num_facts += len(facts)
+                pair_seconds.append(seconds)
+    else:
+        combinations = yield_reset_combinations(
+            from_moles,
+            to_moles,
+            expected_theory,
+            reset_uuids,
+            args.sample,
+            args.sample_seed)
+        for _, new_to_moles, new_theory in combinations:
+            flaws, facts, seconds = process_pair(
+                from_path,
+                to_path,
+                from_moles,
+                new_to_moles,
+                new_theory,
+                *relate_args)
+            num_flaws += len(flaws)
+            num_facts += len(facts)
+            pair_seconds.append(seconds)
 
     if num_flaws:
         print('Flawed mapping: ({} -> {}); {} flaws, {} facts.'.format(
@@ -91,39 +234,157 @@ def process_combinations(from_path, to_path, args):
     else:
         print('Flawless mapping: ({} -> {})'.format(from_path, to_path))
 
+    return {
+        'from': from_path,
+        'to': to_path,
+        'flaws': num_flaws,
+        'facts': num_facts,
+        'pair_seconds': pair_seconds,
+    }
+
+
+def yield_reset_combinations(
+        from_moles,
+        to_moles,
+        expected_theory,
+        num_reset,
+        num_samples=None,
+        seed=0):
+    uuid_combinations = yield_reset_uuid_combinations(
+        to_moles, num_reset, num_samples, seed)
+    for uuids in uuid_combinations:
+        new_to_moles, new_theory = make_reset_combination(
+            to_moles, expected_theory, uuids)
+        yield from_moles, new_to_moles, new_theory
+
 
-def yield_reset_combinations(from_moles, to_moles, expected_theory, num_reset):
+def yield_reset_uuid_combinations(
+        to_moles, num_reset, num_samples=None, seed=0):
+    """Yield tuples of uuids from to_moles, for make_reset_combination().
 
+    :to_moles: a list of mole dicts to pick uuids from.
+    :num_reset: the number of uuids in each combination.
+    :num_samples: if not None, yield only this many distinct combinations,
+                  chosen at random.
+    :seed: the seed for choosing random combinations.
+
+    """
     if num_reset == 0:
-        yield from_moles, to_moles, expected_theory
+        yield ()
         return
 
-    to_uuids = set(x['uuid'] for x in to_moles)
+    # Sort the uuids, so that the combinations don't depend on the order of
+    # iterating a set.
+    to_uuids = sorted(set(x['uuid'] for x in to_moles))
     num_reset = min(len(to_uuids), num_reset)
 
-    for uuids in itertools.combinations(to_uuids, num_reset):
-        new_to_moles = copy.deepcopy(to_moles)
-        new_theory = copy.deepcopy(expected_theory)
-        for u in uuids:
-            new_u = uuid.uuid4().hex
-            for mole in new_to_moles:
-                if mole['uuid'] == u:
-                    mole['uuid'] = new_u
-
-            def remapped_theory(x, y):
-                return (x, y) if y != u else (x, new_u)
-
-            new_theory = [
-                remapped_theory(x, y) for x, y in new_theory
-            ]
-        yield from_moles, new_to_moles, new_theory
+    num_combinations = math.factorial(len(to_uuids)) // (
+        math.factorial(num_reset) *
+        math.factorial(len(to_uuids) - num_reset))
 
+    if num_samples is None or num_samples >= num_combinations:
+        yield from itertools.combinations(to_uuids, num_reset)
+        return
+
+    rng = random.Random(seed)
+    sampled = set()
+    while len(sampled) < num_samples:
+        uuids = tuple(sorted(rng.sample(to_uuids, num_reset)))
+        if uuids not in sampled:
+            sampled.add(uuids)
+            yield uuids
+
+
+def make_reset_combination(to_moles, expected_theory, uuids):
+    """Return (to_moles, expected_theory) with 'uuids' replaced by new ones.
+
+    If 'uuids' is empty then the originals are returned, otherwise copies.
+
+    """
+    if not uuids:
+        return to_moles, expected_theory
+
+    new_to_moles = copy.deepcopy(to_moles)
+    new_theory = copy.deepcopy(expected_theory)
+    for u in uuids:
+        new_u = uuid.uuid4().hex
+        for mole in new_to_moles:
+            if mole['uuid'] == u:
+                mole['uuid'] = new_u
+
+        def remapped_theory(x, y):
+            return (x, y) if y != u else (x, new_u)
+
+        new_theory = [
+            remapped_theory(x, y) for x, y in new_theory
+        ]
+    return new_to_moles, new_theory
 
-def process_pair(
-        from_path, to_path, from_moles, to_moles, expected_theory, iterate):
 
+# The number of combinations to send to a worker process at a time, large
+# enough to amortise the overhead of communicating with the worker.
+_WORKER_CHUNKSIZE = 8
+
+# The moles and settings for the pair of files a worker process is relating,
+# set by _init_worker().
+_WORKER_PAIR = None
+
+
+def _init_worker(from_moles, to_moles, expected_theory, relate_args):
+    global _WORKER_PAIR
+    _WORKER_PAIR = (from_moles, to_moles, expected_theory, relate_args)
+
+
+def _relate_reset_combination(uuids):
+    from_moles, to_moles, expected_theory, relate_args = _WORKER_PAIR
+    new_to_moles, new_theory = make_reset_combination(
+        to_moles, expected_theory, uuids)
+    return relate_pair(from_moles, new_to_moles, new_theory, *relate_args)
+
+
+def process_pair(
+        from_path,
+        to_path,
+        from_moles,
+        to_moles,
+        expected_theory,
+        iterate,
+        baseless_engine,
+        field_engine,
+        field_error):
+
+    flaws, facts, seconds = relate_pair(
+        from_moles,
+        to_moles,
+        expected_theory,
+        iterate,
+        baseless_engine,
+        field_engine,
+        field_error)
+
+    print_pair_results(from_path, to_path, flaws, facts)
+
+    return flaws, facts, seconds
+
+
+def relate_pair(
+        from_moles,
+        to_moles,
+        expected_theory,
+        iterate,
+        baseless_engine,
+        field_engine,
+        field_error):
+
+    start = time.perf_counter()
     offset_theory = mel.rotomap.relate.best_theory(
-        from_moles, to_moles, iterate)
+        from_moles,
+        to_moles,
+        iterate,
+        baseless_engine,
+        field_engine,
+        field_error)
+    seconds = time.perf_counter() - start
 
     expected_theory_set = set(expected_theory)
     offset_theory_set = set(offset_theory)
@@ -131,12 +392,162 @@ def process_pair(
     flaws = offset_theory_set.symmetric_difference(expected_theory_set)
     facts = expected_theory_set.intersection(offset_theory_set)
 
+    return flaws, facts, seconds
+
+
+def print_pair_results(from_path, to_path, flaws, facts):
     for from_uuid, to_uuid in flaws:
         print('False', format_mapping(from_path, to_path, from_uuid, to_uuid))
     for from_uuid, to_uuid in facts:
         print('True', format_mapping(from_path, to_path, from_uuid, to_uuid))
 
-    return flaws, facts
+
+def make_report(file_results, wall_seconds, args):
+    """Return a dict summarising the accuracy and timing of a run.
+
+    :file_results: a list of dicts from process_combinations().
+    :wall_seconds: the time taken for the whole run.
+    :args: the parsed arguments, to record the engine used.
+    :returns: a dict that can be written with write_report().
+
+    """
+    files = []
+    all_pair_seconds = []
+    for result in file_results:
+        files.append(dict(
+            {
+                'from': result['from'],
+                'to': result['to'],
+            },
+            **summarise_results(
+                result['flaws'], result['facts'], result['pair_seconds'])))
+        all_pair_seconds.extend(result['pair_seconds'])
+
+    total = summarise_results(
+        sum(r['flaws'] for r in file_results),
+        sum(r['facts'] for r in file_results),
+        all_pair_seconds)
+    total['wall_seconds'] = wall_seconds
+    total['pairs_per_second'] = 0.0
+    if wall_seconds:
+        total['pairs_per_second'] = len(all_pair_seconds) / wall_seconds
+
+    return {
+        'engine': {
+            'baseless': args.baseless_engine,
+            'field': args.field_engine,
+            'field_error': args.field_error,
+            'iterate': args.iterate_relate,
+        },
+        'files': files,
+        'total': total,
+    }
+
+
+def summarise_results(num_flaws, num_facts, pair_seconds):
+    """Return a dict of accuracy and latency statistics.
+
+    Usage example:
+
+        >>> summary = summarise_results(1, 3, [0.1, 0.2, 0.3, 0.4])
+        >>> summary['flaw_rate'], summary['pairs'], summary['max_seconds']
+        (0.25, 4, 0.4)
+
+    """
+    num_mappings = num_flaws + num_facts
+    summary = {
+        'flaws': num_flaws,
+        'facts': num_facts,
+        'flaw_rate': num_flaws / num_mappings if num_mappings else 0.0,
+        'pairs': len(pair_seconds),
+        'seconds': sum(pair_seconds),
+        'p50_seconds': 0.0,
+        'p95_seconds': 0.0,
+        'max_seconds': 0.0,
+    }
+    if pair_seconds:
+        summary['p50_seconds'] = float(numpy.percentile(pair_seconds, 50))
+        summary['p95_seconds'] = float(numpy.percentile(pair_seconds, 95))
+        summary['max_seconds'] = max(pair_seconds)
+    return summary
+
+
+def print_timing_summary(report):
+    total = report['total']
+    print(
+        'Related {} pairs in {:.3f}s ({:.1f} pairs/s), '
+        'p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms; '
+        'engine {} / {}.'.format(
+            total['pairs'],
+            total['wall_seconds'],
+            total['pairs_per_second'],
+            total['p50_seconds'] * 1000,
+            total['p95_seconds'] * 1000,
+            total['max_seconds'] * 1000,
+            report['engine']['baseless'],
+            report['engine']['field']))
+
+
+def write_report(report, path):
+    if not path.lower().endswith('.csv'):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+            print(file=f)
+        return
+
+    rows = list(report['files'])
+    rows.append(dict(report['total'], **{'from': 'total', 'to': 'total'}))
+    fieldnames = [
+        'from',
+        'to',
+        'flaws',
+        'facts',
+        'flaw_rate',
+        'pairs',
+        'seconds',
+        'p50_seconds',
+        'p95_seconds',
+        'max_seconds',
+    ]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def compare_reports(
+        baseline, report, max_flaw_rate_increase, max_latency_increase):
+    """Return a list of descriptions of regressions from baseline to report.
+
+    Usage example:
+
+        >>> compare_reports(
+        ...     {'total': {'flaw_rate': 0.1, 'p50_seconds': 1.0}},
+        ...     {'total': {'flaw_rate': 0.2, 'p50_seconds': 1.0}},
+        ...     0.01,
+        ...     0.25)
+        ['flaw_rate increased from 0.1000 to 0.2000']
+
+    """
+    regressions = []
+
+    old = baseline['total']
+    new = report['total']
+
+    if new['flaw_rate'] > old['flaw_rate'] + max_flaw_rate_increase:
+        regressions.append(
+            'flaw_rate increased from {:.4f} to {:.4f}'.format(
+                old['flaw_rate'], new['flaw_rate']))
+
+    for key in ('p50_seconds', 'p95_seconds'):
+        if key not in old or key not in new:
+            continue
+        if new[key] > old[key] * (1 + max_latency_increase):
+            regressions.append(
+                '{} increased from {:.2f}ms to {:.2f}ms'.format(
+                    key, old[key] * 1000, new[key] * 1000))
+
+    return regressions
 
 
 def format_mapping(from_path, to_path, from_uuid, to_uuid):
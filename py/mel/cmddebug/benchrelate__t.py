@@ -10,10 +10,18 @@
 # [ B] yield_reset_combinations() iterates over replacements with resets=1
 # [ B] yield_reset_combinations() replaces all with resets=2 (total moles is 2)
 # [ B] yield_reset_combinations() replaces all with resets=3 (total moles is 2)
+# [ C] yield_reset_uuid_combinations() samples distinct combinations
+# [ C] yield_reset_uuid_combinations() samples the same with the same seed
+# [ C] yield_reset_uuid_combinations() yields all if sample is large enough
+# [ D] compare_reports() passes results within the thresholds
+# [ D] compare_reports() reports an increased flaw rate
+# [ D] compare_reports() reports increased latencies
 # -----------------------------------------------------------------------------
 # Tests:
 # [ A] test_A_Breathing
 # [ B] test_B_yield_reset_combinations
+# [ C] test_C_yield_reset_uuid_combinations_sample
+# [ D] test_D_compare_reports
 # =============================================================================
 
 from __future__ import absolute_import
@@ -69,6 +77,49 @@ class Test(unittest.TestCase):
         self.assertEqual(len(result), 1)
         assert_both_mappings_changed(self, *result[0])
 
+    def test_C_yield_reset_uuid_combinations_sample(self):
+        moles = [{'uuid': str(i)} for i in range(10)]
+        yield_combinations = (
+            mel.cmddebug.benchrelate.yield_reset_uuid_combinations)
+
+        # [ C] yield_reset_uuid_combinations() samples distinct combinations
+        result = list(yield_combinations(moles, 3, 20, seed=1))
+        self.assertEqual(len(result), 20)
+        self.assertEqual(len(set(result)), 20)
+        for uuids in result:
+            self.assertEqual(len(set(uuids)), 3)
+
+        # [ C] yield_reset_uuid_combinations() samples the same with the same
+        # seed.
+        self.assertEqual(
+            result,
+            list(yield_combinations(moles, 3, 20, seed=1)))
+
+        # [ C] yield_reset_uuid_combinations() yields all if sample is large
+        # enough.
+        result = list(yield_combinations(moles, 2, 1000))
+        self.assertEqual(len(result), 45)
+
+    def test_D_compare_reports(self):
+        summarise = mel.cmddebug.benchrelate.summarise_results
+        compare = mel.cmddebug.benchrelate.compare_reports
+
+        baseline = {'total': summarise(1, 99, [0.1] * 100)}
+
+        # [ D] compare_reports() passes results within the thresholds
+        report = {'total': summarise(2, 98, [0.12] * 100)}
+        self.assertEqual(compare(baseline, report, 0.01, 0.25), [])
+
+        # [ D] compare_reports() reports an increased flaw rate
+        report = {'total': summarise(3, 97, [0.1] * 100)}
+        self.assertEqual(len(compare(baseline, report, 0.01, 0.25)), 1)
+
+        # [ D] compare_reports() reports increased latencies
+        report = {'total': summarise(1, 99, [0.1] * 90 + [0.2] * 10)}
+        self.assertEqual(len(compare(baseline, report, 0.01, 0.25)), 1)
+        report = {'total': summarise(1, 99, [0.2] * 100)}
+        self.assertEqual(len(compare(baseline, report, 0.01, 0.25)), 2)
+
 
 def assert_one_mapping_changed(test, from_moles, to_moles, theory):
 
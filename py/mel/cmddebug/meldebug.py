@@ -5,6 +5,7 @@ import argparse
 
 import mel.cmddebug.benchrelate
 import mel.cmddebug.rendervaluefield
+import mel.cmddebug.tunerelate
 
 
 def main():
@@ -30,6 +31,8 @@ def main():
         subparsers, mel.cmddebug.benchrelate, 'bench-relate')
     _setup_parser_for_module(
         subparsers, mel.cmddebug.rendervaluefield, 'render-valuefield')
+    _setup_parser_for_module(
+        subparsers, mel.cmddebug.tunerelate, 'tune-relate')
 
     args = parser.parse_args()
     return args.func(args)
@@ -0,0 +1,206 @@
+"""Find the best parameters for rotomap.relate for a rotomap.
+
+Relate neighbouring images in the rotomap with each combination of the
+parameters, resetting uuids in the same way as 'bench-relate'. The combination
+with the fewest flaws is saved to the 'relate.cfg' file in the rotomap, which
+'rotomap-relate' will then use.
+
+Ties are broken in favour of the default parameters, then the smallest field
+error. This is because a smaller radius is less likely to relate moles that
+have no partner in the other image.
+
+"""
+
+import itertools
+import multiprocessing
+
+import mel.cmddebug.benchrelate
+import mel.rotomap.moles
+import mel.rotomap.relate
+
+
+_DEFAULT_FIELD_ERRORS = (100, 150, 200, 250, 300, 400, 500)
+
+
+def setup_parser(parser):
+    parser.add_argument(
+        'ROTOMAP',
+        type=mel.rotomap.moles.ArgparseRotomapDirectoryType,
+        help="Path to the rotomap to tune.")
+    parser.add_argument(
+        '--loop',
+        action='store_true',
+        help="Also relate the last image to the first.")
+    parser.add_argument(
+        '--field-errors',
+        type=int,
+        nargs='+',
+        default=_DEFAULT_FIELD_ERRORS,
+        metavar='PIXELS',
+        help="The distances within which moles may be related to try, "
+             "defaults to '%(default)s'.")
+    parser.add_argument(
+        '--field-engines',
+        choices=mel.rotomap.relate.FIELD_ENGINES,
+        nargs='+',
+        default=mel.rotomap.relate.FIELD_ENGINES,
+        help="The field engines to try, defaults to all of them.")
+    parser.add_argument(
+        '--reset-uuids',
+        type=int,
+        default=1,
+        help="Reset this number of uuids in the destination, as in "
+             "'bench-relate'.")
+    parser.add_argument(
+        '--sample',
+        type=int,
+        default=None,
+        metavar='K',
+        help="Relate only K randomly chosen combinations of reset uuids per "
+             "pair of images, instead of all of them.")
+    parser.add_argument(
+        '--sample-seed',
+        type=int,
+        default=0,
+        help="Seed for choosing combinations with '--sample'.")
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        type=int,
+        default=None,
+        help="Number of processes to use, defaults to the number of "
+             "processors on the machine.")
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help="Print the results without saving the best parameters.")
+
+
+def process_args(args):
+    pairs = load_relate_pairs(args.ROTOMAP, args.loop)
+    if not pairs:
+        print('No pairs of images with moles to relate.')
+        return 1
+
+    candidates = list(itertools.product(args.field_errors, args.field_engines))
+
+    yield_combinations = (
+        mel.cmddebug.benchrelate.yield_reset_uuid_combinations)
+
+    tasks = []
+    for pair_index, (_, to_moles, _) in enumerate(pairs):
+        uuid_combinations = yield_combinations(
+            to_moles, args.reset_uuids, args.sample, args.sample_seed)
+        for uuids in uuid_combinations:
+            tasks.extend(
+                (candidate_index, pair_index, uuids)
+                for candidate_index in range(len(candidates)))
+
+    num_flaws = [0] * len(candidates)
+    num_facts = [0] * len(candidates)
+    with multiprocessing.Pool(
+            args.jobs, _init_worker, (pairs, candidates)) as pool:
+        for candidate_index, flaws, facts in pool.imap_unordered(
+                _relate_task, tasks, chunksize=_WORKER_CHUNKSIZE):
+            num_flaws[candidate_index] += flaws
+            num_facts[candidate_index] += facts
+
+    for (field_error, field_engine), flaws, facts in zip(
+            candidates, num_flaws, num_facts):
+        print('field_error {}, field_engine {}: {} flaws, {} facts.'.format(
+            field_error, field_engine, flaws, facts))
+
+    field_error, field_engine = best_candidate(candidates, num_flaws)
+    relate_config = {
+        'field_error': field_error,
+        'field_engine': field_engine,
+    }
+    print('Best: field_error {}, field_engine {}.'.format(
+        field_error, field_engine))
+
+    if not args.dry_run:
+        mel.rotomap.relate.save_relate_config(
+            args.ROTOMAP.path, relate_config)
+
+
+def load_relate_pairs(rotomap, is_loop):
+    """Return a list of (from_moles, to_moles, expected_theory).
+
+    Only neighbouring images that both have moles are included.
+
+    """
+    mole_lists = [
+        moles for _, moles in sorted(
+            rotomap.yield_mole_lists(), key=lambda x: x[0])
+    ]
+
+    index_pairs = list(zip(range(len(mole_lists)), range(1, len(mole_lists))))
+    if is_loop and len(mole_lists) > 2:
+        index_pairs.append((len(mole_lists) - 1, 0))
+
+    make_theory = mel.cmddebug.benchrelate.make_default_map_theory
+    return [
+        (
+            mole_lists[i],
+            mole_lists[j],
+            make_theory(mole_lists[i], mole_lists[j]),
+        )
+        for i, j in index_pairs
+        if mole_lists[i] and mole_lists[j]
+    ]
+
+
+def best_candidate(candidates, num_flaws):
+    """Return the (field_error, field_engine) candidate with fewest flaws.
+
+    Usage example:
+
+        >>> best_candidate(
+        ...     [(200, 'greedy'), (300, 'greedy'), (100, 'greedy')],
+        ...     [1, 1, 1])
+        (300, 'greedy')
+        >>> best_candidate(
+        ...     [(200, 'assignment'), (100, 'assignment')],
+        ...     [1, 1])
+        (100, 'assignment')
+
+    """
+    default = (mel.rotomap.relate._MAGIC_FIELD_ERROR, 'greedy')
+    return min(
+        zip(candidates, num_flaws),
+        key=lambda x: (x[1], x[0] != default, x[0][0]))[0]
+
+
+# Each task is quick, send them to the workers in batches to reduce overhead.
+_WORKER_CHUNKSIZE = 8
+
+
+# The pairs of mole lists that the worker processes relate, and the parameters
+# to try, set once per worker by _init_worker().
+_WORKER_PAIRS = None
+_WORKER_CANDIDATES = None
+
+
+def _init_worker(pairs, candidates):
+    global _WORKER_PAIRS
+    global _WORKER_CANDIDATES
+    _WORKER_PAIRS = pairs
+    _WORKER_CANDIDATES = candidates
+
+
+def _relate_task(task):
+    candidate_index, pair_index, uuids = task
+    field_error, field_engine = _WORKER_CANDIDATES[candidate_index]
+    from_moles, to_moles, expected_theory = _WORKER_PAIRS[pair_index]
+    make_combination = mel.cmddebug.benchrelate.make_reset_combination
+    new_to_moles, new_theory = make_combination(
+        to_moles, expected_theory, uuids)
+    flaws, facts, _ = mel.cmddebug.benchrelate.relate_pair(
+        from_moles,
+        new_to_moles,
+        new_theory,
+        False,
+        'exhaustive',
+        field_engine,
+        field_error)
+    return candidate_index, len(flaws), len(facts)
@@ -0,0 +1,211 @@
+"""Cache artifacts derived from images, like masks, on disk.
+
+Artifacts are stored under a key made from everything they were derived from,
+e.g. the content of the source image and the parameters of the algorithm. A
+changed input therefore means a different key, and there is no need to
+invalidate anything. The least recently used artifacts are removed once the
+cache grows beyond a size limit.
+
+Usage example:
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as path:
+    ...     cache = Cache(path)
+    ...     key = make_key('double', [1, 2])
+    ...     cached(cache, key, lambda: numpy.array([1, 2]) * 2,
+    ...            encode_array, decode_array)
+    ...     cached(cache, key, lambda: None, encode_array, decode_array)
+    array([2, 4])
+    array([2, 4])
+
+"""
+
+import hashlib
+import io
+import json
+import os
+
+import numpy
+
+import mel.lib.fs
+
+
+_DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# A dict of (path, mtime_ns, size) to the digest of the content of the file,
+# see file_digest().
+_FILE_DIGESTS = {}
+
+
+def default_path():
+    """Return the path of the cache directory to use if none is specified."""
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mel')
+
+
+class Cache():
+
+    """A directory of artifacts, each a file named by its key.
+
+    Reading an artifact marks it as recently used, by updating the
+    modification time of its file. Whenever an artifact is written, the least
+    recently used ones are removed until the total size is at most
+    'max_bytes'.
+
+    Errors other than missing artifacts are raised as OSError, cached() falls
+    back to computing artifacts if the cache can't be used.
+
+    """
+
+    def __init__(self, path, max_bytes=_DEFAULT_MAX_BYTES):
+        self.path = path
+        self._max_bytes = max_bytes
+
+    def get(self, key):
+        """Return the bytes of the artifact with 'key', or None if missing."""
+        entry_path = os.path.join(self.path, key)
+        try:
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        try:
+            os.utime(entry_path)
+        except OSError:
+            # The artifact is still good, e.g. in a read-only cache, it just
+            # won't be kept in preference to others.
+            pass
+
+        return data
+
+    def put(self, key, data):
+        """Store the bytes 'data' as the artifact with 'key'."""
+        os.makedirs(self.path, exist_ok=True)
+        with mel.lib.fs.replacing_open(
+                os.path.join(self.path, key), 'wb') as f:
+            f.write(data)
+        self._evict()
+
+    def _evict(self):
+        # Other processes may be using the cache too, so artifacts may be
+        # removed or replaced while we look at them.
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or entry.name.endswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self._max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total_bytes -= size
+
+
+def make_key(name, *parts):
+    """Return a string key for an artifact, from a name and what it's from.
+
+    :name: a string naming the artifact, include a version to change when the
+           algorithm does.
+    :parts: the inputs and parameters of the algorithm. Each may be a string,
+            bytes, a numpy.array, or anything that json can encode.
+    :returns: a string of hex digits.
+
+    Usage example:
+
+        >>> make_key('mask', 'a') == make_key('mask', 'b')
+        False
+
+    """
+    digest = hashlib.sha1()
+    for part in (name,) + parts:
+        if isinstance(part, numpy.ndarray):
+            data = json.dumps([str(part.dtype), part.shape]).encode()
+            data += numpy.ascontiguousarray(part).tobytes()
+        elif isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode()
+        else:
+            data = json.dumps(part, sort_keys=True).encode()
+
+        # Include the length, so that e.g. ('ab', 'c') and ('a', 'bc') differ.
+        digest.update(str(len(data)).encode() + b':')
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    """Return a hex digest of the content of the file at 'path'.
+
+    Digests are remembered for as long as the file's modification time and
+    size are unchanged, so a file is only read once per process.
+
+    """
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    digest = _FILE_DIGESTS.get(stamp)
+    if digest is None:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(block)
+        digest = sha1.hexdigest()
+        _FILE_DIGESTS[stamp] = digest
+    return digest
+
+
+def cached(cache, key, compute, encode, decode):
+    """Return the artifact with 'key' from 'cache', or compute and store it.
+
+    :cache: a Cache, or None to always compute.
+    :key: a key from make_key().
+    :compute: a callable taking no arguments, returning the artifact.
+    :encode: a callable to convert the artifact to bytes.
+    :decode: a callable to convert bytes from 'encode' back to the artifact.
+    :returns: the artifact.
+
+    If the cache can't be read or written, e.g. the disk is full, then the
+    artifact is computed as if there were no cache.
+
+    """
+    if cache is None:
+        return compute()
+
+    try:
+        data = cache.get(key)
+    except OSError:
+        data = None
+    if data is not None:
+        return decode(data)
+
+    value = compute()
+    try:
+        cache.put(key, encode(value))
+    except OSError:
+        pass
+    return value
+
+
+def encode_array(array):
+    data = io.BytesIO()
+    numpy.savez_compressed(data, array=array)
+    return data.getvalue()
+
+
+def decode_array(data):
+    with numpy.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        return arrays['array']
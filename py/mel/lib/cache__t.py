@@ -0,0 +1,109 @@
+"""Test suite for mel.lib.cache."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] Artifacts are computed once, then loaded from the cache
+# [ B] Arrays round-trip through the cache
+# [ C] The least recently used artifacts are evicted over the size limit
+# [ D] File digests change with the content of the file
+# [ E] cached() computes artifacts if the cache can't be used
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_cached
+# [ C] test_c_eviction
+# [ D] test_d_file_digest
+# [ E] test_e_unusable_cache
+# =============================================================================
+
+
+import os
+import tempfile
+import unittest
+
+import numpy
+
+import mel.lib.cache
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = mel.lib.cache.Cache(self.temp_dir.name, max_bytes=250)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_a_breathing(self):
+        self.assertIsNone(self.cache.get(mel.lib.cache.make_key('a')))
+
+    def test_b_cached(self):
+        computed = []
+
+        def compute():
+            computed.append(True)
+            return numpy.arange(6, dtype=numpy.uint8).reshape(2, 3)
+
+        key = mel.lib.cache.make_key('b', numpy.zeros(2), {'c': 1})
+
+        # [ B] Artifacts are computed once, then loaded from the cache
+        # [ B] Arrays round-trip through the cache
+        for _ in range(2):
+            array = mel.lib.cache.cached(
+                self.cache,
+                key,
+                compute,
+                mel.lib.cache.encode_array,
+                mel.lib.cache.decode_array)
+            self.assertEqual([[0, 1, 2], [3, 4, 5]], array.tolist())
+            self.assertEqual(numpy.uint8, array.dtype)
+        self.assertEqual(1, len(computed))
+
+    def test_c_eviction(self):
+        keys = [mel.lib.cache.make_key('c', i) for i in range(3)]
+        self.cache.put(keys[0], b'0' * 100)
+        self.cache.put(keys[1], b'1' * 100)
+        os.utime(os.path.join(self.cache.path, keys[0]), ns=(0, 0))
+        os.utime(os.path.join(self.cache.path, keys[1]), ns=(1, 1))
+
+        # [ C] The least recently used artifacts are evicted over the size
+        # limit
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.cache.put(keys[2], b'2' * 100)
+        self.assertIsNotNone(self.cache.get(keys[0]))
+        self.assertIsNone(self.cache.get(keys[1]))
+        self.assertIsNotNone(self.cache.get(keys[2]))
+
+    def test_d_file_digest(self):
+        path = os.path.join(self.temp_dir.name, 'file')
+        with open(path, 'w') as f:
+            f.write('a')
+        digest = mel.lib.cache.file_digest(path)
+
+        # [ D] File digests change with the content of the file
+        with open(path, 'w') as f:
+            f.write('bb')
+        self.assertNotEqual(digest, mel.lib.cache.file_digest(path))
+
+    def test_e_unusable_cache(self):
+        # A file where the cache directory should be makes every read and
+        # write fail.
+        path = os.path.join(self.temp_dir.name, 'file')
+        with open(path, 'w'):
+            pass
+        cache = mel.lib.cache.Cache(path)
+
+        # [ E] cached() computes artifacts if the cache can't be used
+        for _ in range(2):
+            array = mel.lib.cache.cached(
+                cache,
+                mel.lib.cache.make_key('e'),
+                lambda: numpy.arange(3),
+                mel.lib.cache.encode_array,
+                mel.lib.cache.decode_array)
+            self.assertEqual([0, 1, 2], array.tolist())
@@ -1,6 +1,21 @@
 """FileSystem helpers."""
 
+import contextlib
 import os
+import stat
+import tempfile
+
+
+def _read_umask():
+    # There's no way to read the umask without setting it, so do that once
+    # here before there are other threads that might create files.
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# The permissions of new files, see replacing_open().
+_NEW_FILE_MODE = 0o666 & ~_read_umask()
 
 
 def expand_dirs_to_jpegs(path_list):
@@ -22,3 +37,46 @@ def yield_only_jpegs_from_dir(path):
 def is_jpeg_name(filename):
     lower_ext = os.path.splitext(filename)[1].lower()
     return lower_ext in ('.jpg', '.jpeg')
+
+
+@contextlib.contextmanager
+def replacing_open(path, mode='w'):
+    """Open a temporary file to write to, and rename it over 'path' on close.
+
+    This means that other readers of 'path' never see a partially written
+    file. If there's an exception while writing, then 'path' is unchanged.
+    The temporary file is in the same directory, so that the rename is
+    atomic, and is synced to disk first so that 'path' is never left empty
+    after a crash. The file keeps its permissions, or gets the usual ones for
+    a new file.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+            mode,
+            dir=directory,
+            prefix=os.path.basename(path) + '.',
+            suffix='.tmp',
+            delete=False) as f:
+        try:
+            # NamedTemporaryFile is only readable by the owner, give it the
+            # permissions that the file would have had otherwise.
+            try:
+                file_mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                file_mode = _NEW_FILE_MODE
+            os.chmod(f.name, file_mode)
+
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+
+    try:
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
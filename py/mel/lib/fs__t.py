@@ -0,0 +1,59 @@
+"""Test suite for mel.lib.fs."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] replacing_open() replaces the file, keeping its permissions
+# [ B] replacing_open() leaves the file unchanged if writing fails
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_replacing_open
+# =============================================================================
+
+
+import os
+import stat
+import tempfile
+import unittest
+
+import mel.lib.fs
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        pass
+
+    def test_b_replacing_open(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, 'file.json')
+
+            # [ B] replacing_open() replaces the file, keeping its permissions
+            with mel.lib.fs.replacing_open(file_path) as f:
+                f.write('a')
+            os.chmod(file_path, 0o640)
+            with mel.lib.fs.replacing_open(file_path, 'wb') as f:
+                f.write(b'b')
+            with open(file_path) as f:
+                self.assertEqual('b', f.read())
+            self.assertEqual(
+                0o640, stat.S_IMODE(os.stat(file_path).st_mode))
+
+            # [ B] replacing_open() leaves the file unchanged if writing fails
+            with self.assertRaises(RuntimeError):
+                with mel.lib.fs.replacing_open(file_path) as f:
+                    f.write('c')
+                    raise RuntimeError()
+            with open(file_path) as f:
+                self.assertEqual('b', f.read())
+            self.assertEqual(['file.json'], os.listdir(path))
@@ -1,7 +1,5 @@
 """Math-related things."""
 
-import math
-
 import numpy
 
 
@@ -27,39 +25,98 @@ def clamp(x, x_min, x_max):
     return max(min(x, x_max), x_min)
 
 
-def distance_sq_2d(a, b):
-    """Return the squared distance between two points in two dimensions.
+def raise_if_not_int_vector2(v):
+    if not isinstance(v, numpy.ndarray):
+        raise ValueError('{}:{}:{} is not a numpy array'.format(
+            v, repr(v), type(v)))
+    if not numpy.issubdtype(v.dtype.type, numpy.integer):
+        raise ValueError('{}:{} is not an int vector2'.format(v, v.dtype))
 
-    Usage examples:
-        >>> distance_sq_2d((1, 1), (1, 1))
-        0
 
-        >>> distance_sq_2d((0, 0), (0, 2))
-        4
+def linear_sum_assignment(cost):
+    """Return (row_indices, col_indices) of the minimum cost assignment.
 
-    """
-    x = a[0] - b[0]
-    y = a[1] - b[1]
-    return (x * x) + (y * y)
+    Each row is assigned to a different column, such that the sum of the costs
+    of the assignments is minimal. If there are more columns than rows then
+    some columns will be unassigned, and vice-versa.
 
+    This is the Hungarian algorithm, in the form of finding shortest
+    augmenting paths with row and column potentials. The inner loop over
+    columns is done with numpy.
 
-def distance_2d(a, b):
-    """Return the distance between two points in two dimensions.
+    Usage example:
 
-    Usage examples:
-        >>> distance_2d((1, 1), (1, 1))
-        0.0
+        >>> rows, cols = linear_sum_assignment([[4, 1, 3], [2, 0, 5]])
+        >>> rows.tolist(), cols.tolist()
+        ([0, 1], [1, 0])
 
-        >>> distance_2d((0, 0), (0, 2))
-        2.0
+    :cost: a 2d array of costs, rows are assigned to columns.
+    :returns: a tuple of numpy.arrays, (row_indices, col_indices), sorted by
+              row index.
 
     """
-    return math.sqrt(distance_sq_2d(a, b))
-
-
-def raise_if_not_int_vector2(v):
-    if not isinstance(v, numpy.ndarray):
-        raise ValueError('{}:{}:{} is not a numpy array'.format(
-            v, repr(v), type(v)))
-    if not numpy.issubdtype(v.dtype.type, numpy.integer):
-        raise ValueError('{}:{} is not an int vector2'.format(v, v.dtype))
+    cost = numpy.asarray(cost, dtype=float)
+    if cost.ndim != 2:
+        raise ValueError('cost must be a 2d array', cost.shape)
+
+    if cost.shape[0] > cost.shape[1]:
+        col_indices, row_indices = linear_sum_assignment(cost.T)
+        order = numpy.argsort(row_indices)
+        return row_indices[order], col_indices[order]
+
+    num_rows, num_cols = cost.shape
+
+    # Column 0 is a sentinel for the row being added, so the real columns are
+    # indexed from 1. Similarly rows are indexed from 1, so that 0 can mean
+    # 'unassigned'.
+    padded_cost = numpy.full((num_rows, num_cols + 1), numpy.inf)
+    padded_cost[:, 1:] = cost
+    row_potential = numpy.zeros(num_rows + 1)
+    col_potential = numpy.zeros(num_cols + 1)
+    col_to_row = numpy.zeros(num_cols + 1, dtype=int)
+    col_way = numpy.zeros(num_cols + 1, dtype=int)
+
+    for row in range(1, num_rows + 1):
+        col_to_row[0] = row
+        col = 0
+        min_slack = numpy.full(num_cols + 1, numpy.inf)
+        is_used = numpy.zeros(num_cols + 1, dtype=bool)
+
+        # Grow a tree of tight edges from the new row until it reaches an
+        # unassigned column.
+        while True:
+            is_used[col] = True
+            this_row = col_to_row[col]
+            is_free = ~is_used
+
+            slack = (
+                padded_cost[this_row - 1]
+                - row_potential[this_row]
+                - col_potential)
+            is_better = is_free & (slack < min_slack)
+            min_slack[is_better] = slack[is_better]
+            col_way[is_better] = col
+
+            free_slack = numpy.where(is_free, min_slack, numpy.inf)
+            next_col = int(numpy.argmin(free_slack))
+            delta = free_slack[next_col]
+
+            row_potential[col_to_row[is_used]] += delta
+            col_potential[is_used] -= delta
+            min_slack[is_free] -= delta
+
+            col = next_col
+            if not col_to_row[col]:
+                break
+
+        # Flip the assignments along the augmenting path.
+        while col:
+            prev_col = col_way[col]
+            col_to_row[col] = col_to_row[prev_col]
+            col = prev_col
+
+    is_assigned = col_to_row[1:] > 0
+    col_indices = numpy.nonzero(is_assigned)[0]
+    row_indices = col_to_row[1:][is_assigned] - 1
+    order = numpy.argsort(row_indices)
+    return row_indices[order], col_indices[order]
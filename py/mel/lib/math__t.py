@@ -0,0 +1,59 @@
+"""Test suite for mel.lib.math."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] linear_sum_assignment() finds the minimum, for square and rectangular
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_linear_sum_assignment
+# =============================================================================
+
+
+import itertools
+import unittest
+
+import numpy
+
+import mel.lib.math
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        with self.assertRaises(ValueError):
+            mel.lib.math.linear_sum_assignment([1, 2, 3])
+
+    def test_b_linear_sum_assignment(self):
+        rng = numpy.random.RandomState(0)
+        for shape in [(1, 1), (3, 3), (5, 5), (3, 6), (6, 3), (4, 7)]:
+            for _ in range(10):
+                # Use a small range of values, so that there are ties.
+                cost = rng.randint(0, 5, size=shape)
+                rows, cols = mel.lib.math.linear_sum_assignment(cost)
+
+                num_assigned = min(shape)
+                self.assertEqual(num_assigned, len(set(rows)))
+                self.assertEqual(num_assigned, len(set(cols)))
+                self.assertEqual(sorted(rows.tolist()), rows.tolist())
+                self.assertEqual(
+                    brute_force_min_cost(cost), cost[rows, cols].sum())
+
+
+def brute_force_min_cost(cost):
+    if cost.shape[0] > cost.shape[1]:
+        cost = cost.T
+    num_rows, num_cols = cost.shape
+    return min(
+        sum(cost[r, c] for r, c in enumerate(cols))
+        for cols in itertools.permutations(range(num_cols), num_rows))
@@ -0,0 +1,177 @@
+"""Spatial indexing of 2d points, for fast nearest-point queries."""
+
+import copy
+import math
+
+import numpy
+
+
+class PointGrid():
+
+    """A uniform grid of 2d points, supporting nearest and radius queries.
+
+    Points are referred to by their index in the list supplied on
+    construction. Results are ordered by distance, ties are broken by index so
+    that results are the same as for a simple linear scan of the points.
+
+    Usage example:
+
+        >>> grid = PointGrid([(0, 0), (10, 0), (0, 10)])
+        >>> grid.nearest((9, 1))
+        (1, 2)
+        >>> grid.k_nearest((1, 1), 2)
+        [(0, 2), (1, 82)]
+        >>> grid.within_radius((0, 0), 10)
+        [(0, 0), (1, 100), (2, 100)]
+        >>> grid.remove(1)
+        >>> grid.nearest((9, 1))
+        (0, 82)
+
+    """
+
+    def __init__(self, points, cell_size=None):
+        self._points = [_to_xy(p) for p in points]
+        self._cells = {}
+        self._indices = set()
+
+        if cell_size is None:
+            cell_size = _guess_cell_size(self._points)
+        elif cell_size <= 0:
+            raise ValueError("'cell_size' must be more than zero", cell_size)
+        self._cell_size = cell_size
+
+        for i, (x, y) in enumerate(self._points):
+            self._cells.setdefault(self._cell(x, y), []).append(i)
+            self._indices.add(i)
+
+        if self._cells:
+            cells_x = [c[0] for c in self._cells]
+            cells_y = [c[1] for c in self._cells]
+            self._bounds = (
+                min(cells_x), min(cells_y), max(cells_x), max(cells_y))
+        else:
+            self._bounds = None
+
+    def __len__(self):
+        return len(self._indices)
+
+    def __contains__(self, index):
+        return index in self._indices
+
+    def copy(self):
+        """Return a copy of the grid, points may be removed independently."""
+        grid = copy.copy(self)
+        grid._cells = {c: list(i) for c, i in self._cells.items()}
+        grid._indices = set(self._indices)
+        return grid
+
+    def remove(self, index):
+        """Remove the point at 'index' from consideration in queries."""
+        self._indices.remove(index)
+        self._cells[self._cell(*self._points[index])].remove(index)
+
+    def nearest(self, point):
+        """Return (index, distance_sq) of the nearest point, or (None, None).
+
+        :point: a 2d point to search from.
+        :returns: a tuple of (index, squared distance) for the nearest point,
+                  or (None, None) if there are no points.
+
+        """
+        found = self.k_nearest(point, 1)
+        if not found:
+            return None, None
+        return found[0]
+
+    def k_nearest(self, point, k):
+        """Return a list of up to 'k' (index, distance_sq), nearest first."""
+        if not self._indices or k < 1:
+            return []
+
+        x, y = _to_xy(point)
+        cell_x, cell_y = self._cell(x, y)
+        left, top, right, bottom = self._bounds
+
+        # Search in square rings of cells around the query cell, starting from
+        # the first ring that may contain points. Points in ring 'r' are more
+        # than '(r - 1) * cell_size' away, so we can stop searching once that
+        # is further than the k'th nearest point found so far.
+
+        first_ring = max(
+            left - cell_x, cell_x - right, top - cell_y, cell_y - bottom, 0)
+        last_ring = max(
+            abs(cell_x - left), abs(cell_x - right),
+            abs(cell_y - top), abs(cell_y - bottom))
+
+        found = []
+        for ring in range(first_ring, last_ring + 1):
+            if ring and len(found) >= k:
+                min_ring_distance = (ring - 1) * self._cell_size
+                if min_ring_distance * min_ring_distance >= found[k - 1][0]:
+                    break
+            for cell in _yield_ring_cells(cell_x, cell_y, ring):
+                for i in self._cells.get(cell, ()):
+                    found.append((_distance_sq(self._points[i], x, y), i))
+            found.sort()
+            del found[k:]
+
+        return [(i, dist_sq) for dist_sq, i in found]
+
+    def within_radius(self, point, radius):
+        """Return a list of (index, distance_sq) within radius, nearest first.
+
+        Points exactly 'radius' away are included.
+
+        """
+        x, y = _to_xy(point)
+        left, top = self._cell(x - radius, y - radius)
+        right, bottom = self._cell(x + radius, y + radius)
+        radius_sq = radius * radius
+
+        found = []
+        for cell_y in range(top, bottom + 1):
+            for cell_x in range(left, right + 1):
+                for i in self._cells.get((cell_x, cell_y), ()):
+                    dist_sq = _distance_sq(self._points[i], x, y)
+                    if dist_sq <= radius_sq:
+                        found.append((dist_sq, i))
+        found.sort()
+
+        return [(i, dist_sq) for dist_sq, i in found]
+
+    def _cell(self, x, y):
+        return int(x // self._cell_size), int(y // self._cell_size)
+
+
+def _to_xy(point):
+    # Convert from numpy types, Python numbers are much faster to work with one
+    # at a time.
+    return tuple(numpy.asarray(point[:2]).tolist())
+
+
+def _guess_cell_size(points):
+    # Aim for around one point per cell.
+    if not points:
+        return 1
+    width = max(p[0] for p in points) - min(p[0] for p in points)
+    height = max(p[1] for p in points) - min(p[1] for p in points)
+    area = max(width, 1) * max(height, 1)
+    return max(int(math.sqrt(area / len(points))), 1)
+
+
+def _yield_ring_cells(cell_x, cell_y, ring):
+    if not ring:
+        yield cell_x, cell_y
+        return
+    for i in range(-ring, ring + 1):
+        yield cell_x + i, cell_y - ring
+        yield cell_x + i, cell_y + ring
+    for i in range(-ring + 1, ring):
+        yield cell_x - ring, cell_y + i
+        yield cell_x + ring, cell_y + i
+
+
+def _distance_sq(point, x, y):
+    dx = point[0] - x
+    dy = point[1] - y
+    return (dx * dx) + (dy * dy)
@@ -0,0 +1,83 @@
+"""Test suite for mel.lib.spatial."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] PointGrid queries agree with a linear scan, including ties
+# [ B] PointGrid queries from outside the extents of the points
+# [ C] PointGrid.remove() excludes points, PointGrid.copy() is independent
+# [ D] PointGrid with no points
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_agrees_with_linear_scan
+# [ C] test_c_remove_and_copy
+# [ D] test_d_empty
+# =============================================================================
+
+
+import random
+import unittest
+
+import mel.lib.spatial
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        mel.lib.spatial.PointGrid([(0, 0)])
+        mel.lib.spatial.PointGrid([(0, 0)], cell_size=10)
+        with self.assertRaises(ValueError):
+            mel.lib.spatial.PointGrid([(0, 0)], cell_size=0)
+
+    def test_b_agrees_with_linear_scan(self):
+        rng = random.Random(0)
+
+        # Use a small range of values, so that there are plenty of ties.
+        points = [(rng.randint(0, 50), rng.randint(0, 50)) for _ in range(100)]
+        grid = mel.lib.spatial.PointGrid(points)
+
+        for _ in range(100):
+            query = (rng.randint(-100, 150), rng.randint(-100, 150))
+            expected = sorted(
+                (distance_sq(p, query), i) for i, p in enumerate(points))
+            expected = [(i, d) for d, i in expected]
+
+            self.assertEqual(expected[0], grid.nearest(query))
+            self.assertEqual(expected[:5], grid.k_nearest(query, 5))
+            self.assertEqual(
+                [(i, d) for i, d in expected if d <= 20 * 20],
+                grid.within_radius(query, 20))
+
+    def test_c_remove_and_copy(self):
+        grid = mel.lib.spatial.PointGrid([(0, 0), (1, 1), (2, 2)])
+        grid_copy = grid.copy()
+
+        grid.remove(0)
+        self.assertEqual(2, len(grid))
+        self.assertNotIn(0, grid)
+        self.assertEqual((1, 2), grid.nearest((0, 0)))
+
+        self.assertEqual(3, len(grid_copy))
+        self.assertIn(0, grid_copy)
+        self.assertEqual((0, 0), grid_copy.nearest((0, 0)))
+
+    def test_d_empty(self):
+        grid = mel.lib.spatial.PointGrid([])
+        self.assertEqual(0, len(grid))
+        self.assertEqual((None, None), grid.nearest((0, 0)))
+        self.assertEqual([], grid.k_nearest((0, 0), 3))
+        self.assertEqual([], grid.within_radius((0, 0), 10))
+
+
+def distance_sq(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2
@@ -16,6 +16,9 @@ In summary:
 
 """
 
+import os
+import tempfile
+
 import cv2
 import numpy
 
@@ -33,17 +36,42 @@ class NamedClassifier(object):
         self._number_to_name = {}
         self._next_class_num = 0
 
-    def add_sample(self, data, class_name):
+    @property
+    def c(self):
+        return self._classifier.c
 
-        if class_name not in self._name_to_number:
-            class_num = self._next_class_num
-            self._name_to_number[class_name] = class_num
-            self._number_to_name[class_num] = class_name
-            self._next_class_num += 1
-        else:
-            class_num = self._name_to_number[class_name]
+    @property
+    def gamma(self):
+        return self._classifier.gamma
+
+    def to_dict(self):
+        """Return a dict that json can encode, for from_dict().
+
+        The training samples are not included, only what's needed to predict.
+
+        """
+        return {
+            'class_names': [
+                self._number_to_name[i] for i in range(self._next_class_num)
+            ],
+            'svm': self._classifier.to_string(),
+        }
+
+    @classmethod
+    def from_dict(cls, model):
+        """Return a trained NamedClassifier from the result of to_dict()."""
+        classifier = cls(Classifier.from_string(model['svm']))
+        for class_name in model['class_names']:
+            classifier._class_num(class_name)
+        return classifier
+
+    def add_sample(self, data, class_name):
+        self._classifier.add_sample(data, self._class_num(class_name))
 
-        self._classifier.add_sample(data, class_num)
+    def add_samples(self, matrix, class_names):
+        """Add a sample for each row of 'matrix', of the class in the list."""
+        self._classifier.add_samples(
+            matrix, [self._class_num(name) for name in class_names])
 
     def train(self):
         self._classifier.train()
@@ -52,6 +80,22 @@ class NamedClassifier(object):
         class_num = self._classifier.predict(data)
         return self._number_to_name[class_num]
 
+    def predict_batch(self, matrix):
+        """Return a list of the class name of each row of 'matrix'."""
+        return [
+            self._number_to_name[class_num]
+            for class_num in self._classifier.predict_batch(matrix).tolist()
+        ]
+
+    def _class_num(self, class_name):
+        class_num = self._name_to_number.get(class_name)
+        if class_num is None:
+            class_num = self._next_class_num
+            self._name_to_number[class_name] = class_num
+            self._number_to_name[class_num] = class_name
+            self._next_class_num += 1
+        return class_num
+
 
 class Classifier(object):
 
@@ -68,6 +112,8 @@ class Classifier(object):
         elif gamma <= 0:
             raise ValueError("'gamma' must be more than zero", gamma)
 
+        # Lists of 2d arrays of samples and 1d arrays of their classes, these
+        # are only concatenated when training.
         self._training_data = []
         self._responses = []
 
@@ -77,26 +123,62 @@ class Classifier(object):
         self._svm.setKernel(cv2.ml.SVM_RBF)
         self._svm.setType(cv2.ml.SVM_C_SVC)
 
+    @property
+    def c(self):
+        return self._svm.getC()
+
+    @property
+    def gamma(self):
+        return self._svm.getGamma()
+
+    def to_string(self):
+        """Return the trained SVM, as serialized by OpenCV."""
+        # The OpenCV bindings can only save to and load from files.
+        with tempfile.TemporaryDirectory() as path:
+            svm_path = os.path.join(path, 'svm.yml')
+            self._svm.save(svm_path)
+            with open(svm_path) as f:
+                return f.read()
+
+    @classmethod
+    def from_string(cls, text):
+        """Return a trained Classifier from the result of to_string()."""
+        with tempfile.TemporaryDirectory() as path:
+            svm_path = os.path.join(path, 'svm.yml')
+            with open(svm_path, 'w') as f:
+                f.write(text)
+            svm = cv2.ml.SVM_load(svm_path)
+        classifier = cls()
+        classifier._svm = svm
+        return classifier
+
     def add_sample(self, data, class_num):
-        self._training_data.append(data)
-        self._responses.append(class_num)
+        self.add_samples([data], [class_num])
+
+    def add_samples(self, matrix, class_nums):
+        """Add a sample for each row of 'matrix', of the class in the list."""
+        matrix = numpy.asarray(matrix, dtype=numpy.float32)
+        class_nums = numpy.asarray(class_nums, dtype=numpy.int32)
+        if matrix.ndim != 2 or len(matrix) != len(class_nums):
+            raise ValueError(
+                "Expected a 2d 'matrix' with a row per class number",
+                matrix.shape,
+                class_nums.shape)
+        self._training_data.append(matrix)
+        self._responses.append(class_nums)
 
     def train(self):
-
-        training_data = numpy.array(
-            [
-                numpy.array(x, dtype=numpy.float32)
-                for x in self._training_data
-            ],
-            dtype=numpy.float32)
-
-        responses = numpy.array(self._responses, dtype=numpy.int32)
-
         self._svm.train(
-            training_data,
+            numpy.concatenate(self._training_data),
             cv2.ml.ROW_SAMPLE,
-            responses)
+            numpy.concatenate(self._responses))
 
     def predict(self, sample):
-        data = numpy.array([sample], dtype=numpy.float32)
-        return int(self._svm.predict(data)[1].ravel())
+        return int(self.predict_batch([sample])[0])
+
+    def predict_batch(self, matrix):
+        """Return a 1d numpy.array of the class number of each row."""
+        matrix = numpy.asarray(matrix, dtype=numpy.float32)
+        if not len(matrix):
+            return numpy.empty((0,), dtype=numpy.int32)
+        return self._svm.predict(matrix)[1].ravel().astype(numpy.int32)
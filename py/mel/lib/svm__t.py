@@ -6,15 +6,22 @@
 # cover those concerns.
 #
 # Concerns:
-# [  ]
+# [ C] add_samples() and predict_batch() agree with the single versions
+# [ C] predict_batch() copes with no samples
+# [ D] a NamedClassifier predicts the same after to_dict() and from_dict()
 # -----------------------------------------------------------------------------
 # Tests:
 # [ A] test_A_Breathing
 # [ B] test_B_Breathing
+# [ C] test_C_Batch
+# [ D] test_D_Serialization
 # =============================================================================
 
+import json
 import unittest
 
+import numpy
+
 import mel.lib.svm
 
 
@@ -71,3 +78,46 @@ class Test(unittest.TestCase):
         self.assertEqual(classifier.predict([1.0, 1.0]), "orange")
         self.assertEqual(classifier.predict([0.0, 1.0]), "badger")
         self.assertEqual(classifier.predict([0.5, 0.5]), "tea")
+
+    def test_C_Batch(self):
+        samples = numpy.array([[1.0, 1.0], [0.0, 1.0], [0.5, 0.5]])
+
+        # [ C] add_samples() and predict_batch() agree with the single
+        # versions
+        classifier = mel.lib.svm.Classifier()
+        classifier.add_samples(numpy.tile(samples, (3, 1)), [0, 2, 1] * 3)
+        classifier.add_sample([1.0, 1.0], 0)
+        classifier.train()
+        self.assertEqual(
+            [0, 2, 1], classifier.predict_batch(samples).tolist())
+        self.assertEqual(
+            [classifier.predict(x) for x in samples],
+            classifier.predict_batch(samples).tolist())
+
+        named = mel.lib.svm.NamedClassifier()
+        named.add_samples(samples, ["orange", "badger", "tea"])
+        named.train()
+        self.assertEqual(
+            ["orange", "badger", "tea"], named.predict_batch(samples))
+
+        with self.assertRaises(ValueError):
+            classifier.add_samples(samples, [0, 1])
+
+        # [ C] predict_batch() copes with no samples
+        self.assertEqual([], named.predict_batch(numpy.empty((0, 2))))
+
+    def test_D_Serialization(self):
+        samples = numpy.array([[1.0, 1.0], [0.0, 1.0], [0.5, 0.5]])
+        classifier = mel.lib.svm.NamedClassifier()
+        classifier.add_samples(
+            numpy.tile(samples, (3, 1)), ["orange", "badger", "tea"] * 3)
+        classifier.train()
+
+        # [ D] a NamedClassifier predicts the same after to_dict() and
+        # from_dict()
+        model = json.loads(json.dumps(classifier.to_dict()))
+        loaded = mel.lib.svm.NamedClassifier.from_dict(model)
+        self.assertEqual(
+            ["orange", "badger", "tea"], loaded.predict_batch(samples))
+        self.assertEqual(classifier.c, loaded.c)
+        self.assertEqual(classifier.gamma, loaded.gamma)
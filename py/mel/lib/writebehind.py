@@ -0,0 +1,138 @@
+"""Defer and coalesce writes to files, doing them on a background thread."""
+
+import logging
+import threading
+import time
+
+
+class WriteError(Exception):
+
+    """Raised by WriteBehind.flush() if any writes failed.
+
+    'failures' is a list of (key, exception) for each write that failed.
+
+    """
+
+    def __init__(self, failures):
+        super().__init__(
+            '{} write(s) failed: {}'.format(
+                len(failures),
+                ', '.join('{}: {}'.format(k, e) for k, e in failures)))
+        self.failures = failures
+
+
+class WriteBehind():
+
+    """Do scheduled writes on a background thread, once writes are idle.
+
+    Writes are identified by a key, usually the path being written. Only the
+    last write scheduled for each key is done, so repeatedly saving the same
+    file while editing results in a single write. Pending writes are done once
+    'delay' seconds have passed without another being scheduled, or when
+    flush() or close() are called.
+
+    If a write fails, it is kept to be tried again with the next flush,
+    unless another write has been scheduled for the same key since. The
+    failure is raised from flush() or close(), or logged if the write was in
+    the background.
+
+    Usage example:
+
+        >>> written = []
+        >>> writer = WriteBehind(delay=60)
+        >>> writer.schedule('a', lambda: written.append(1))
+        >>> writer.schedule('a', lambda: written.append(2))
+        >>> writer.flush()
+        >>> written
+        [2]
+        >>> writer.close()
+
+    """
+
+    def __init__(self, delay):
+        self._delay = delay
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._deadline = None
+        self._is_closed = False
+
+        # Held while writing, so that flush() doesn't return while the
+        # background thread is part way through a write.
+        self._write_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, key, write):
+        """Schedule 'write' to be called, replacing any pending for 'key'.
+
+        :key: a hashable identifying what will be written, e.g. a path.
+        :write: a callable taking no arguments that does the write. It will
+                be called on another thread, so it must not refer to data
+                that will be modified before it's called.
+
+        """
+        with self._condition:
+            if self._is_closed:
+                raise ValueError('WriteBehind is closed')
+            self._pending.pop(key, None)
+            self._pending[key] = write
+            self._deadline = time.monotonic() + self._delay
+            self._condition.notify()
+
+    def flush(self):
+        """Do all the pending writes now, returning when they're done.
+
+        :raises WriteError: if any of the writes failed, after trying all of
+                            them.
+
+        """
+        with self._write_lock:
+            with self._condition:
+                pending = self._pending
+                self._pending = {}
+
+            failures = []
+            for key, write in pending.items():
+                try:
+                    write()
+                except Exception as e:
+                    failures.append((key, write, e))
+
+            if failures:
+                with self._condition:
+                    for key, write, _ in failures:
+                        # Don't replace a newer write scheduled meanwhile.
+                        self._pending.setdefault(key, write)
+                    self._deadline = time.monotonic() + self._delay
+                raise WriteError(
+                    [(key, e) for key, _, e in failures]) from failures[0][2]
+
+    def close(self):
+        """Stop the background thread, and do any pending writes."""
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while self._wait_until_idle():
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Failed to write in the background.')
+
+    def _wait_until_idle(self):
+        # Return True when there are pending writes and no more have been
+        # scheduled for 'delay' seconds, or False when closed.
+        with self._condition:
+            while not self._is_closed:
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    return True
+                self._condition.wait(remaining)
+            return False
@@ -0,0 +1,107 @@
+"""Test suite for mel.lib.writebehind."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] Only the last write scheduled for each key is done
+# [ B] Pending writes are done in the background once idle
+# [ C] close() does pending writes, scheduling afterwards is an error
+# [ D] A failing write doesn't stop the others, and is raised and retried
+# [ D] A failed write is dropped if a newer one is scheduled for its key
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_coalesce_and_idle
+# [ C] test_c_close
+# [ D] test_d_failing_write
+# =============================================================================
+
+
+import threading
+import unittest
+
+import mel.lib.writebehind
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        writer = mel.lib.writebehind.WriteBehind(delay=0)
+        writer.close()
+
+    def test_b_coalesce_and_idle(self):
+        written = []
+        is_written = threading.Event()
+
+        def write(value):
+            written.append(value)
+            is_written.set()
+
+        writer = mel.lib.writebehind.WriteBehind(delay=0.01)
+
+        # [ B] Only the last write scheduled for each key is done
+        # [ B] Pending writes are done in the background once idle
+        writer.schedule('a', lambda: write('a1'))
+        writer.schedule('a', lambda: write('a2'))
+        self.assertTrue(is_written.wait(10))
+        writer.flush()
+        self.assertEqual(['a2'], written)
+
+        writer.close()
+
+    def test_c_close(self):
+        written = []
+        writer = mel.lib.writebehind.WriteBehind(delay=60)
+        writer.schedule('a', lambda: written.append('a'))
+        writer.schedule('b', lambda: written.append('b'))
+
+        # [ C] close() does pending writes, scheduling afterwards is an error
+        writer.close()
+        self.assertEqual(['a', 'b'], written)
+        with self.assertRaises(ValueError):
+            writer.schedule('a', lambda: written.append('a'))
+
+    def test_d_failing_write(self):
+        written = []
+        is_failing = [True]
+
+        def fail():
+            if is_failing[0]:
+                raise OSError('disk full')
+            written.append('b')
+
+        writer = mel.lib.writebehind.WriteBehind(delay=60)
+        writer.schedule('a', lambda: written.append('a'))
+        writer.schedule('b', fail)
+        writer.schedule('c', lambda: written.append('c'))
+
+        # [ D] A failing write doesn't stop the others, and is raised and
+        # retried
+        with self.assertRaises(mel.lib.writebehind.WriteError) as context:
+            writer.flush()
+        self.assertEqual(['b'], [k for k, _ in context.exception.failures])
+        self.assertEqual(['a', 'c'], written)
+        is_failing[0] = False
+        writer.flush()
+        self.assertEqual(['a', 'c', 'b'], written)
+
+        # [ D] A failed write is dropped if a newer one is scheduled for its
+        # key
+        def fail_after_newer_scheduled():
+            writer.schedule('b', lambda: written.append('b2'))
+            raise OSError('disk full')
+
+        writer.schedule('b', fail_after_newer_scheduled)
+        with self.assertRaises(mel.lib.writebehind.WriteError):
+            writer.flush()
+        writer.close()
+        self.assertEqual(['a', 'c', 'b', 'b2'], written)
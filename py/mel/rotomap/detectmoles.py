@@ -1,8 +1,11 @@
 """Detect moles in an image."""
 
+import json
+
 import cv2
 import numpy
 
+import mel.lib.cache
 import mel.rotomap.moles
 
 
@@ -40,6 +43,42 @@ def moles(image, mask):
     return moles_
 
 
+def moles_cached(cache, image_path, mask, image=None):
+    """Return moles(image, mask) for the image at 'image_path', from 'cache'.
+
+    :cache: a mel.lib.cache.Cache, or None to not use one.
+    :image_path: the path of the image to detect moles in.
+    :mask: the mask of the image, or None.
+    :image: the image if already loaded, otherwise it's only loaded if the
+            moles aren't in the cache.
+    :returns: a list of mole dicts. The uuids will be the same as when they
+              were cached.
+
+    """
+    def compute():
+        return moles(
+            image if image is not None else cv2.imread(image_path), mask)
+
+    key = mel.lib.cache.make_key(
+        'detectmoles.moles-1',
+        mel.lib.cache.file_digest(image_path),
+        mask if mask is not None else 'no mask')
+    return mel.lib.cache.cached(
+        cache,
+        key,
+        compute,
+        _encode_moles,
+        _decode_moles)
+
+
+def _encode_moles(moles):
+    return json.dumps(moles).encode()
+
+
+def _decode_moles(data):
+    return json.loads(data.decode())
+
+
 def _is_mask_region_all_set(mask, point, region_size):
     x, y = (int(i) for i in point)
     x_slice = slice(x - region_size, x + region_size)
@@ -3,13 +3,17 @@
 import enum
 
 import collections
+import os
+
 import cv2
 import numpy
 
+import mel.lib.cache
 import mel.lib.common
 import mel.lib.image
 import mel.lib.math
 import mel.lib.ui
+import mel.lib.writebehind
 import mel.rotomap.detectmoles
 import mel.rotomap.mask
 import mel.rotomap.moles
@@ -264,6 +268,7 @@ class ImageRelateOverlay():
     def __init__(self):
         self.prev_moles = None
         self.moles = None
+        self.relate_config = {}
         self.is_target_mode = False
 
     def __call__(self, image, transform):
@@ -288,7 +293,10 @@ class ImageRelateOverlay():
 
             if self.moles:
                 best_theory = mel.rotomap.relate.best_theory(
-                    self.prev_moles, self.moles, iterate=False)
+                    self.prev_moles,
+                    self.moles,
+                    iterate=False,
+                    **self.relate_config)
 
         green = [[0, 255, 0], [128, 255, 128], [0, 255, 0]]
         red = [[0, 0, 255], [128, 128, 255], [0, 0, 255]]
@@ -476,7 +484,10 @@ class Editor:
     def __init__(self, directory_list, width, height):
         self._uuid_to_tricolour = mel.rotomap.tricolour.UuidTriColourPicker()
         self.display = Display(width, height)
-        self.moledata_list = [MoleData(x.image_paths) for x in directory_list]
+        self.cache = mel.lib.cache.Cache(mel.lib.cache.default_path())
+        self.moledata_list = [
+            MoleData(x, self.cache) for x in directory_list
+        ]
 
         self._mode = EditorMode.edit_mole
 
@@ -596,6 +607,8 @@ class Editor:
         elif self._mode is EditorMode.image_relate:
             self.image_relate_overlay.moles = self.moledata.moles
             self.image_relate_overlay.prev_moles = self.from_moles
+            self.image_relate_overlay.relate_config = (
+                self.moledata.relate_config())
             self.display.show_current(
                 image,
                 self.image_relate_overlay)
@@ -620,13 +633,20 @@ class Editor:
         self.display.set_zoomed(image_x, image_y)
         self.show_current()
 
+    def close(self):
+        """Save any pending changes, the Editor must not be used after."""
+        for moledata in self.moledata_list:
+            moledata.close()
+
     def show_prev_map(self):
+        self.moledata.flush()
         self.moledata_index -= 1
         self.moledata_index %= len(self.moledata_list)
         self.moledata = self.moledata_list[self.moledata_index]
         self.show_current()
 
     def show_next_map(self):
+        self.moledata.flush()
         self.moledata_index += 1
         self.moledata_index %= len(self.moledata_list)
         self.moledata = self.moledata_list[self.moledata_index]
@@ -692,23 +712,48 @@ class Editor:
         self.moledata.save_moles()
         self.show_current()
 
-    def remap_uuid(self, from_uuid, to_uuid):
-        self.moledata.remap_uuid(from_uuid, to_uuid)
+    def remap_uuids(self, uuid_map):
+        self.moledata.remap_uuids(uuid_map)
         self.show_current()
 
 
+# Seconds without edits before saving them. Saving the mask of a large image
+# takes long enough to make painting stutter, so wait for a pause.
+_MAGIC_SAVE_DELAY = 1
+
+
 class MoleData:
 
-    def __init__(self, path_list):
+    def __init__(self, rotomap, cache=None):
         self.moles = []
         self.image = None
         self.mask = None
-        self._mask_path = None
-        self._path_list = path_list
+        self._rotomap = rotomap
+        self._image_paths = None
         self._list_index = 0
-        self._num_images = len(self._path_list)
         self._loaded_index = None
-        self._ensure_loaded()
+        self._writer = mel.lib.writebehind.WriteBehind(_MAGIC_SAVE_DELAY)
+        self._cache = cache
+
+        # The relate config of each rotomap, see relate_config().
+        self._relate_configs = {}
+
+        # The uuids in each image and the images with each uuid, see
+        # _ensure_uuid_index(). Only needed for remapping, so it's made on
+        # first use.
+        self._image_uuids = None
+        self._uuid_to_image_paths = None
+
+        # Don't load anything until get_image() is called, as there may be
+        # many rotomaps which are never viewed.
+
+    @property
+    def _path_list(self):
+        # Only list the images of the rotomap when it's first viewed, so that
+        # startup time doesn't depend on the number of rotomaps.
+        if self._image_paths is None:
+            self._image_paths = self._rotomap.image_paths
+        return self._image_paths
 
     def get_image(self):
         self._ensure_loaded()
@@ -725,42 +770,124 @@ class MoleData:
         self.moles = mel.rotomap.moles.load_image_moles(image_path)
 
         height, width = self.image.shape[:2]
-        self._mask_path = mel.rotomap.mask.path(image_path)
         self.mask = mel.rotomap.mask.load_or_none(image_path)
         if self.mask is None:
             self.mask = numpy.zeros((height, width, 1), numpy.uint8)
 
         self._loaded_index = self._list_index
 
-    def remap_uuid(self, from_uuid, to_uuid):
-        for image_path in self._path_list:
+    def remap_uuids(self, uuid_map):
+        """Change the uuids of moles in all the images, and save them now.
+
+        :uuid_map: a dict of from_uuid to to_uuid. All the uuids are remapped
+                   at once, so e.g. {'a': 'b', 'b': 'a'} swaps two moles.
+
+        Only the mole files of images with moles to remap are re-written, and
+        each of those only once.
+
+        """
+        self._writer.flush()
+        self._ensure_uuid_index()
+
+        image_paths = set()
+        for from_uuid in uuid_map:
+            image_paths.update(self._uuid_to_image_paths.get(from_uuid, ()))
+
+        for image_path in sorted(image_paths):
             moles = mel.rotomap.moles.load_image_moles(image_path)
             for m in moles:
-                if m['uuid'] == from_uuid:
+                to_uuid = uuid_map.get(m['uuid'])
+                if to_uuid is not None:
                     m['uuid'] = to_uuid
                     m['is_uuid_canonical'] = True
             mel.rotomap.moles.save_image_moles(moles, image_path)
+            self._index_image_uuids(image_path, moles)
 
         image_path = self._path_list[self._list_index]
-        self.moles = mel.rotomap.moles.load_image_moles(image_path)
+        if image_path in image_paths:
+            self.moles = mel.rotomap.moles.load_image_moles(image_path)
+
+    def _ensure_uuid_index(self):
+        if self._image_uuids is not None:
+            return
+
+        self._image_uuids = {}
+        self._uuid_to_image_paths = collections.defaultdict(set)
+
+        # Use the mole index of each rotomap, to avoid reading every file.
+        mole_indices = {}
+        for image_path in self._path_list:
+            rotomap_path = os.path.dirname(image_path)
+            if rotomap_path not in mole_indices:
+                mole_indices[rotomap_path] = mel.rotomap.moles.MoleIndex(
+                    rotomap_path, self._cache)
+            self._index_image_uuids(
+                image_path,
+                mole_indices[rotomap_path].image_moles(image_path))
+
+    def _index_image_uuids(self, image_path, moles):
+        for mole_uuid in self._image_uuids.get(image_path, ()):
+            self._uuid_to_image_paths[mole_uuid].discard(image_path)
+        uuids = {m['uuid'] for m in moles}
+        self._image_uuids[image_path] = uuids
+        for mole_uuid in uuids:
+            self._uuid_to_image_paths[mole_uuid].add(image_path)
 
     def decrement(self):
-        new_index = self._list_index + self._num_images - 1
-        self._list_index = new_index % self._num_images
+        self._writer.flush()
+        num_images = len(self._path_list)
+        new_index = self._list_index + num_images - 1
+        self._list_index = new_index % num_images
 
     def increment(self):
-        self._list_index = (self._list_index + 1) % self._num_images
+        self._writer.flush()
+        self._list_index = (self._list_index + 1) % len(self._path_list)
 
     def index(self):
         return self._list_index
 
     def save_mask(self):
-        cv2.imwrite(self._mask_path, self.mask)
+        """Schedule the mask to be saved in the background, see flush()."""
+        image_path = self._path_list[self._list_index]
+
+        # Painting modifies the mask in place, so save a snapshot of it. The
+        # copy is cheap compared to encoding it.
+        mask = self.mask.copy()
+        self._writer.schedule(
+            mel.rotomap.mask.path(image_path),
+            lambda: mel.rotomap.mask.save(image_path, mask))
 
     def save_moles(self):
+        """Schedule the moles to be saved in the background, see flush()."""
         image_path = self._path_list[self._list_index]
         mel.rotomap.moles.normalise_moles(self.moles)
-        mel.rotomap.moles.save_image_moles(self.moles, image_path)
+        moles = [dict(m) for m in self.moles]
+        if self._image_uuids is not None:
+            self._index_image_uuids(image_path, moles)
+        self._writer.schedule(
+            image_path + '.json',
+            lambda: mel.rotomap.moles.save_image_moles(moles, image_path))
+
+    def flush(self):
+        """Save any pending changes now, returning when they're saved."""
+        self._writer.flush()
+
+    def close(self):
+        """Save any pending changes, the MoleData must not be saved after."""
+        self._writer.close()
 
     def current_image_path(self):
         return self._path_list[self._list_index]
+
+    def relate_config(self):
+        """Return the best_theory() keyword arguments for the current image.
+
+        These are loaded from the config file of the image's rotomap, see
+        mel.rotomap.relate.load_relate_config().
+
+        """
+        rotomap_path = os.path.dirname(self.current_image_path())
+        if rotomap_path not in self._relate_configs:
+            self._relate_configs[rotomap_path] = (
+                mel.rotomap.relate.load_relate_config(rotomap_path))
+        return self._relate_configs[rotomap_path]
@@ -5,6 +5,17 @@ import os
 import cv2
 import numpy
 
+import mel.lib.cache
+import mel.lib.fs
+
+
+# The width and height of the tiles that guess_mask() classifies as skin.
+_GUESS_MASK_TILE_SIZE = 10
+
+# The number of pixels to bin at once in tile_skin_distances(), to bound the
+# memory used.
+_GUESS_MASK_BAND_PIXELS = 4 * 1024 * 1024
+
 
 def path(mole_image_path):
     return mole_image_path + '.mask.png'
@@ -22,25 +33,107 @@ def load_or_none(mole_image_path):
     return None
 
 
+def save(mole_image_path, mask):
+    """Save the mask for an image, replacing any previous one atomically."""
+    is_ok, png = cv2.imencode('.png', mask)
+    if not is_ok:
+        raise ValueError(
+            'Could not encode mask for {}'.format(mole_image_path))
+    with mel.lib.fs.replacing_open(path(mole_image_path), 'wb') as f:
+        f.write(png.tobytes())
+
+
 def histogram_from_image_mask(image, mask):
     hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     skin_hist = calc_hist(hsv, mask)
     return skin_hist
 
 
-def yield_regions(*image_list, size=40):
-    """Yield (histogram, mask_average) regions from an image."""
-
-    width = image_list[0].shape[1]
-    height = image_list[0].shape[0]
-
-    for y in range(0, height, size):
-        for x in range(0, width, size):
-            frag_list = [
-                image[y:y + size, x:x + size]
-                for image in image_list
-            ]
-            yield tuple(frag_list)
+def histogram_from_image_mask_cached(cache, image_path):
+    """Return the histogram_from_image_mask() of an image file, from 'cache'.
+
+    The image and its mask are only loaded if the histogram isn't cached.
+
+    """
+    def compute():
+        return histogram_from_image_mask(
+            cv2.imread(image_path), load(image_path))
+
+    key = mel.lib.cache.make_key(
+        'mask.histogram_from_image_mask-1',
+        mel.lib.cache.file_digest(image_path),
+        mel.lib.cache.file_digest(path(image_path)))
+    return mel.lib.cache.cached(
+        cache,
+        key,
+        compute,
+        mel.lib.cache.encode_array,
+        mel.lib.cache.decode_array)
+
+
+def tile_view(image, size):
+    """Return a view of the image as a grid of square tiles, without copying.
+
+    Only whole tiles are included, any pixels along the right and bottom that
+    don't make up a whole tile are left out. The view is read-only, as it
+    shares memory with 'image'.
+
+    :image: an image with one or more channels, a 2d image is treated as
+            having one channel.
+    :size: the width and height of each tile in pixels.
+    :returns: a (rows, cols, size, size, channels) numpy.array.
+
+    Usage example:
+
+        >>> image = numpy.arange(5 * 4).reshape(5, 4)
+        >>> tiles = tile_view(image, 2)
+        >>> tiles.shape
+        (2, 2, 2, 2, 1)
+        >>> tiles[1, 0, :, :, 0]
+        array([[ 8,  9],
+               [12, 13]])
+
+    """
+    if image.ndim == 2:
+        image = image[:, :, numpy.newaxis]
+    height, width, channels = image.shape
+    row_stride, col_stride, channel_stride = image.strides
+    return numpy.lib.stride_tricks.as_strided(
+        image,
+        shape=(height // size, width // size, size, size, channels),
+        strides=(
+            row_stride * size,
+            col_stride * size,
+            row_stride,
+            col_stride,
+            channel_stride),
+        writeable=False)
+
+
+def tile_hists(tiles, width):
+    """Return the histogram of the hue of every tile, binning them at once.
+
+    calc_hist() makes a 2d histogram of hue against itself, so only the
+    diagonal is ever set. This returns that diagonal for each tile, as if from
+    calc_hist(tile, width=width).
+
+    :tiles: a (rows, cols, size, size, channels) array of HSV tiles, from
+            tile_view().
+    :width: the number of bins in each histogram.
+    :returns: a (rows, cols, width) numpy.array of float32 pixel counts.
+
+    """
+    rows, cols = tiles.shape[:2]
+    to_bin = (numpy.arange(256) * width // 256).astype(numpy.intp)
+    tile_bin_base = numpy.arange(cols).reshape(cols, 1, 1) * width
+
+    # Bin a row of tiles at a time, to limit the memory used for indices.
+    hists = numpy.empty((rows, cols, width), numpy.float32)
+    for row in range(rows):
+        indices = tile_bin_base + to_bin[tiles[row, :, :, :, 0]]
+        hists[row] = numpy.bincount(
+            indices.ravel(), minlength=cols * width).reshape(cols, width)
+    return hists
 
 
 def calc_hist(image, mask=None, width=8):
@@ -80,44 +173,104 @@ def shrunk_to_largest_region(mask):
     return mask
 
 
-def guess_mask(image, skin_hist):
-    width = image.shape[1]
-    height = image.shape[0]
-    stride = 10
-
-    mask = numpy.zeros((height, width, 1), numpy.uint8)
-
-    for y in range(0, height, stride):
-        for x in range(0, width, stride):
-            frag = image[y:y + stride, x:x + stride]
-            hsv = cv2.cvtColor(frag, cv2.COLOR_BGR2HSV)
-            hist = calc_hist(hsv)
-            distance = cv2.compareHist(hist, skin_hist, cv2.HISTCMP_HELLINGER)
-            is_skin_hist = distance <= 0.5
-            if is_skin_hist:
-                mask[y:y + stride, x:x + stride] = 255
+def guess_mask_cached(cache, image_path, skin_hist, image=None):
+    """Return guess_mask() for the image at 'image_path', from 'cache'.
 
-    # Pick only the biggest connected region - there may be other things in the
-    # image which have a similar colour profile. Assume that the biggest region
-    # is the area that we're interested in.
+    :cache: a mel.lib.cache.Cache, or None to not use one.
+    :image_path: the path of the image to guess the mask of.
+    :skin_hist: the histogram of skin to match, see guess_mask().
+    :image: the image if already loaded, otherwise it's only loaded if the
+            mask isn't in the cache.
+    :returns: the mask, as from guess_mask().
 
-    _, contours, _ = cv2.findContours(
-        mask.copy(),
-        cv2.RETR_LIST,
-        cv2.CHAIN_APPROX_NONE)
+    """
+    def compute():
+        return guess_mask(
+            image if image is not None else cv2.imread(image_path), skin_hist)
 
-    max_area = 0
-    max_index = None
-    for i, c in enumerate(contours):
-        if c is not None and len(c) > 5:
-            area = cv2.contourArea(c)
-            if max_index is None or area > max_area:
-                max_area = area
-                max_index = i
+    key = mel.lib.cache.make_key(
+        'mask.guess_mask-2',
+        mel.lib.cache.file_digest(image_path),
+        skin_hist)
+    return mel.lib.cache.cached(
+        cache,
+        key,
+        compute,
+        mel.lib.cache.encode_array,
+        mel.lib.cache.decode_array)
 
-    mask = numpy.zeros((height, width, 1), numpy.uint8)
-    if max_index is not None:
-        c = contours[max_index]
-        cv2.drawContours(mask, [c], -1, (255), -1)
 
-    return mask
+def guess_mask(image, skin_hist):
+    """Return a mask of the largest region of the image that looks like skin.
+
+    The image is divided into square tiles, a tile looks like skin if the
+    histogram of its hues is similar to 'skin_hist'. See tile_skin_distances().
+
+    :image: a BGR image to guess the mask of.
+    :skin_hist: a histogram of skin, from histogram_from_image_mask().
+    :returns: a mask image the same size as 'image', with a single channel.
+
+    """
+    height, width = image.shape[:2]
+    size = _GUESS_MASK_TILE_SIZE
+
+    is_skin = tile_skin_distances(image, skin_hist, size) <= 0.5
+    mask = numpy.repeat(numpy.repeat(is_skin, size, axis=0), size, axis=1)
+    mask = mask[:height, :width, numpy.newaxis].astype(numpy.uint8) * 255
+
+    return shrunk_to_largest_region(mask)
+
+
+def tile_skin_distances(image, skin_hist, size):
+    """Return an array of how unlike skin each square tile of the image is.
+
+    This gives the same results as calling cv2.compareHist() with
+    cv2.HISTCMP_HELLINGER on the calc_hist() of each tile, but converts and
+    bins the whole image at once. The tiles along the right and bottom may be
+    smaller than 'size'.
+
+    :image: a BGR image.
+    :skin_hist: a histogram of skin, from histogram_from_image_mask().
+    :size: the width and height of each tile in pixels.
+    :returns: a (rows, cols) numpy.array of distances from 0 to 1.
+
+    """
+    height, width = image.shape[:2]
+    rows = -(-height // size)
+    cols = -(-width // size)
+
+    # calc_hist() makes a 2d histogram of hue against itself, so only the
+    # diagonal is ever set. Work with the 1d hue histogram on the diagonal.
+    num_bins = skin_hist.shape[0]
+    skin_weights = numpy.sqrt(numpy.diagonal(skin_hist).astype(numpy.float64))
+    skin_total = float(numpy.sum(skin_hist))
+
+    hue = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)[:, :, 0]
+    to_bin = (numpy.arange(256) * num_bins // 256).astype(numpy.uint8)
+    bins = cv2.LUT(hue, to_bin)
+
+    # Count the pixels in each bin of each tile with bincount(), on views of
+    # a band of tile rows at a time to limit the memory used for indices.
+    col_bin_base = (numpy.arange(width) // size) * num_bins
+    band_rows = max(1, _GUESS_MASK_BAND_PIXELS // (width * size))
+    counts = numpy.empty((rows, cols, num_bins))
+    for row in range(0, rows, band_rows):
+        band = bins[row * size:(row + band_rows) * size]
+        band_tile_rows = -(-band.shape[0] // size)
+        row_bin_base = (numpy.arange(band.shape[0]) // size) * cols * num_bins
+        indices = (
+            row_bin_base[:, numpy.newaxis] +
+            col_bin_base[numpy.newaxis, :] +
+            band)
+        counts[row:row + band_tile_rows] = numpy.bincount(
+            indices.ravel(),
+            minlength=band_tile_rows * cols * num_bins).reshape(
+                band_tile_rows, cols, num_bins)
+
+    # This is the Hellinger distance as calculated by cv2.compareHist().
+    similarity = numpy.sqrt(counts).dot(skin_weights)
+    norm = counts.sum(axis=2) * skin_total
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        similarity = numpy.where(
+            norm > 0, similarity / numpy.sqrt(norm), similarity)
+    return numpy.sqrt(numpy.maximum(1 - similarity, 0))
@@ -0,0 +1,104 @@
+"""Test suite for mel.rotomap.mask."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] tile_skin_distances() agrees with cv2.compareHist() on each tile
+# [ B] tile_skin_distances() handles partial tiles at the edges
+# [ C] tile_view() exposes the whole tiles of an image without copying
+# [ D] tile_hists() agrees with the diagonal of calc_hist() on each tile
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_tile_skin_distances
+# [ C] test_c_tile_view
+# [ D] test_d_tile_hists
+# =============================================================================
+
+
+import unittest
+
+import cv2
+import numpy
+
+import mel.rotomap.mask
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        pass
+
+    def test_b_tile_skin_distances(self):
+        random_state = numpy.random.RandomState(0)
+        height, width, size = 45, 62, 10
+        image = random_state.randint(
+            0, 256, (height, width, 3)).astype(numpy.uint8)
+        image[10:30, 10:40] = (120, 150, 200)
+        mask = numpy.zeros((height, width), numpy.uint8)
+        mask[10:30, 10:40] = 255
+        skin_hist = mel.rotomap.mask.histogram_from_image_mask(image, mask)
+
+        # [ B] tile_skin_distances() agrees with cv2.compareHist() on each
+        # tile
+        # [ B] tile_skin_distances() handles partial tiles at the edges
+        distances = mel.rotomap.mask.tile_skin_distances(
+            image, skin_hist, size)
+        self.assertEqual((5, 7), distances.shape)
+        for row in range(5):
+            for col in range(7):
+                tile = image[
+                    row * size:(row + 1) * size,
+                    col * size:(col + 1) * size]
+                expected = cv2.compareHist(
+                    mel.rotomap.mask.calc_hist(
+                        cv2.cvtColor(tile, cv2.COLOR_BGR2HSV)),
+                    skin_hist,
+                    cv2.HISTCMP_HELLINGER)
+                self.assertAlmostEqual(expected, distances[row, col])
+
+    def test_c_tile_view(self):
+        image = numpy.arange(45 * 62 * 3).reshape(45, 62, 3)
+
+        # [ C] tile_view() exposes the whole tiles of an image without copying
+        tiles = mel.rotomap.mask.tile_view(image, 10)
+        self.assertEqual((4, 6, 10, 10, 3), tiles.shape)
+        self.assertTrue(numpy.shares_memory(image, tiles))
+        for row in range(4):
+            for col in range(6):
+                numpy.testing.assert_array_equal(
+                    image[row * 10:(row + 1) * 10, col * 10:(col + 1) * 10],
+                    tiles[row, col])
+
+        tiles = mel.rotomap.mask.tile_view(image[:, :, 0], 10)
+        self.assertEqual((4, 6, 10, 10, 1), tiles.shape)
+        numpy.testing.assert_array_equal(
+            image[10:20, 50:60, 0], tiles[1, 5, :, :, 0])
+
+    def test_d_tile_hists(self):
+        random_state = numpy.random.RandomState(0)
+        image = random_state.randint(0, 256, (45, 62, 3)).astype(numpy.uint8)
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        width = 32
+
+        # [ D] tile_hists() agrees with the diagonal of calc_hist() on each
+        # tile
+        hists = mel.rotomap.mask.tile_hists(
+            mel.rotomap.mask.tile_view(hsv, 10), width)
+        self.assertEqual((4, 6, width), hists.shape)
+        for row in range(4):
+            for col in range(6):
+                expected = mel.rotomap.mask.calc_hist(
+                    hsv[row * 10:(row + 1) * 10, col * 10:(col + 1) * 10],
+                    width=width)
+                numpy.testing.assert_array_equal(
+                    numpy.diagonal(expected), hists[row, col])
@@ -2,15 +2,52 @@
 
 
 import argparse
+import binascii
+import collections
 import json
 import math
 import os
+import re
+import time
 import uuid
 
 import cv2
 import numpy
 
+import mel.lib.cache
+import mel.lib.fs
 import mel.lib.math
+import mel.lib.spatial
+
+
+# The formats of image mole files, see save_image_moles(). A 'json' file is
+# named like 'image.jpg.json' and a 'binary' one like 'image.jpg.moles'.
+MOLE_FILE_FORMATS = ('json', 'binary')
+
+_MOLE_FILE_EXTENSIONS = {
+    'json': '.json',
+    'binary': '.moles',
+}
+
+# A 'binary' mole file is this magic, then an array of these records. The
+# uuids must be 32 lowercase hex digits, as made by add_mole(), to be stored
+# in 16 bytes.
+_BINARY_MOLES_MAGIC = b'MELMOLE1'
+_BINARY_MOLES_DTYPE = numpy.dtype([
+    ('x', '<i4'),
+    ('y', '<i4'),
+    ('flags', '<u4'),
+    ('uuid', 'V16'),
+])
+_BINARY_MOLES_FLAG_UUID_CANONICAL = 1
+_BINARY_MOLES_UUID_RE = re.compile('[0-9a-f]{32}')
+
+# The distance in pixels that a mole may be from where a homography maps it,
+# and still be used to find the homography. See mapped_points().
+_MAGIC_HOMOGRAPHY_ERROR = 100
+
+# The keys of a mole dict that MoleList and the 'binary' format store.
+_MOLE_LIST_KEYS = frozenset(('uuid', 'x', 'y', 'is_uuid_canonical'))
 
 
 class ArgparseRotomapDirectoryType():
@@ -22,27 +59,213 @@ class ArgparseRotomapDirectoryType():
         if not os.path.isdir(self.path):
             raise argparse.ArgumentTypeError(
                 '"{}" is not a directory, so not a rotomap.'.format(self.path))
-        files = os.listdir(self.path)
-        self.image_paths = [
-            os.path.join(self.path, f)
-            for f in files
-            if f.lower().endswith('.jpg')
-        ]
-        if not self.image_paths:
+
+        # Only look as far as the first image here, the full list is made when
+        # it's first needed.
+        if not any(is_rotomap_image_name(e.name) for e in os.scandir(path)):
             raise argparse.ArgumentTypeError(
                 '"{}" has no images, so not a rotomap.'.format(self.path))
 
+    @property
+    def image_paths(self):
+        """A sorted list of the paths of the images in the rotomap."""
+        return [
+            os.path.join(self.path, name)
+            for name in rotomap_image_names(self.path)
+        ]
+
     def yield_mole_lists(self):
         """Yield (image_path, mole_list) for all mole image files."""
         for imagepath in self.image_paths:
             yield imagepath, load_image_moles(imagepath)
 
+    def mole_index(self, cache=None):
+        """Return an up-to-date MoleIndex of the rotomap, see MoleIndex."""
+        return MoleIndex(self.path, cache)
+
+
+def is_rotomap_image_name(name):
+    return name.lower().endswith('.jpg')
+
+
+# A dict of absolute directory path to (mtime_ns, image names), see
+# rotomap_image_names().
+_ROTOMAP_IMAGE_NAMES_CACHE = {}
+
+# Some filesystems only record modification times to the nearest second or
+# two, so a directory may be changed again without its mtime changing. Don't
+# trust the cached names for directories modified more recently than this.
+_MTIME_RESOLUTION_SECONDS = 2
+
+
+def rotomap_image_names(rotomap_path):
+    """Return a sorted list of the names of the images in a rotomap directory.
+
+    The names are cached, and only listed again if the directory has been
+    modified since, so this may be called often. Recently modified directories
+    are always listed again, see _MTIME_RESOLUTION_SECONDS.
+
+    """
+    key = os.path.abspath(rotomap_path)
+    stat = os.stat(key)
+    mtime_ns = stat.st_mtime_ns
+    is_recent = time.time() - stat.st_mtime < _MTIME_RESOLUTION_SECONDS
+    cached = _ROTOMAP_IMAGE_NAMES_CACHE.get(key)
+    if cached is None or cached[0] != mtime_ns or is_recent:
+        names = sorted(
+            e.name for e in os.scandir(key) if is_rotomap_image_name(e.name))
+        cached = (mtime_ns, names)
+        _ROTOMAP_IMAGE_NAMES_CACHE[key] = cached
+    return list(cached[1])
+
+
+class MoleIndex():
+
+    """The moles of all the images in a rotomap directory, from one file.
+
+    Reading one index file is much quicker than reading the mole file of each
+    image, especially when searching many rotomaps for a uuid. If a
+    mel.lib.cache.Cache is supplied, the index is saved there. Nothing is
+    written to the rotomap directory. Without a cache, the mole file of each
+    image is read every time.
+
+    On construction, the index is brought up-to-date by checking the
+    modification time and size of each image's mole file. Only the mole files
+    that have changed are read, and the index is only saved if anything
+    changed. If the index can't be saved, e.g. the cache directory is
+    read-only, then it is still usable.
+
+    """
+
+    def __init__(self, rotomap_path, cache=None):
+        self.path = rotomap_path
+        self._cache = cache
+        self._images = {}
+        self._uuid_to_locations = collections.defaultdict(list)
+        self.refresh()
+
+    def refresh(self):
+        """Re-read any changed mole files, and save the index if changed."""
+        saved_images = self._load()
+
+        image_names = rotomap_image_names(self.path)
+
+        is_changed = set(saved_images) != set(image_names)
+        self._images = {}
+        for name in image_names:
+            image_path = os.path.join(self.path, name)
+            stamp = mole_file_stamp(image_path)
+            entry = saved_images.get(name)
+            if entry is None or entry['stamp'] != stamp:
+                entry = {
+                    'stamp': stamp,
+                    'moles': load_image_moles(image_path),
+                }
+                is_changed = True
+            self._images[name] = entry
+
+        self._uuid_to_locations = collections.defaultdict(list)
+        for name in image_names:
+            image_path = os.path.join(self.path, name)
+            for mole in self._images[name]['moles']:
+                self._uuid_to_locations[mole['uuid']].append(
+                    (image_path, mole['x'], mole['y']))
+
+        if is_changed:
+            self._save()
+
+    def image_moles(self, image_path):
+        """Return a new list of mole dicts for the image, as load_image_moles.
+
+        :image_path: the path of an image in the rotomap.
+        :returns: a list of mole dicts, which may be modified by the caller.
+
+        """
+        entry = self._images.get(os.path.basename(image_path))
+        if entry is None:
+            return load_image_moles(image_path)
+        return [dict(m) for m in entry['moles']]
+
+    def uuids(self):
+        """Return a set of the uuids of the moles in all the images."""
+        return set(self._uuid_to_locations)
+
+    def uuid_locations(self, mole_uuid):
+        """Return a list of (image_path, x, y) of the mole in sorted images."""
+        return list(self._uuid_to_locations.get(mole_uuid, ()))
+
+    def _cache_key(self):
+        # Include the version in the name, to change when the format does.
+        return mel.lib.cache.make_key(
+            'moles.MoleIndex-1', os.path.abspath(self.path))
+
+    def _load(self):
+        if self._cache is None:
+            return {}
+
+        try:
+            data = self._cache.get(self._cache_key())
+            if data is None:
+                return {}
+            return json.loads(data.decode())
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        if self._cache is None:
+            return
+
+        data = json.dumps(
+            self._images, separators=(',', ':'), sort_keys=True).encode()
+        try:
+            self._cache.put(self._cache_key(), data)
+        except OSError:
+            pass
+
+
+def mole_file_path(image_path, mole_format='json'):
+    """Return the path of the image's mole file in the specified format."""
+    return image_path + _MOLE_FILE_EXTENSIONS[mole_format]
+
+
+def mole_file_format(image_path):
+    """Return the format of the image's mole file, or None if there isn't one.
+
+    If there are files of both formats, then the 'json' one is used. This is
+    so that a file edited by hand, or updated with 'git', takes precedence.
+
+    """
+    for mole_format in MOLE_FILE_FORMATS:
+        if os.path.exists(mole_file_path(image_path, mole_format)):
+            return mole_format
+    return None
+
+
+def mole_file_stamp(image_path):
+    """Return [mtime_ns, size] of the image's mole file, or None if missing.
+
+    The stamp will change if the mole file is changed. It's a list so that it
+    compares equal to a stamp loaded from JSON.
+
+    """
+    mole_format = mole_file_format(image_path)
+    if mole_format is None:
+        return None
+    try:
+        stat = os.stat(mole_file_path(image_path, mole_format))
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
 
 def load_image_moles(image_path):
-    moles_path = image_path + '.json'
+    mole_format = mole_file_format(image_path)
+    if mole_format == 'binary':
+        return list(load_image_mole_list(image_path))
+
     moles = []
-    if os.path.exists(moles_path):
-        with open(moles_path) as moles_file:
+    if mole_format == 'json':
+        with open(mole_file_path(image_path)) as moles_file:
             moles = json.load(moles_file)
 
     for m in moles:
@@ -56,15 +279,204 @@ def load_image_moles(image_path):
     return moles
 
 
+def load_image_mole_list(image_path):
+    """Return a MoleList of the moles of an image, as load_image_moles()."""
+    mole_format = mole_file_format(image_path)
+    if mole_format == 'binary':
+        with open(mole_file_path(image_path, 'binary'), 'rb') as moles_file:
+            return binary_to_mole_list(moles_file.read())
+
+    moles = []
+    if mole_format == 'json':
+        with open(mole_file_path(image_path)) as moles_file:
+            moles = json.load(moles_file)
+    return MoleList(moles, normalise=True)
+
+
+def mole_list_to_binary(mole_list):
+    """Return the bytes of a 'binary' mole file for a MoleList.
+
+    Raise ValueError if the moles can't be stored in the format, because a
+    uuid is not 32 lowercase hex digits.
+
+    """
+    for mole_uuid in mole_list.uuids:
+        if not _BINARY_MOLES_UUID_RE.fullmatch(mole_uuid):
+            raise ValueError(
+                'Uuid not supported by binary format: {}'.format(mole_uuid))
+
+    records = numpy.zeros(len(mole_list), dtype=_BINARY_MOLES_DTYPE)
+    records['x'] = mole_list.points[:, 0]
+    records['y'] = mole_list.points[:, 1]
+    records['flags'] = numpy.where(
+        mole_list.is_uuid_canonical, _BINARY_MOLES_FLAG_UUID_CANONICAL, 0)
+    records['uuid'] = [binascii.unhexlify(u) for u in mole_list.uuids]
+    return _BINARY_MOLES_MAGIC + records.tobytes()
+
+
+def binary_to_mole_list(data):
+    """Return a MoleList from the bytes of a 'binary' mole file.
+
+    Usage example:
+
+        >>> moles = MoleList([{'uuid': '0' * 32, 'x': 1, 'y': 2}])
+        >>> list(binary_to_mole_list(mole_list_to_binary(moles))) == list(
+        ...     moles)
+        True
+
+    """
+    if not data.startswith(_BINARY_MOLES_MAGIC):
+        raise ValueError('Not a binary mole file.')
+    records = numpy.frombuffer(
+        data, dtype=_BINARY_MOLES_DTYPE, offset=len(_BINARY_MOLES_MAGIC))
+    return MoleList.from_arrays(
+        [binascii.hexlify(bytes(u)).decode() for u in records['uuid']],
+        numpy.column_stack([records['x'], records['y']]),
+        (records['flags'] & _BINARY_MOLES_FLAG_UUID_CANONICAL) != 0)
+
+
+class MoleList():
+
+    """A list of moles, stored as numpy arrays instead of as mole dicts.
+
+    The positions are in 'points', an (N, 2) numpy.array of int32. The uuids
+    are in 'uuids', and the 'is_uuid_canonical' flags in a bool array of the
+    same name, both in the same order. 'uuid_to_index' is a dict of uuid to
+    row, the last row if a uuid appears more than once.
+
+    Iterating or indexing gives new mole dicts, so a MoleList can be passed to
+    code that expects a list of mole dicts, if it doesn't modify them. Only
+    the keys above are stored, others like 'radius' are dropped. Code that
+    edits moles, like rotomap-edit, works with mole dicts instead.
+
+    Usage example:
+
+        >>> moles = MoleList([{'uuid': 'a', 'x': 1, 'y': 2}])
+        >>> moles.points
+        array([[1, 2]], dtype=int32)
+        >>> moles.uuid_to_index['a']
+        0
+        >>> list(moles) == [
+        ...     {'uuid': 'a', 'x': 1, 'y': 2, 'is_uuid_canonical': True}]
+        True
+
+    """
+
+    def __init__(self, moles=(), normalise=False):
+        """Make a MoleList from mole dicts.
+
+        :moles: an iterable of mole dicts.
+        :normalise: if True, truncate positions to integers as
+                    normalise_moles() does, otherwise raise ValueError if they
+                    are not integers.
+
+        """
+        moles = list(moles)
+
+        points = numpy.array(
+            [(m['x'], m['y']) for m in moles]).reshape(-1, 2)
+        if moles and not normalise:
+            if not numpy.issubdtype(points.dtype, numpy.integer):
+                raise ValueError(
+                    'Mole positions are not integers: {}'.format(points))
+        self.points = points.astype(numpy.int32)
+
+        self.uuids = numpy.array([m['uuid'] for m in moles], dtype=object)
+        self.is_uuid_canonical = numpy.array(
+            [m.get('is_uuid_canonical', True) for m in moles], dtype=bool)
+        self.uuid_to_index = {u: i for i, u in enumerate(self.uuids)}
+
+    @classmethod
+    def from_arrays(cls, uuids, points, is_uuid_canonical):
+        """Return a MoleList of moles from sequences of their attributes."""
+        mole_list = cls()
+        mole_list.points = numpy.array(points, dtype=numpy.int32).reshape(
+            -1, 2)
+        mole_list.uuids = numpy.array(uuids, dtype=object)
+        mole_list.is_uuid_canonical = numpy.array(
+            is_uuid_canonical, dtype=bool)
+        mole_list.uuid_to_index = {
+            u: i for i, u in enumerate(mole_list.uuids)}
+        return mole_list
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def __getitem__(self, index):
+        return {
+            'uuid': self.uuids[index],
+            'x': int(self.points[index, 0]),
+            'y': int(self.points[index, 1]),
+            'is_uuid_canonical': bool(self.is_uuid_canonical[index]),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_uuid_points(self):
+        """Return a dict of uuid to numpy.array point, as to_uuid_points()."""
+        return {u: self.points[i] for u, i in self.uuid_to_index.items()}
+
+
+def as_mole_list(moles):
+    """Return 'moles' as a MoleList, converting from mole dicts if needed."""
+    if isinstance(moles, MoleList):
+        return moles
+    return MoleList(moles)
+
+
 def normalise_moles(moles):
     for m in moles:
         m['x'] = int(m['x'])
         m['y'] = int(m['y'])
 
 
-def save_image_moles(moles, image_path):
-    moles_path = image_path + '.json'
-    with open(moles_path, 'w') as moles_file:
+def save_image_moles(moles, image_path, mole_format=None):
+    """Save the moles of an image, in the specified format.
+
+    :moles: a list of mole dicts, or a MoleList.
+    :image_path: the path of the image that the moles are in.
+    :mole_format: one of MOLE_FILE_FORMATS, or None to keep the format of the
+                  existing file. Raise ValueError if the moles can't be saved
+                  in the specified format. If None and the moles can't be
+                  saved in the existing format, then fall back to 'json'.
+
+    Any file of the other format is removed, after the new file is written.
+
+    """
+    if mole_format is None:
+        mole_format = mole_file_format(image_path)
+        if mole_format == 'binary':
+            try:
+                _save_image_moles_binary(moles, image_path)
+                return
+            except ValueError:
+                pass
+        mole_format = 'json'
+
+    if mole_format == 'binary':
+        _save_image_moles_binary(moles, image_path)
+    elif mole_format == 'json':
+        _save_image_moles_json(moles, image_path)
+    else:
+        raise ValueError('Unknown mole file format: {}'.format(mole_format))
+
+
+def _save_image_moles_binary(moles, image_path):
+    if not isinstance(moles, MoleList):
+        if any(not _MOLE_LIST_KEYS.issuperset(m) for m in moles):
+            raise ValueError('Mole keys not supported by binary format.')
+    data = mole_list_to_binary(as_mole_list(moles))
+    with mel.lib.fs.replacing_open(
+            mole_file_path(image_path, 'binary'), 'wb') as moles_file:
+        moles_file.write(data)
+    _remove_if_exists(mole_file_path(image_path, 'json'))
+
+
+def _save_image_moles_json(moles, image_path):
+    moles = list(moles)
+    with mel.lib.fs.replacing_open(mole_file_path(image_path)) as moles_file:
         json.dump(
             moles,
             moles_file,
@@ -75,6 +487,15 @@ def save_image_moles(moles, image_path):
         # There's no newline after dump(), add one here for happier viewing
         print(file=moles_file)
 
+    _remove_if_exists(mole_file_path(image_path, 'binary'))
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 
 def add_mole(moles, x, y, mole_uuid=None):
     is_uuid_canonical = True
@@ -90,32 +511,15 @@ def add_mole(moles, x, y, mole_uuid=None):
     })
 
 
-def sorted_by_distances(mole_list, x, y):
-
-    def sqdist(mole):
-        dist_x = x - mole['x']
-        dist_y = y - mole['y']
-        return (dist_x * dist_x) + (dist_y * dist_y)
-
-    return sorted(mole_list, key=sqdist)
-
-
 def nearest_mole_index(moles, x, y):
     return nearest_mole_index_distance(moles, x, y)[0]
 
 
 def nearest_mole_index_distance(moles, x, y):
-    nearest_index = None
-    nearest_distance = None
-    for i, mole in enumerate(moles):
-        dx = x - mole['x']
-        dy = y - mole['y']
-        distance = math.sqrt(dx * dx + dy * dy)
-        if nearest_distance is None or distance < nearest_distance:
-            nearest_index = i
-            nearest_distance = distance
-
-    return nearest_index, nearest_distance
+    nearest_index, distance_sq = to_point_grid(moles).nearest((x, y))
+    if nearest_index is None:
+        return None, None
+    return nearest_index, math.sqrt(distance_sq)
 
 
 def uuid_mole_index(moles, mole_uuid):
@@ -163,181 +567,252 @@ def mole_to_point(mole):
 
 
 def to_uuid_points(moles):
+    if isinstance(moles, MoleList):
+        return moles.to_uuid_points()
     uuid_points = {}
     for m in moles:
         uuid_points[m['uuid']] = mole_to_point(m)
     return uuid_points
 
 
-def set_molepos_to_nparray(mole, nparray):
-    mole['x'] = int(nparray[0])
-    mole['y'] = int(nparray[1])
-
-
-def is_value_in_range(value, lower, upper):
-    return value >= lower and value <= upper
+def to_point_grid(moles):
+    """Return a mel.lib.spatial.PointGrid of the positions of 'moles'.
 
+    The indices in the grid correspond to the indices in 'moles'. Build one of
+    these when making many nearest-mole queries against the same moles.
 
-def is_point_in_rect(point, rect):
-    return (
-        is_value_in_range(point[0], rect[0], rect[2]) and
-        is_value_in_range(point[1], rect[1], rect[3])
-    )
+    """
+    return mel.lib.spatial.PointGrid(as_mole_list(moles).points.tolist())
 
 
-def triangle_to_points(triangle):
-    return (
-        (triangle[0], triangle[1]),
-        (triangle[2], triangle[3]),
-        (triangle[4], triangle[5])
-    )
+def set_molepos_to_nparray(mole, nparray):
+    mole['x'] = int(nparray[0])
+    mole['y'] = int(nparray[1])
 
 
-def is_triangle_in_rect(triangle, rect):
-    return all(is_point_in_rect(p, rect) for p in triangle_to_points(triangle))
+class MoleTriangulation():
+
+    """A Delaunay triangulation of moles, for picking moles to map with.
+
+    Make one of these once for a list of moles, and then call
+    mapping_indices() for each point to map. Triangles with any vertices
+    outside 'image_rect' are ignored.
+
+    Usage example:
+
+        >>> moles = []
+        >>> add_mole(moles, 0, 0, 'a')
+        >>> add_mole(moles, 100, 0, 'b')
+        >>> add_mole(moles, 50, 90, 'c')
+        >>> triangulation = MoleTriangulation(moles, (0, 0, 200, 200))
+        >>> sorted(triangulation.mapping_indices((50, 30)))
+        [0, 1, 2]
+
+    """
+
+    def __init__(self, mole_list, image_rect):
+        """Make a triangulation of moles in an image.
+
+        :mole_list: a list of mole dicts.
+        :image_rect: the (0, 0, width, height) rectangle of the image.
+
+        """
+        self._mole_list = mole_list
+        self._point_grid = None
+        self._triangles = numpy.zeros((0, 3, 2))
+        self._triangle_indices = []
+        self._is_triangle_good = numpy.zeros(0, dtype=bool)
+
+        if len(mole_list) < 3:
+            return
+
+        subdiv = cv2.Subdiv2D(image_rect)
+        point_to_index = {}
+        for i, mole in enumerate(mole_list):
+            subdiv.insert((mole['x'], mole['y']))
+            point_to_index[(mole['x'], mole['y'])] = i
+
+        # Triangles include the virtual vertices that Subdiv2D adds outside
+        # the rectangle, filter them out.
+        triangles = numpy.array(
+            subdiv.getTriangleList(), dtype=numpy.float64).reshape(-1, 3, 2)
+        left, top, right, bottom = image_rect
+        is_in_rect = numpy.all(
+            (triangles[:, :, 0] >= left) & (triangles[:, :, 0] <= right) &
+            (triangles[:, :, 1] >= top) & (triangles[:, :, 1] <= bottom),
+            axis=1)
+        self._triangles = triangles[is_in_rect]
+        self._triangle_indices = [
+            tuple(point_to_index[tuple(p)] for p in triangle.tolist())
+            for triangle in self._triangles
+        ]
 
+        # Discard triangles that are not very equilateral, they seem to give
+        # bad mappings.
+        sides = numpy.linalg.norm(
+            self._triangles - numpy.roll(self._triangles, 1, axis=1), axis=2)
+        longest = sides.max(axis=1)
+        self._is_triangle_good = (longest > 0) & numpy.all(
+            sides > longest[:, numpy.newaxis] * 0.5, axis=1)
+
+    def __len__(self):
+        return len(self._mole_list)
+
+    def map_points(self, points, to_moles):
+        """Return a numpy.array of 'points' mapped to their place in to_moles.
+
+        Each point is mapped with the moles from mapping_indices(), see
+        mapped_points(). Points that are mapped with the same moles are mapped
+        together, so the transform for each triangle is only found once.
+
+        :points: an (N, 2) array-like of points to map.
+        :to_moles: a list of mole dicts, with a mole for each uuid in the
+                   triangulation.
+        :returns: an (N, 2) numpy.array of float points.
+
+        """
+        points = numpy.array(points, dtype=numpy.float64).reshape(-1, 2)
+
+        indices_to_rows = collections.defaultdict(list)
+        for row, point in enumerate(points):
+            indices_to_rows[self.mapping_indices(point)].append(row)
+
+        mapped = points.copy()
+        for indices, rows in indices_to_rows.items():
+            mapped[rows] = mapped_points(
+                points[rows],
+                [self._mole_list[i] for i in indices],
+                to_moles)
+        return mapped
+
+    def mapping_indices(self, point):
+        """Return a tuple of the indices of moles to use for mapping 'point'.
+
+        This is the triangle that 'point' is deepest inside, or nearest to. If
+        that triangle is not very equilateral, or there are fewer than three
+        moles, then it's the nearest two moles.
+
+        """
+        if len(self._mole_list) < 3:
+            return tuple(range(len(self._mole_list)))
+
+        if len(self._triangles):
+            best = numpy.argmax(
+                triangle_signed_distances(self._triangles, point))
+            if self._is_triangle_good[best]:
+                return self._triangle_indices[best]
 
-def get_mole_triangles(mole_list, image_rect):
-    subdiv = cv2.Subdiv2D(image_rect)
-    for mole in mole_list:
-        subdiv.insert((mole['x'], mole['y']))
+        # Two nearest moles to map with is better than none
+        if self._point_grid is None:
+            self._point_grid = to_point_grid(self._mole_list)
+        return tuple(i for i, _ in self._point_grid.k_nearest(point, 2))
 
-    # filter the list of triangles to those that only have points that fit in
-    # the rectangle
-    triangle_list = []
-    for triangle in subdiv.getTriangleList():
-        if is_triangle_in_rect(triangle, image_rect):
-            triangle_list.append(triangle)
 
-    return triangle_list
+def triangle_signed_distances(triangles, point):
+    """Return a numpy.array of the distance of 'point' to each triangle.
 
+    The distance is to the nearest edge, and is positive if the point is
+    inside the triangle. This is as cv2.pointPolygonTest() with 'measureDist'
+    true, for many triangles at once.
 
-def get_best_triangle_for_mapping(triangle_list, point):
-    best_triangle = None
-    best_result = None
-    for triangle in triangle_list:
-        # Ignore "Instance of 'tuple' has no 'astype' member (no-member)" from
-        # pylint.
-        # pylint: disable=no-member
-        #
-        # pointPolygonTest() will fail if we don't pass it values exactly like
-        # this.
-        contour = numpy.array(triangle_to_points(triangle)).astype('float32')
-        # pylint: enable=no-member
-        result = cv2.pointPolygonTest(contour, tuple(point), True)
-        if best_result is None or result > best_result:
-            best_result = result
-            best_triangle = triangle
+    Usage example:
 
-    return best_triangle
+        >>> triangle_signed_distances(
+        ...     numpy.array([[[0, 0], [10, 0], [0, 10]]]), (1, 2)).tolist()
+        [1.0]
 
+    """
+    point = numpy.asarray(point, dtype=numpy.float64)
+    starts = numpy.asarray(triangles, dtype=numpy.float64)
+    edges = numpy.roll(starts, -1, axis=1) - starts
+    to_point = point - starts
 
-def get_moles_from_points(mole_list, point_list):
-    output_moles = []
-    for point in point_list:
-        for mole in mole_list:
-            molepoint = mole_to_point(mole)
-            if numpy.allclose(point, molepoint):
-                output_moles.append(mole)
+    edge_lengths_sq = numpy.sum(edges * edges, axis=2)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t = numpy.sum(to_point * edges, axis=2) / edge_lengths_sq
+    t = numpy.clip(numpy.nan_to_num(t), 0, 1)
+    nearest = starts + t[:, :, numpy.newaxis] * edges
+    distances = numpy.linalg.norm(point - nearest, axis=2).min(axis=1)
 
-    if len(point_list) != len(output_moles):
-        raise ValueError('Not all points match moles: {}, {}'.format(
-            point_list, mole_list))
+    cross = (
+        edges[:, :, 0] * to_point[:, :, 1] -
+        edges[:, :, 1] * to_point[:, :, 0])
+    is_inside = numpy.all(cross >= 0, axis=1) | numpy.all(cross <= 0, axis=1)
 
-    return output_moles
+    return numpy.where(is_inside, distances, -distances)
 
 
-def get_best_moles_for_mapping(molepoint, mole_list, image_rect):
+def mapped_points(points, from_moles, to_moles):
+    """Return a numpy.array of 'points' mapped as 'from_moles' to 'to_moles'.
 
-    if len(mole_list) < 3:
-        if len(mole_list) == 0:
-            return None
-        else:
-            return mole_list
+    The kind of transform depends on the number of moles to map with. It's a
+    translation for one, a similarity transform for two, and an affine
+    transform for three. For four or more it's a homography, found with RANSAC
+    so that moles which don't fit are ignored.
 
-    triangle_list = get_mole_triangles(mole_list, image_rect)
-    best_triangle = get_best_triangle_for_mapping(triangle_list, molepoint)
+    :points: an (N, 2) array-like of points to map.
+    :from_moles: a list of mole dicts, to estimate the mapping from.
+    :to_moles: a list of mole dicts, with a mole for each uuid in from_moles.
+    :returns: an (N, 2) numpy.array of float points.
 
-    # Discard triangles that are not very equilateral, they seem to give bad
-    # mappings.
-    if best_triangle is not None:
-        points = triangle_to_points(best_triangle)
-        distances = [
-            mel.lib.math.distance_2d(points[i - 1], points[i])
-            for i in range(3)
-        ]
-        max_ = max(*distances)
-        if max_ == 0:
-            best_triangle = None
-        else:
-            norm_distances = [x / max_ for x in distances]
-            for x in norm_distances:
-                if x <= 0.5:
-                    best_triangle = None
-
-    moles_for_mapping = None
-    if best_triangle is not None:
-        moles_for_mapping = get_moles_from_points(
-            mole_list, triangle_to_points(best_triangle))
-    else:
-        # Two nearest moles to map with is better than none
-        return sorted_by_distances(
-            mole_list, molepoint[0], molepoint[1])[:2]
-
-    return moles_for_mapping
+    Usage example:
 
+        >>> from_moles = [{'uuid': 'a', 'x': 0, 'y': 0}]
+        >>> to_moles = [{'uuid': 'a', 'x': 1, 'y': 2}]
+        >>> mapped_points([[1, 1], [2, 2]], from_moles, to_moles).tolist()
+        [[2.0, 3.0], [3.0, 4.0]]
 
-def mapped_pos(molepos, from_moles, to_moles):
-    mel.lib.math.raise_if_not_int_vector2(molepos)
+    """
+    points = numpy.array(points, dtype=numpy.float64).reshape(-1, 2)
 
     if not from_moles:
-        return molepos
+        return points
 
     to_dict = {m['uuid']: m for m in to_moles}
-    from_pos_list = [mole_to_point(m) for m in from_moles]
-    to_pos_list = [mole_to_point(to_dict[m['uuid']]) for m in from_moles]
-
-    num_pairs = len(from_pos_list)
-
-    if num_pairs > 3:
-        # Ideally we'd handle 4 points by using cv2.getPerspectiveTransform()
-        # as in this article:
-        #
-        #     http://www.pyimagesearch.com/2014/08/25/4-point-opencv-getperspective-transform-example/
-        #
-        # We could take advantage of more than 4 points by using
-        # findHomography(), which can use various methods to deal with the
-        # ambiguity introduced by multiple points.
-        #
-        # In practice, trying to use more than 3 points proved difficult as
-        # naively including neighboring triangles resulted in adding co-linear
-        # points.
-        #
-        raise ValueError('Too many moles')
+    from_points = numpy.array(
+        [mole_to_point(m) for m in from_moles], dtype=numpy.float64)
+    to_points = numpy.array(
+        [mole_to_point(to_dict[m['uuid']]) for m in from_moles],
+        dtype=numpy.float64)
+
+    num_pairs = len(from_points)
+
+    if num_pairs >= 4:
+        homography, _ = cv2.findHomography(
+            from_points, to_points, cv2.RANSAC, _MAGIC_HOMOGRAPHY_ERROR)
+        if homography is not None:
+            return cv2.perspectiveTransform(
+                points[:, numpy.newaxis], homography)[:, 0]
+        # The moles may all be in a line, do the best we can with an affine
+        # transform instead.
+        return _least_squares_affine_points(points, from_points, to_points)
     elif num_pairs == 3:
         # The best we can do here is to determine the translation, rotation and
-        # scaling to apply in order to map from one triangle to the other. If
-        # we want this to be a perspective transformation then we'd need an
-        # additional point.
-        #
-        transform = numpy.matrix(cv2.getAffineTransform(
-            numpy.float32(from_pos_list),
-            numpy.float32(to_pos_list))).transpose()
-        pos = numpy.array([molepos[0], molepos[1], 1.0]) * transform
-        pos = numpy.array(pos)
-        molepos = pos[0]
-    elif num_pairs > 0:
+        # scaling to apply in order to map from one triangle to the other.
+        transform = cv2.getAffineTransform(
+            numpy.float32(from_points),
+            numpy.float32(to_points))
+        return cv2.transform(points[:, numpy.newaxis], transform)[:, 0]
+    elif num_pairs == 2 and not numpy.array_equal(*from_points):
+        # Assume a rotation, uniform scaling and translation. As complex
+        # numbers, that's multiplying by one number and adding another.
+        from_complex = from_points[:, 0] + 1j * from_points[:, 1]
+        to_complex = to_points[:, 0] + 1j * to_points[:, 1]
+        scale = (to_complex[1] - to_complex[0]) / (
+            from_complex[1] - from_complex[0])
+        mapped = (
+            (points[:, 0] + 1j * points[:, 1] - from_complex[0]) * scale +
+            to_complex[0])
+        return numpy.column_stack([mapped.real, mapped.imag])
+    else:
         # Here we'll just assume that the transformation is a translation and
         # compute it from the first pair of points.
-        translation = to_pos_list[0] - from_pos_list[0]
-        molepos += translation
-    # elif num_pairs > 2:
-        # In later work, to take advantage of 2 pairs of points, we'll handle
-        # it like so:
-        #
-        # Here we'll assume that the line through the supplied points is
-        # roughly perpendicular to the axis of rotation. This means that we'd
-        # expect the distance of the point from the line to be constant across
-        # the transformation.
-
-    return molepos
+        return points + (to_points[0] - from_points[0])
+
+
+def _least_squares_affine_points(points, from_points, to_points):
+    from_homogeneous = numpy.column_stack(
+        [from_points, numpy.ones(len(from_points))])
+    transform = numpy.linalg.lstsq(from_homogeneous, to_points, rcond=-1)[0]
+    return numpy.column_stack([points, numpy.ones(len(points))]).dot(
+        transform)
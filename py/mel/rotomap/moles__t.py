@@ -0,0 +1,270 @@
+"""Test suite for mel.rotomap.moles."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] MoleIndex finds the moles in each image, by image and by uuid
+# [ B] MoleIndex is saved to the cache, not the rotomap directory
+# [ B] MoleIndex picks up changed, added and removed images
+# [ B] MoleIndex ignores a corrupt index in the cache
+# [ B] MoleIndex works without a cache
+# [ C] MoleList round-trips mole dicts, dropping other keys
+# [ C] MoleList looks up moles by uuid
+# [ C] MoleList rejects non-integer positions unless normalising
+# [ D] Binary mole files are loaded like json ones, and saved in kind
+# [ D] Saving falls back to json if the moles can't be stored as binary
+# [ D] Saving as binary raises if the moles can't be stored so
+# [ D] Saving as binary raises if the moles have other keys
+# [ E] MoleTriangulation picks the enclosing triangle, or the nearest two
+# [ E] mapped_points() maps with the affine transform of a triangle
+# [ E] mapped_points() maps with similarity for 2 moles, homography for 4+
+# [ F] ArgparseRotomapDirectoryType rejects directories without images
+# [ F] Image paths are sorted, and pick up images added later
+# [ G] nearest_mole_index_distance() finds the nearest, earliest if tied
+# [ G] nearest_mole_index_distance() returns (None, None) if no moles
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_mole_index
+# [ C] test_c_mole_list
+# [ D] test_d_binary_mole_files
+# [ E] test_e_triangulation_mapping
+# [ F] test_f_rotomap_directory
+# [ G] test_g_nearest_mole
+# =============================================================================
+
+
+import argparse
+import os
+import tempfile
+import unittest
+
+import numpy
+
+import mel.lib.cache
+import mel.rotomap.moles
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        pass
+
+    def test_b_mole_index(self):
+        with tempfile.TemporaryDirectory() as rotomap_path, \
+                tempfile.TemporaryDirectory() as cache_path:
+            cache = mel.lib.cache.Cache(cache_path)
+            path_a = make_image(rotomap_path, 'a.jpg', [('x', 1, 2)])
+            path_b = make_image(rotomap_path, 'b.jpg', [('x', 3, 4)])
+            make_image(rotomap_path, 'c.jpg', None)
+            rotomap_files = sorted(os.listdir(rotomap_path))
+
+            # [ B] MoleIndex finds the moles in each image, by image and by
+            # uuid.
+            index = mel.rotomap.moles.MoleIndex(rotomap_path, cache)
+            self.assertEqual({'x'}, index.uuids())
+            self.assertEqual(
+                [(path_a, 1, 2), (path_b, 3, 4)],
+                index.uuid_locations('x'))
+            self.assertEqual(
+                mel.rotomap.moles.load_image_moles(path_a),
+                index.image_moles(path_a))
+            self.assertEqual([], index.uuid_locations('y'))
+
+            # [ B] MoleIndex is saved to the cache, not the rotomap directory
+            self.assertEqual(rotomap_files, sorted(os.listdir(rotomap_path)))
+            self.assertEqual(1, len(os.listdir(cache_path)))
+
+            # [ B] MoleIndex picks up changed, added and removed images
+            make_image(rotomap_path, 'b.jpg', [('y', 5, 6), ('y2', 7, 8)])
+            make_image(rotomap_path, 'd.jpg', [('z', 9, 10)])
+            os.remove(path_a)
+            os.remove(path_a + '.json')
+            index = mel.rotomap.moles.MoleIndex(rotomap_path, cache)
+            self.assertEqual({'y', 'y2', 'z'}, index.uuids())
+            self.assertEqual([(path_b, 5, 6)], index.uuid_locations('y'))
+
+            # [ B] MoleIndex ignores a corrupt index in the cache
+            for name in os.listdir(cache_path):
+                with open(os.path.join(cache_path, name), 'w') as f:
+                    f.write('{')
+            index = mel.rotomap.moles.MoleIndex(rotomap_path, cache)
+            self.assertEqual({'y', 'y2', 'z'}, index.uuids())
+
+            # [ B] MoleIndex works without a cache
+            index = mel.rotomap.moles.MoleIndex(rotomap_path)
+            self.assertEqual({'y', 'y2', 'z'}, index.uuids())
+
+    def test_c_mole_list(self):
+        moles = []
+        mel.rotomap.moles.add_mole(moles, 1, 2, 'a')
+        mel.rotomap.moles.add_mole(moles, 3, 4, 'b')
+        moles[1]['is_uuid_canonical'] = False
+
+        # [ C] MoleList round-trips mole dicts, dropping other keys
+        mole_list = mel.rotomap.moles.MoleList(moles)
+        self.assertEqual(2, len(mole_list))
+        self.assertEqual(moles, list(mole_list))
+        self.assertEqual(moles[1], mole_list[1])
+        extra_mole = dict(moles[1], radius=5)
+        self.assertEqual(
+            [moles[1]], list(mel.rotomap.moles.MoleList([extra_mole])))
+
+        # [ C] MoleList looks up moles by uuid
+        self.assertEqual(1, mole_list.uuid_to_index['b'])
+        self.assertEqual([3, 4], mole_list.points[1].tolist())
+        self.assertEqual(
+            [3, 4], mole_list.to_uuid_points()['b'].tolist())
+        self.assertEqual(0, len(mel.rotomap.moles.MoleList()))
+
+        # [ C] MoleList rejects non-integer positions unless normalising
+        moles[0]['x'] = 1.5
+        with self.assertRaises(ValueError):
+            mel.rotomap.moles.MoleList(moles)
+        mole_list = mel.rotomap.moles.MoleList(moles, normalise=True)
+        self.assertEqual([1, 2], mole_list.points[0].tolist())
+
+    def test_d_binary_mole_files(self):
+        with tempfile.TemporaryDirectory() as rotomap_path:
+            image_path = make_image(rotomap_path, 'a.jpg', [('x', 1, 2)])
+            moles = mel.rotomap.moles.load_image_moles(image_path)
+            mel.rotomap.moles.add_mole(moles, 3, 4)
+            binary_path = mel.rotomap.moles.mole_file_path(
+                image_path, 'binary')
+
+            # [ D] Saving as binary raises if the moles can't be stored so
+            with self.assertRaises(ValueError):
+                mel.rotomap.moles.save_image_moles(
+                    moles, image_path, 'binary')
+            moles[0]['uuid'] = 'f' * 32
+
+            # [ D] Saving as binary raises if the moles have other keys
+            moles[0]['radius'] = 5
+            with self.assertRaises(ValueError):
+                mel.rotomap.moles.save_image_moles(
+                    moles, image_path, 'binary')
+            del moles[0]['radius']
+
+            mel.rotomap.moles.save_image_moles(moles, image_path, 'binary')
+            self.assertFalse(os.path.exists(image_path + '.json'))
+            self.assertTrue(os.path.exists(binary_path))
+
+            # [ D] Binary mole files are loaded like json ones, and saved in
+            # kind
+            self.assertEqual(
+                moles, mel.rotomap.moles.load_image_moles(image_path))
+            self.assertEqual(
+                moles,
+                list(mel.rotomap.moles.load_image_mole_list(image_path)))
+            moles[1]['x'] = 5
+            mel.rotomap.moles.save_image_moles(moles, image_path)
+            self.assertEqual(
+                'binary', mel.rotomap.moles.mole_file_format(image_path))
+            self.assertEqual(
+                moles, mel.rotomap.moles.load_image_moles(image_path))
+
+            # [ D] Saving falls back to json if the moles can't be stored as
+            # binary
+            moles[1]['uuid'] = 'not hex'
+            mel.rotomap.moles.save_image_moles(moles, image_path)
+            self.assertEqual(
+                'json', mel.rotomap.moles.mole_file_format(image_path))
+            self.assertFalse(os.path.exists(binary_path))
+            self.assertEqual(
+                moles, mel.rotomap.moles.load_image_moles(image_path))
+
+    def test_e_triangulation_mapping(self):
+        moles = []
+        for uuid_, x, y in [
+                ('a', 0, 0), ('b', 100, 0), ('c', 50, 90), ('d', 300, 5)]:
+            mel.rotomap.moles.add_mole(moles, x, y, uuid_)
+        image_rect = (0, 0, 400, 400)
+
+        # [ E] MoleTriangulation picks the enclosing triangle, or the nearest
+        # two
+        triangulation = mel.rotomap.moles.MoleTriangulation(moles, image_rect)
+        self.assertEqual(
+            [0, 1, 2], sorted(triangulation.mapping_indices((50, 30))))
+        self.assertEqual(
+            [1, 3], sorted(triangulation.mapping_indices((250, 5))))
+        triangulation = mel.rotomap.moles.MoleTriangulation(
+            moles[:2], image_rect)
+        self.assertEqual((0, 1), triangulation.mapping_indices((50, 30)))
+
+        # [ E] mapped_points() maps with the affine transform of a triangle
+        to_moles = [
+            {'uuid': m['uuid'], 'x': m['x'] * 2, 'y': m['y'] + 10}
+            for m in moles
+        ]
+        self.assertEqual(
+            [[100.0, 40.0], [20.0, 30.0]],
+            mel.rotomap.moles.mapped_points(
+                [[50, 30], [10, 20]], moles[:3], to_moles).tolist())
+
+        # [ E] mapped_points() maps with similarity for 2 moles, homography
+        # for 4+
+        to_moles = [
+            {'uuid': m['uuid'], 'x': -m['y'], 'y': m['x']} for m in moles
+        ]
+        for from_moles in (moles[:2], moles):
+            self.assertTrue(
+                numpy.allclose(
+                    [[-30, 50], [-20, 10]],
+                    mel.rotomap.moles.mapped_points(
+                        [[50, 30], [10, 20]], from_moles, to_moles)))
+        triangulation = mel.rotomap.moles.MoleTriangulation(moles, image_rect)
+        self.assertTrue(
+            numpy.allclose(
+                [[-30, 50], [-5, 250]],
+                triangulation.map_points([[50, 30], [250, 5]], to_moles)))
+
+    def test_f_rotomap_directory(self):
+        with tempfile.TemporaryDirectory() as rotomap_path:
+            # [ F] ArgparseRotomapDirectoryType rejects directories without
+            # images
+            with self.assertRaises(argparse.ArgumentTypeError):
+                mel.rotomap.moles.ArgparseRotomapDirectoryType(rotomap_path)
+
+            # [ F] Image paths are sorted, and pick up images added later
+            path_b = make_image(rotomap_path, 'b.jpg', None)
+            rotomap = mel.rotomap.moles.ArgparseRotomapDirectoryType(
+                rotomap_path)
+            self.assertEqual([path_b], rotomap.image_paths)
+            path_a = make_image(rotomap_path, 'a.JPG', None)
+            self.assertEqual([path_a, path_b], rotomap.image_paths)
+
+    def test_g_nearest_mole(self):
+        moles = []
+        for uuid_, x, y in (('a', 0, 0), ('b', 10, 0), ('c', 0, 10)):
+            mel.rotomap.moles.add_mole(moles, x, y, uuid_)
+        nearest = mel.rotomap.moles.nearest_mole_index_distance
+
+        # [ G] nearest_mole_index_distance() finds the nearest, earliest if
+        # tied
+        self.assertEqual((1, 5.0), nearest(moles, 13, 4))
+        self.assertEqual((1, 10.0), nearest(moles, 10, 10))
+
+        # [ G] nearest_mole_index_distance() returns (None, None) if no moles
+        self.assertEqual((None, None), nearest([], 1, 1))
+
+
+def make_image(rotomap_path, name, mole_specs):
+    """Return the path of a fake image, with moles from (uuid, x, y)."""
+    image_path = os.path.join(rotomap_path, name)
+    with open(image_path, 'w'):
+        pass
+    if mole_specs is not None:
+        moles = []
+        for uuid_, x, y in mole_specs:
+            mel.rotomap.moles.add_mole(moles, x, y, uuid_)
+        mel.rotomap.moles.save_image_moles(moles, image_path)
+    return image_path
@@ -1,12 +1,16 @@
 """Relate rotomaps to eachother."""
 
-import copy
+import collections
+import configparser
+import math
+import os
 
 import cv2
 import numpy
 
 import mel.lib.debugrenderer
 import mel.lib.math
+import mel.lib.spatial
 import mel.rotomap.moles
 import mel.rotomap.tricolour
 
@@ -25,8 +29,9 @@ _DEBUG_RENDERER = mel.lib.debugrenderer.GlobalContext()
 # of rotomaps, where the image sizes are the same and the distance from the
 # camera is similar.
 #
-# In later work, we'll want to find a way of automatically determining the best
-# error value to use.
+# Use 'mel-debug tune-relate' to find the best error value to use for a
+# particular rotomap, it is saved in the RELATE_CONFIG_NAME file for that
+# rotomap and passed in as 'field_error'.
 #
 # Before pick_value_from_field(), the results for --reset-uuids 1 were:
 #     155 Flawed
@@ -49,6 +54,42 @@ _DEBUG_RENDERER = mel.lib.debugrenderer.GlobalContext()
 #
 _MAGIC_FIELD_ERROR = 300
 
+# The number of peaks in the histogram of pairwise offsets to consider, when
+# using the 'voting' engine for relating moles without any known pairs. The
+# true offset should be the largest peak, allow for a few others in case of
+# noise or unusual images. Compare with the 'exhaustive' engine using
+# 'mel-debug bench-relate --reset-all-uuids --baseless-engine voting'.
+_MAGIC_VOTING_PEAKS = 4
+
+# The choices of engine for relating moles without any known pairs.
+#
+#   'exhaustive' tries the offset between every pair of moles.
+#   'voting' only tries the offsets that are the most common.
+#
+BASELESS_ENGINES = ('exhaustive', 'voting')
+
+# The choices of engine for relating moles, given some known pairs.
+#
+#   'greedy' relates each mole in turn to the nearest predicted position.
+#   'assignment' relates all the moles at once, minimising the total distance
+#   from the predicted positions.
+#   'homography' is like 'assignment', but predicts positions with a
+#   perspective transform fitted to the known pairs, corrected by the offset
+#   field. This copes better with rotations and changes of viewpoint.
+#
+FIELD_ENGINES = ('greedy', 'assignment', 'homography')
+
+# The maximum distance in pixels between a known pair and the position
+# predicted by a homography, for the pair to count as an inlier when fitting it
+# with RANSAC. Moles are on a curved and flexible surface, so the fit will not
+# be exact, this allows for that whilst rejecting pairs from e.g. an arm that
+# has moved relative to the body.
+_MAGIC_HOMOGRAPHY_ERROR = 100
+
+# The name of the file in a rotomap directory that holds the parameters for
+# relating its images, as written by 'mel-debug tune-relate'.
+RELATE_CONFIG_NAME = 'relate.cfg'
+
 
 def draw_canonical_mole(image, x, y, colour):
     radius = 16
@@ -136,91 +177,218 @@ def mole_list_to_uuid_dict(mole_list):
     return {m['uuid']: m for m in mole_list}
 
 
-def apply_theory(theory, to_moles):
-    theory_to_original = {}
-    for mole in to_moles:
-        for from_, to in theory:
-            if from_ is not None and mole['uuid'] == to:
-                mole['uuid'] = from_
-                if from_ != to:
-                    theory_to_original[from_] = to
-    return theory_to_original
+def best_theory(
+        from_moles,
+        to_moles,
+        iterate,
+        baseless_engine='exhaustive',
+        field_engine='greedy',
+        field_error=None):
 
+    # Convert once here, rather than in each of the steps below.
+    from_moles = mel.rotomap.moles.as_mole_list(from_moles)
+    to_moles = mel.rotomap.moles.as_mole_list(to_moles)
 
-def reverse_theory(theory, theory_to_original):
-    new_theory = []
-    for from_, to in theory:
-        if to in theory_to_original:
-            new_theory.append((from_, theory_to_original[to]))
-        else:
-            new_theory.append((from_, to))
-    return new_theory
+    theory = best_offset_theory(
+        from_moles, to_moles, baseless_engine, field_engine, field_error)
 
-
-def best_theory(from_moles, to_moles, iterate):
-
-    if not iterate:
-        return best_offset_theory(from_moles, to_moles)
-
-    to_moles = copy.deepcopy(to_moles)
-
-    theory = None
-    done = False
-    theory_to_original = {}
-    while not done:
-        new_theory = reverse_theory(
-            best_offset_theory(from_moles, to_moles),
-            theory_to_original)
-        done = new_theory == theory
-        theory = new_theory
-        if not done:
-            theory_to_original.update(apply_theory(theory, to_moles))
+    if iterate:
+        theory = iterate_offset_field_theory(
+            from_moles, to_moles, theory, field_engine, field_error)
 
     return theory
 
 
-def best_offset_theory(from_moles, to_moles):
+def best_offset_theory(
+        from_moles,
+        to_moles,
+        baseless_engine='exhaustive',
+        field_engine='greedy',
+        field_error=None):
     if not from_moles:
         raise ValueError('from_moles is empty')
     if not to_moles:
         raise ValueError('to_moles is empty')
+    if baseless_engine not in BASELESS_ENGINES:
+        raise ValueError(
+            'Unknown baseless engine: {}'.format(baseless_engine))
+    if field_engine not in FIELD_ENGINES:
+        raise ValueError('Unknown field engine: {}'.format(field_engine))
+
+    from_moles = mel.rotomap.moles.as_mole_list(from_moles)
+    to_moles = mel.rotomap.moles.as_mole_list(to_moles)
 
-    theory = best_offset_field_theory(from_moles, to_moles)
+    theory = best_offset_field_theory(
+        from_moles, to_moles, field_engine, field_error)
     if theory is None:
-        theory = best_baseless_offset_theory(from_moles, to_moles)
+        if baseless_engine == 'voting':
+            theory = best_voted_baseless_offset_theory(from_moles, to_moles)
+        else:
+            theory = best_baseless_offset_theory(from_moles, to_moles)
     return theory
 
 
-def best_offset_field_theory(from_moles, to_moles):
+def best_offset_field_theory(
+        from_moles, to_moles, field_engine='greedy', field_error=None):
     from_points, to_points, point_offsets, theory = offset_theory_points(
         from_moles, to_moles)
 
     if not point_offsets:
         return None
 
+    return make_field_engine_theory(
+        from_points,
+        to_points,
+        point_offsets,
+        theory,
+        field_engine,
+        field_error)
+
+
+def iterate_offset_field_theory(
+        from_moles, to_moles, theory, field_engine='greedy', field_error=None):
+    """Return 'theory' extended by relating moles with the pairs it relates.
+
+    Repeatedly relate the unrelated moles, using the offset field from all of
+    the pairs related so far, until no more pairs are related. Only the newly
+    related pairs are added to the field each time, and only the moles that
+    are still unrelated are considered.
+
+    :from_moles: a list of mole dicts, or a MoleList, to map from.
+    :to_moles: a list of mole dicts, or a MoleList, to map to.
+    :theory: a list of (from_uuid, to_uuid) from best_offset_theory().
+    :returns: a new list of (from_uuid, to_uuid), like 'theory'.
+
+    """
+    related = [(f, t) for f, t in theory if f is not None and t is not None]
+    if not related:
+        return theory
+
+    from_moles = mel.rotomap.moles.as_mole_list(from_moles)
+    to_moles = mel.rotomap.moles.as_mole_list(to_moles)
+    from_uuid_points = from_moles.to_uuid_points()
+    to_uuid_points = to_moles.to_uuid_points()
+
+    known_theory = []
+    point_offsets = []
+    while related:
+        known_theory.extend(related)
+        point_offsets.extend(
+            mole_list_point_offsets(from_moles, to_moles, related))
+        for from_uuid, to_uuid in related:
+            del from_uuid_points[from_uuid]
+            del to_uuid_points[to_uuid]
+
+        new_theory = make_field_engine_theory(
+            from_uuid_points,
+            to_uuid_points,
+            point_offsets,
+            [],
+            field_engine,
+            field_error)
+
+        related = [
+            (f, t) for f, t in new_theory if f is not None and t is not None
+        ]
+
+    return known_theory + new_theory
+
+
+def make_field_engine_theory(
+        from_uuid_points,
+        to_uuid_points,
+        point_offsets,
+        theory,
+        field_engine,
+        field_error):
+    """Return 'theory' extended by the 'field_engine', see FIELD_ENGINES."""
+    if field_error is None:
+        field_error = _MAGIC_FIELD_ERROR
+
+    if field_engine == 'assignment':
+        return make_offset_field_assignment_theory(
+            from_uuid_points,
+            to_uuid_points,
+            point_offsets,
+            theory,
+            field_error)
+    elif field_engine == 'homography':
+        return make_homography_theory(
+            from_uuid_points,
+            to_uuid_points,
+            point_offsets,
+            theory,
+            field_error)
+
     return make_offset_field_theory(
-        from_points, to_points, point_offsets, theory)
+        from_uuid_points, to_uuid_points, point_offsets, theory, field_error)
+
+
+def load_relate_config(rotomap_path):
+    """Return a dict of keyword arguments for best_theory() for a rotomap.
+
+    :rotomap_path: the path of the rotomap directory.
+    :returns: a dict with any of 'field_error' and 'field_engine', which is
+              empty if there is no RELATE_CONFIG_NAME file in the directory.
+
+    """
+    config = configparser.ConfigParser()
+    config.read(os.path.join(rotomap_path, RELATE_CONFIG_NAME))
+    if not config.has_section('relate'):
+        return {}
+
+    section = config['relate']
+    relate_config = {}
+    if 'field_error' in section:
+        relate_config['field_error'] = section.getint('field_error')
+    if 'field_engine' in section:
+        field_engine = section['field_engine']
+        if field_engine not in FIELD_ENGINES:
+            raise ValueError(
+                'Unknown field engine: {}'.format(field_engine))
+        relate_config['field_engine'] = field_engine
+
+    return relate_config
+
+
+def save_relate_config(rotomap_path, relate_config):
+    """Save a dict from load_relate_config() for a rotomap."""
+    config = configparser.ConfigParser()
+    config['relate'] = {
+        key: str(value) for key, value in relate_config.items()
+    }
+    with open(os.path.join(rotomap_path, RELATE_CONFIG_NAME), 'w') as f:
+        config.write(f)
 
 
 def offset_theory_points(from_moles, to_moles):
     """Return (from_points, to_points, point_offsets, theory) from input.
 
-    :from_moles: a list of mole dicts to map from
-    :to_moles: a list of mole dicts to map to
+    :from_moles: a list of mole dicts, or a MoleList, to map from
+    :to_moles: a list of mole dicts, or a MoleList, to map to
     :returns: (from_uuid_points, to_uuid_points, point_offsets)
 
     """
-    from_dict, to_dict, from_set, to_set, in_both = mole_list_overlap_info(
-        from_moles, to_moles)
+    from_moles = mel.rotomap.moles.as_mole_list(from_moles)
+    to_moles = mel.rotomap.moles.as_mole_list(to_moles)
 
-    theory = []
-    theory.extend((u, u) for u in in_both)
-    point_offsets = to_point_offsets(
-        [(from_dict[m], to_dict[m]) for m in in_both])
-    new_from_moles = [from_dict[m] for m in from_set - in_both]
-    new_to_moles = [to_dict[m] for m in to_set - in_both]
-    from_uuid_points = mel.rotomap.moles.to_uuid_points(new_from_moles)
-    to_uuid_points = mel.rotomap.moles.to_uuid_points(new_to_moles)
+    in_both = [
+        u for u in from_moles.uuid_to_index if u in to_moles.uuid_to_index
+    ]
+    theory = [(u, u) for u in in_both]
+    point_offsets = mole_list_point_offsets(from_moles, to_moles, theory)
+
+    in_both = set(in_both)
+    from_uuid_points = {
+        u: from_moles.points[i]
+        for u, i in from_moles.uuid_to_index.items()
+        if u not in in_both
+    }
+    to_uuid_points = {
+        u: to_moles.points[i]
+        for u, i in to_moles.uuid_to_index.items()
+        if u not in in_both
+    }
 
     return from_uuid_points, to_uuid_points, point_offsets, theory
 
@@ -234,69 +402,98 @@ def mole_list_overlap_info(from_moles, to_moles):
     return from_dict, to_dict, from_set, to_set, in_both
 
 
-def guess_mole_pos(from_uuid, from_moles, to_moles):
-    """Return a numpy.array position guessing the location of uuid_, or None.
+def mole_list_point_offsets(from_moles, to_moles, uuid_pairs):
+    """Return a list of (point, offset) from pairs of moles.
 
-    :from_uuid: string uuid of the mole to guess the position of in to_moles.
-    :from_moles: a list of mole dicts to map from.
-    :to_moles: a list of mole dicts to map to.
-    :returns: a numpy.array of the guessed position, or None if no guess.
+    :from_moles: a MoleList to map from.
+    :to_moles: a MoleList to map to.
+    :uuid_pairs: a list of (from_uuid, to_uuid) of moles in the lists.
+    :returns: a list of (from_point, to_point - from_point) numpy.arrays.
 
     """
-    from_points, to_points, point_offsets, _ = offset_theory_points(
-        from_moles, to_moles)
+    from_points = from_moles.points[
+        [from_moles.uuid_to_index[f] for f, _ in uuid_pairs]]
+    to_points = to_moles.points[
+        [to_moles.uuid_to_index[t] for _, t in uuid_pairs]]
+    return list(zip(from_points, to_points - from_points))
 
-    if not point_offsets:
-        return None
 
-    if from_uuid not in from_points:
-        return None
+def point_offsets_to_arrays(point_offsets):
+    """Return (points, offsets) numpy.arrays from a list of (point, offset).
 
-    point = from_points[from_uuid]
-    offset, error = pick_value_from_field(point, point_offsets)
-    return (point + offset).astype(int)
+    This is the form that pick_values_from_field() expects its field in.
 
+    """
+    points = numpy.array([p for p, _ in point_offsets])
+    offsets = numpy.array([o for _, o in point_offsets])
+    return points, offsets
 
-def to_point_offsets(mole_pairs):
-    point_offsets = []
-    for from_mole, to_mole in mole_pairs:
-        from_pos = mel.rotomap.moles.mole_to_point(from_mole)
-        to_pos = mel.rotomap.moles.mole_to_point(to_mole)
-        point_offsets.append((from_pos, to_pos - from_pos))
-    return point_offsets
+
+def sample_uuid_points_from_field(uuid_points, field_points, field_values):
+    """Return a dict of uuid to (value, error) sampled at each point.
+
+    :uuid_points: a dict of uuid to numpy.array 2d point.
+    :field_points: an (M, 2) numpy.array of the points in the field.
+    :field_values: an (M, V) numpy.array of the values at those points.
+    :returns: a dict of uuid to (value, error), as pick_value_from_field().
+
+    """
+    if not uuid_points:
+        return {}
+
+    uuids = list(uuid_points.keys())
+    points = numpy.array([uuid_points[u] for u in uuids])
+    values, errors = pick_values_from_field(points, field_points, field_values)
+    return {u: (values[i], errors[i]) for i, u in enumerate(uuids)}
 
 
 def make_offset_field_theory(
-        from_uuid_points, to_uuid_points, point_offsets, theory):
+        from_uuid_points,
+        to_uuid_points,
+        point_offsets,
+        theory,
+        field_error=_MAGIC_FIELD_ERROR):
+
+    field_points, field_offsets = point_offsets_to_arrays(point_offsets)
+
+    # Sample the field for all the points up-front, as doing it in one go is
+    # much cheaper than doing it once per mole inside the loop.
+    from_uuid_offsets = sample_uuid_points_from_field(
+        from_uuid_points, field_points, field_offsets)
+    to_uuid_inv_offsets = sample_uuid_points_from_field(
+        to_uuid_points, field_points + field_offsets, -field_offsets)
+
+    from_uuids, from_grid = uuid_points_to_grid(from_uuid_points)
+    to_uuids, to_grid = uuid_points_to_grid(to_uuid_points)
 
     to_uuid_points = dict(to_uuid_points)
-    inv_point_offsets = invert_point_offsets(point_offsets)
     for uuid_, point in from_uuid_points.items():
         if not to_uuid_points:
             theory.append((uuid_, None))
             continue
 
-        offset, error = pick_value_from_field(point, point_offsets)
-        to_uuid, distance = nearest_uuid_point(point + offset, to_uuid_points)
+        offset, error = from_uuid_offsets[uuid_]
+        to_index, distance_sq = to_grid.nearest(point + offset)
+        to_uuid = to_uuids[to_index]
+        distance = math.sqrt(distance_sq)
 
         # Note that an attempt to lerp between _MAGIC_FIELD_ERROR and 'error'
         # based on len(point_offsets) has been tried. If the lerp saturates at
         # len(point_offsets)==25, then it seems to perform better in one image
         # out of hundreds. Otherwise _MAGIC_FIELD_ERROR is still best.
 
-        if distance < _MAGIC_FIELD_ERROR:
+        if distance < field_error:
 
             # Make sure that the closest match for the 'to' mole is also the
             # 'from' mole.
             to_point = to_uuid_points[to_uuid]
-            inv_offset, inv_error = pick_value_from_field(
-                to_point, inv_point_offsets)
-            from_uuid, from_distance = nearest_uuid_point(
-                to_point + inv_offset, from_uuid_points)
+            inv_offset, inv_error = to_uuid_inv_offsets[to_uuid]
+            from_index, _ = from_grid.nearest(to_point + inv_offset)
 
-            if from_uuid == uuid_:
+            if from_uuids[from_index] == uuid_:
                 theory.append((uuid_, to_uuid))
                 del to_uuid_points[to_uuid]
+                to_grid.remove(to_index)
             else:
                 _DEBUG_RENDERER.arrow(to_point, to_point + inv_offset)
                 _DEBUG_RENDERER.circle(to_point + inv_offset, inv_error)
@@ -312,23 +509,249 @@ def make_offset_field_theory(
     return theory
 
 
-def invert_point_offsets(point_offsets):
-    return [
-        (point + offset, -offset)
-        for point, offset in point_offsets
-    ]
+def make_offset_field_assignment_theory(
+        from_uuid_points,
+        to_uuid_points,
+        point_offsets,
+        theory,
+        field_error=_MAGIC_FIELD_ERROR):
+    """Return 'theory' extended by relating moles with optimal assignment.
+
+    This is an alternative to make_offset_field_theory(), which takes the same
+    parameters. Instead of relating each 'from' mole in turn, relate them all
+    at once. The total distance between the positions predicted by the offset
+    field and the related 'to' moles is minimised. This means that the result
+    does not depend on the order of the moles.
+
+    Moles are only related if the distance is less than 'field_error'.
+
+    """
+    field_points, field_offsets = point_offsets_to_arrays(point_offsets)
+
+    def predict_points(from_points):
+        offsets, errors = pick_values_from_field(
+            from_points, field_points, field_offsets)
+        return from_points + offsets, errors
+
+    return make_assignment_theory(
+        from_uuid_points, to_uuid_points, predict_points, theory, field_error)
+
+
+def make_homography_theory(
+        from_uuid_points,
+        to_uuid_points,
+        point_offsets,
+        theory,
+        field_error=_MAGIC_FIELD_ERROR):
+    """Return 'theory' extended by relating moles with a fitted homography.
+
+    This is an alternative to make_offset_field_assignment_theory(), which
+    takes the same parameters. Instead of assuming that moles near each other
+    move by the same offset, fit a perspective transform to the known pairs
+    with RANSAC. The offset field of what the transform gets wrong for the
+    known pairs is then added, to allow for the surface not being flat.
 
+    If there are fewer than four known pairs, or no transform can be found,
+    then fall back to make_offset_field_assignment_theory().
 
-def nearest_uuid_point(point, uuid_points):
-    nearest_sqdist = None
-    nearest_uuid = None
-    for uuid_, q in uuid_points.items():
-        offset = q - point
-        sqdist = numpy.dot(offset, offset)
-        if nearest_sqdist is None or sqdist < nearest_sqdist:
-            nearest_sqdist = sqdist
-            nearest_uuid = uuid_
-    return nearest_uuid, numpy.sqrt(nearest_sqdist)
+    """
+    field_points, field_offsets = point_offsets_to_arrays(point_offsets)
+    field_to_points = field_points + field_offsets
+
+    homography = None
+    if len(field_points) >= 4:
+        homography, _ = cv2.findHomography(
+            numpy.float32(field_points),
+            numpy.float32(field_to_points),
+            cv2.RANSAC,
+            _MAGIC_HOMOGRAPHY_ERROR)
+
+    if homography is None:
+        return make_offset_field_assignment_theory(
+            from_uuid_points,
+            to_uuid_points,
+            point_offsets,
+            theory,
+            field_error)
+
+    field_residuals = field_to_points - transform_points(
+        field_points, homography)
+
+    def predict_points(from_points):
+        residuals, errors = pick_values_from_field(
+            from_points, field_points, field_residuals)
+        return transform_points(from_points, homography) + residuals, errors
+
+    return make_assignment_theory(
+        from_uuid_points, to_uuid_points, predict_points, theory, field_error)
+
+
+def transform_points(points, homography):
+    """Return a numpy.array of 'points' transformed by the 3x3 'homography'.
+
+    Usage example:
+
+        >>> transform_points(
+        ...     numpy.array([[1, 2], [3, 4]]),
+        ...     numpy.array([[2, 0, 1], [0, 2, 0], [0, 0, 1]])).tolist()
+        [[3.0, 4.0], [7.0, 8.0]]
+
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    return cv2.perspectiveTransform(
+        points.reshape(-1, 1, 2),
+        numpy.asarray(homography, dtype=numpy.float64)).reshape(-1, 2)
+
+
+def make_assignment_theory(
+        from_uuid_points, to_uuid_points, predict_points, theory, field_error):
+    """Return 'theory' extended by relating predicted moles optimally.
+
+    The total distance between the predicted positions of the 'from' moles and
+    the related 'to' moles is minimised, only relating moles if the distance
+    is less than 'field_error'. Moles can only affect each other's relations
+    through chains of moles within that distance, so each such group is solved
+    separately, see candidate_groups().
+
+    :from_uuid_points: a dict of uuid to numpy.array 2d point to map from.
+    :to_uuid_points: a dict of uuid to numpy.array 2d point to map to.
+    :predict_points: a function taking a numpy.array of 'from' points, which
+                     returns (predicted_points, errors) numpy.arrays. The
+                     errors are only used for debug rendering.
+    :theory: a list of (from_uuid, to_uuid) to extend.
+    :field_error: the distance in pixels within which moles may be related.
+    :returns: 'theory'.
+
+    """
+    from_uuids = list(from_uuid_points.keys())
+    to_uuids = list(to_uuid_points.keys())
+
+    from_to_index = {}
+    if from_uuids and to_uuids:
+        from_points = numpy.array([from_uuid_points[u] for u in from_uuids])
+        to_points = numpy.array([to_uuid_points[u] for u in to_uuids])
+
+        predicted_points, errors = predict_points(from_points)
+
+        # Only find the distances to moles that are near enough to relate.
+        to_grid = mel.lib.spatial.PointGrid(to_points)
+        field_error_sq = field_error * field_error
+        distances = [{} for _ in from_uuids]
+        for from_index, point in enumerate(predicted_points.tolist()):
+            for to_index, dist_sq in to_grid.within_radius(point, field_error):
+                if dist_sq < field_error_sq:
+                    distances[from_index][to_index] = math.sqrt(dist_sq)
+
+        for group_from, group_to in candidate_groups(distances):
+            if not group_to:
+                continue
+
+            # Most groups on sparse maps are a single 'from' mole, which is
+            # best related to the nearest candidate.
+            if len(group_from) == 1:
+                from_index = group_from[0]
+                from_to_index[from_index] = min(
+                    group_to, key=distances[from_index].get)
+                continue
+
+            # Give each 'from' mole the option of being unrelated, at the cost
+            # of 'field_error'. Relating it to a mole that is nearer than that
+            # will then be cheaper. Make forbidden options so costly that it
+            # is cheaper to leave every mole unrelated.
+            num_from = len(group_from)
+            num_to = len(group_to)
+            forbidden_cost = field_error * (num_from + 1)
+            costs = numpy.full(
+                (num_from, num_to + num_from), forbidden_cost, dtype=float)
+            costs[:, num_to:][numpy.diag_indices(num_from)] = field_error
+            to_to_col = {to: col for col, to in enumerate(group_to)}
+            for row, from_index in enumerate(group_from):
+                for to_index, distance in distances[from_index].items():
+                    costs[row, to_to_col[to_index]] = distance
+
+            rows, cols = mel.lib.math.linear_sum_assignment(costs)
+            for row, col in zip(rows, cols):
+                if col < num_to and costs[row, col] < field_error:
+                    from_to_index[group_from[row]] = group_to[col]
+
+        for from_index in range(len(from_uuids)):
+            if from_index not in from_to_index:
+                _DEBUG_RENDERER.arrow(
+                    from_points[from_index], predicted_points[from_index])
+                _DEBUG_RENDERER.circle(
+                    predicted_points[from_index], errors[from_index])
+
+    for from_index, uuid_ in enumerate(from_uuids):
+        to_index = from_to_index.get(from_index)
+        if to_index is None:
+            theory.append((uuid_, None))
+        else:
+            theory.append((uuid_, to_uuids[to_index]))
+
+    related_to_indices = set(from_to_index.values())
+    for to_index, uuid_ in enumerate(to_uuids):
+        if to_index not in related_to_indices:
+            theory.append((None, uuid_))
+
+    return theory
+
+
+def candidate_groups(candidates):
+    """Return a list of (from_indices, to_indices) of connected candidates.
+
+    'from' and 'to' indices are in the same group if they are candidates to be
+    related, directly or through other candidates. Groups are ordered by their
+    first 'from' index, and the indices in each group are sorted. 'from'
+    indices without candidates are in groups of their own.
+
+    Usage example:
+
+        >>> candidate_groups([[0], [1, 0], [], [2]])
+        [([0, 1], [0, 1]), ([2], []), ([3], [2])]
+
+    :candidates: a list with an iterable of 'to' indices for each 'from'
+                 index, e.g. dicts keyed by 'to' index.
+    :returns: a list of tuples of lists, (from_indices, to_indices).
+
+    """
+    from_parent = list(range(len(candidates)))
+
+    def find_root(from_index):
+        while from_parent[from_index] != from_index:
+            from_parent[from_index] = from_parent[from_parent[from_index]]
+            from_index = from_parent[from_index]
+        return from_index
+
+    to_owner = {}
+    for from_index, to_indices in enumerate(candidates):
+        for to_index in to_indices:
+            owner = to_owner.setdefault(to_index, from_index)
+            if owner == from_index:
+                continue
+            root, owner_root = find_root(from_index), find_root(owner)
+            if root != owner_root:
+                from_parent[max(root, owner_root)] = min(root, owner_root)
+
+    root_to_group = collections.OrderedDict()
+    for from_index in range(len(candidates)):
+        root = find_root(from_index)
+        root_to_group.setdefault(root, ([], []))[0].append(from_index)
+    for to_index, owner in sorted(to_owner.items()):
+        root_to_group[find_root(owner)][1].append(to_index)
+
+    return list(root_to_group.values())
+
+
+def uuid_points_to_grid(uuid_points):
+    """Return (uuid_list, grid) for a dict of uuid to numpy.array 2d point.
+
+    The indices in the mel.lib.spatial.PointGrid correspond to the uuids in
+    the returned list.
+
+    """
+    uuids = list(uuid_points.keys())
+    grid = mel.lib.spatial.PointGrid([uuid_points[u] for u in uuids])
+    return uuids, grid
 
 
 def pick_value_from_field(point, point_values):
@@ -356,128 +779,389 @@ def pick_value_from_field(point, point_values):
 
     """
 
-    # Note that the idea of passing in 'points' and 'values' as separate
-    # variables, already as numpy.arrays has been tried. This was in order to
-    # avoid the array -> numpy.array listcomp conversions happening inside a
-    # loop. It turns out that there is no noticable difference in speed, and it
-    # slightly complicated all the existing client code. May as well leave
-    # as-is.
+    points = numpy.array([q for q, _ in point_values])
+    values = numpy.array([v for _, v in point_values])
+    picked_values, picked_errors = pick_values_from_field(
+        numpy.array([point]), points, values)
+    return picked_values[0], picked_errors[0]
+
+
+def pick_values_from_field(points, field_points, field_values):
+    """Return (values, errors) sampled from the field at each of 'points'.
+
+    This is the batched form of pick_value_from_field(), the field is supplied
+    as separate numpy.arrays of points and values so that they only need to be
+    built once, and all the supplied 'points' are sampled in one go.
+
+    Usage example:
+
+        Sample two points from a field with a single point in it, expect the
+        supplied value with certainty.
+
+        >>> values, errors = pick_values_from_field(
+        ...     numpy.array([[0, 0], [10, 10]]),
+        ...     numpy.array([[0, 0]]),
+        ...     numpy.array([[1, 2]]))
+        >>> values.tolist(), errors.tolist()
+        ([[1.0, 2.0], [1.0, 2.0]], [0.0, 0.0])
 
-    offsets = numpy.array([q - point for q, v in point_values])
-    sq_distances = numpy.sum(offsets * offsets, axis=1)
+    :points: an (N, 2) numpy.array of 2d points to take samples from.
+    :field_points: an (M, 2) numpy.array of the points in the field.
+    :field_values: an (M, V) numpy.array of the values at those points.
+    :returns: a tuple, (sampled_values, estimated_errors), of shapes (N, V)
+              and (N,) respectively.
+
+    """
+    offsets = field_points[numpy.newaxis, :, :] - points[:, numpy.newaxis, :]
+    sq_distances = numpy.sum(offsets * offsets, axis=2)
 
     sqweights = 1.0 / (sq_distances + 1)
-    sqweights /= numpy.sum(sqweights)
+    sqweights /= numpy.sum(sqweights, axis=1)[:, numpy.newaxis]
 
-    values = numpy.array([x[1] for x in point_values])
-    picked_value = numpy.dot(values.T, sqweights)
+    picked_values = numpy.dot(sqweights, field_values)
 
     # Note that inverse-distance instead of inverse-square-distance for
     # calculating error has been tried. This did not improve results as
     # measured by 'mel-debug bench-relate'. Also tried inverse-log10-distance,
     # and 'equal weights'.
 
-    value_errors = numpy.linalg.norm(values - picked_value, axis=1)
-    picked_error = numpy.dot(value_errors.T, sqweights)
+    value_errors = numpy.linalg.norm(
+        field_values[numpy.newaxis, :, :] - picked_values[:, numpy.newaxis, :],
+        axis=2)
+    picked_errors = numpy.sum(value_errors * sqweights, axis=1)
 
-    return picked_value, picked_error
+    return picked_values, picked_errors
 
 
 def best_baseless_offset_theory(from_moles, to_moles):
+    """Return the best theory from the offset between every pair of moles.
+
+    :from_moles: a MoleList to map from.
+    :to_moles: a MoleList to map to.
+
+    """
+    offsets = pairwise_offsets(from_moles, to_moles)
+    return best_offset_theory_from_candidates(
+        from_moles, to_moles, offsets.tolist())
+
+
+def pairwise_offsets(from_moles, to_moles):
+    """Return an (N * M, 2) numpy.array of the offsets from each to each.
+
+    The offsets are ordered by 'from' mole, then by 'to' mole.
+
+    """
+    from_points = from_moles.points.astype(numpy.int64)
+    to_points = to_moles.points.astype(numpy.int64)
+    return (
+        to_points[numpy.newaxis, :, :] - from_points[:, numpy.newaxis, :]
+    ).reshape(-1, 2)
+
+
+def best_voted_baseless_offset_theory(from_moles, to_moles):
+    """Return the best theory from only the most common pairwise offsets.
 
-    cutoff_sq = mole_min_sq_distance(to_moles)
+    This is a faster alternative to best_baseless_offset_theory(). Instead of
+    trying the offset between every pair of moles, bin all the offsets into a
+    coarse histogram and only try the offsets in the most popular bins.
+
+    The offsets are tried in the same order as best_baseless_offset_theory(),
+    so if the best offset is in one of the popular bins then the result is
+    the same.
+
+    """
+    offsets = pairwise_offsets(from_moles, to_moles)
+
+    # Moles matched by an offset must be nearer than the closest 'to' moles
+    # are to each other, so make the bins that size.
+    to_points = to_moles.points.tolist()
+    cutoff_sq = mole_min_sq_distance(
+        to_points, mel.lib.spatial.PointGrid(to_points))
+    bin_size = 1
+    if cutoff_sq:
+        bin_size = max(int(math.sqrt(cutoff_sq)), 1)
+
+    offset_bins = numpy.floor_divide(offsets, bin_size)
+    candidates = offset_bins_near_peaks(offset_bins, _MAGIC_VOTING_PEAKS)
+
+    return best_offset_theory_from_candidates(
+        from_moles, to_moles, offsets[candidates].tolist())
+
+
+def offset_bins_near_peaks(offset_bins, num_peaks):
+    """Return a bool array of which offset_bins are near the popular ones.
+
+    Votes for each bin are counted from the bin and its eight neighbours, so
+    that offsets near the edge of a bin are not split from their cluster.
+
+    :offset_bins: an (N, 2) numpy.array of integer 2d bin co-ordinates.
+    :num_peaks: the number of the most voted-for bins to consider.
+    :returns: an (N,) numpy.array of bool, True where the bin is the same as,
+              or a neighbour of, one of the most voted-for bins.
+
+    """
+    # Encode each bin as a single integer, so we can look up neighbours with
+    # numpy.searchsorted(). Leave a margin so neighbours also encode uniquely.
+    offset_bins = offset_bins - offset_bins.min(axis=0) + 1
+    stride = offset_bins[:, 1].max() + 2
+
+    def encode(bins):
+        return bins[:, 0] * stride + bins[:, 1]
+
+    unique_bins, bin_counts = numpy.unique(
+        offset_bins, axis=0, return_counts=True)
+    codes = encode(unique_bins)
+
+    neighbours = [(x, y) for x in (-1, 0, 1) for y in (-1, 0, 1)]
+
+    votes = numpy.zeros(len(unique_bins), dtype=int)
+    for neighbour in neighbours:
+        neighbour_codes = encode(unique_bins + neighbour)
+        indices = numpy.searchsorted(codes, neighbour_codes)
+        indices = numpy.minimum(indices, len(codes) - 1)
+        is_found = codes[indices] == neighbour_codes
+        votes[is_found] += bin_counts[indices[is_found]]
+
+    peak_bins = unique_bins[numpy.argsort(-votes, kind='stable')[:num_peaks]]
+
+    near_peak_codes = numpy.unique(numpy.concatenate([
+        encode(peak_bins + neighbour) for neighbour in neighbours
+    ]))
+
+    return numpy.isin(encode(offset_bins), near_peak_codes)
+
+
+def best_offset_theory_from_candidates(from_moles, to_moles, offsets):
+    """Return the best theory from make_offset_theory() for supplied offsets.
+
+    The best theory has the fewest entries, i.e. the most moles related. Ties
+    are broken by the smallest sum of squared distances between related moles,
+    and then by the smallest offset. If still tied, the earliest wins.
+
+    :from_moles: a MoleList to map from.
+    :to_moles: a MoleList to map to.
+    :offsets: an iterable of (x, y) offsets to try.
+    :returns: the best theory, or None if no offsets were supplied.
+
+    """
+    # Convert to Python lists once, they're much quicker to work with one
+    # element at a time than numpy arrays.
+    from_uuids = from_moles.uuids.tolist()
+    from_points = from_moles.points.tolist()
+    to_uuids = to_moles.uuids.tolist()
+    to_points = to_moles.points.tolist()
+
+    from_grid = mel.lib.spatial.PointGrid(from_points)
+    to_grid = mel.lib.spatial.PointGrid(to_points)
+
+    cutoff_sq = mole_min_sq_distance(to_points, to_grid)
     if cutoff_sq is None:
         cutoff_sq = 0
 
     best_theory = None
     best_theory_dist_sq = None
     best_theory_offset_dist_sq = None
-    for source in from_moles:
-        for dest in to_moles:
-            to_x = dest['x'] - source['x']
-            to_y = dest['y'] - source['y']
-            offset_dist_sq = to_x * to_x + to_y * to_y
-
-            theory, dist_sq = make_offset_theory(
-                from_moles, to_moles, (to_x, to_y), cutoff_sq)
-
-            new_best = best_theory is None
-            if not new_best and len(theory) < len(best_theory):
+    for to_x, to_y in offsets:
+        offset_dist_sq = to_x * to_x + to_y * to_y
+
+        theory, dist_sq = make_offset_theory(
+            from_uuids,
+            from_points,
+            to_uuids,
+            to_points,
+            (to_x, to_y),
+            cutoff_sq,
+            from_grid,
+            to_grid)
+
+        new_best = best_theory is None
+        if not new_best and len(theory) < len(best_theory):
+            new_best = True
+        if not new_best and len(theory) == len(best_theory):
+            if dist_sq < best_theory_dist_sq:
                 new_best = True
-            if not new_best and len(theory) == len(best_theory):
-                if dist_sq < best_theory_dist_sq:
+            if not new_best and dist_sq == best_theory_dist_sq:
+                if offset_dist_sq < best_theory_offset_dist_sq:
                     new_best = True
-                if not new_best and dist_sq == best_theory_dist_sq:
-                    if offset_dist_sq < best_theory_offset_dist_sq:
-                        new_best = True
 
-            if new_best:
-                best_theory = theory
-                best_theory_dist_sq = dist_sq
-                best_theory_offset_dist_sq = offset_dist_sq
+        if new_best:
+            best_theory = theory
+            best_theory_dist_sq = dist_sq
+            best_theory_offset_dist_sq = offset_dist_sq
 
     return best_theory
 
 
-def mole_min_sq_distance(moles):
+def mole_min_sq_distance(points, grid):
+    """Return the smallest squared distance between any two points, or None.
+
+    :points: a list of (x, y) mole positions.
+    :grid: a mel.lib.spatial.PointGrid of the points.
+
+    """
     min_dist = None
-    for i, a in enumerate(moles):
-        for j, b in enumerate(moles):
-            if j == i:
-                continue
-            dist = _mole_distance_sq(a, b)
-            if min_dist is None or dist < min_dist:
-                min_dist = dist
+    for point in points:
+        # The nearest will be 'point' itself, so look at the second nearest.
+        nearest = grid.k_nearest(point, 2)
+        if len(nearest) < 2:
+            continue
+        dist = nearest[1][1]
+        if min_dist is None or dist < min_dist:
+            min_dist = dist
     return min_dist
 
 
-def make_offset_theory(from_moles, to_moles_in, offset, cutoff_sq):
-    to_moles = list(to_moles_in)
-    offset = numpy.array(offset)
+def make_offset_theory(
+        from_uuids,
+        from_points,
+        to_uuids,
+        to_points,
+        offset,
+        cutoff_sq,
+        from_grid,
+        to_grid):
+    """Return (theory, dist_sq_sum) for mapping moles by a simple offset.
+
+    The moles are supplied as lists, e.g. from MoleList.uuids.tolist() and
+    MoleList.points.tolist(), as this is called for many offsets.
+
+    :from_uuids: a list of the uuids of the moles to map from.
+    :from_points: a list of (x, y) of the moles to map from.
+    :to_uuids: a list of the uuids of the moles to map to.
+    :to_points: a list of (x, y) of the moles to map to.
+    :offset: an (x, y) offset to apply to from_points to map to to_points.
+    :cutoff_sq: the maximum squared distance for moles to be related.
+    :from_grid: a mel.lib.spatial.PointGrid of from_points.
+    :to_grid: a mel.lib.spatial.PointGrid of to_points, this is not modified.
+    :returns: (theory, dist_sq_sum)
+
+    """
+    to_grid = to_grid.copy()
+    offset_x, offset_y = offset
 
     theory = []
 
     dist_sq_sum = 0
 
-    for i, a in enumerate(from_moles):
-        point = mel.rotomap.moles.mole_to_point(a)
-        point += offset
-        best_index, best_dist_sq = _nearest_mole_index_to_point(
-            point, to_moles)
+    for i, (x, y) in enumerate(from_points):
+        best_index, best_dist_sq = to_grid.nearest(
+            (x + offset_x, y + offset_y))
         if best_index is not None and best_dist_sq <= cutoff_sq:
-            r_point = mel.rotomap.moles.mole_to_point(
-                to_moles[best_index])
-            r_point -= offset
-            r_index, _ = _nearest_mole_index_to_point(r_point, from_moles)
+            to_x, to_y = to_points[best_index]
+            r_index, _ = from_grid.nearest((to_x - offset_x, to_y - offset_y))
             if i == r_index:
-                theory.append((a['uuid'], to_moles[best_index]['uuid']))
-                del to_moles[best_index]
+                theory.append((from_uuids[i], to_uuids[best_index]))
+                to_grid.remove(best_index)
                 dist_sq_sum += best_dist_sq
             else:
-                theory.append((a['uuid'], None))
+                theory.append((from_uuids[i], None))
         else:
-            theory.append((a['uuid'], None))
+            theory.append((from_uuids[i], None))
 
-    for b in to_moles:
-        theory.append((None, b['uuid']))
+    for j, to_uuid in enumerate(to_uuids):
+        if j in to_grid:
+            theory.append((None, to_uuid))
 
     return theory, dist_sq_sum
 
 
-def _nearest_mole_index_to_point(point, mole_list):
-    best_index = None
-    best_dist_sq = None
-    for i, mole in enumerate(mole_list):
-        dist_sq = mel.lib.math.distance_sq_2d(
-            point,
-            mel.rotomap.moles.mole_to_point(mole))
-        if best_index is None or dist_sq < best_dist_sq:
-            best_index = i
-            best_dist_sq = dist_sq
-    return best_index, best_dist_sq
+class MoleTracks():
+
+    """Merge related moles from many images into tracks of the same mole.
+
+    Each mole in each image starts in a track of its own, moles are then
+    merged into the same track using union-find. Moles in different images
+    with the same uuid are merged on construction.
 
+    Merges that would result in an inconsistent track are refused. A track
+    may not contain more than one mole from the same image, or more than one
+    canonical uuid. Moles are canonical unless 'is_uuid_canonical' is False.
+
+    """
 
-def _mole_distance_sq(from_mole, to_mole):
-    return mel.lib.math.distance_sq_2d(
-        mel.rotomap.moles.mole_to_point(from_mole),
-        mel.rotomap.moles.mole_to_point(to_mole))
+    def __init__(self, mole_lists):
+        self._parent = {}
+        self._size = {}
+        self._images = {}
+        self._canonical_uuid = {}
+        self._num_images = len(mole_lists)
+
+        uuid_to_nodes = collections.defaultdict(list)
+        for image_index, moles in enumerate(mole_lists):
+            for m in moles:
+                node = (image_index, m['uuid'])
+                if node in self._parent:
+                    continue
+                self._parent[node] = node
+                self._size[node] = 1
+                self._images[node] = {image_index}
+                self._canonical_uuid[node] = None
+                if m.get('is_uuid_canonical', True):
+                    self._canonical_uuid[node] = m['uuid']
+                uuid_to_nodes[m['uuid']].append(node)
+
+        for nodes in uuid_to_nodes.values():
+            for node in nodes[1:]:
+                self.merge(nodes[0], node)
+
+    def merge(self, node_a, node_b):
+        """Merge the tracks of the supplied nodes, return False on conflict.
+
+        :node_a: an (image_index, uuid) tuple identifying a mole.
+        :node_b: an (image_index, uuid) tuple identifying a mole.
+        :returns: True if the nodes are now in the same track.
+
+        """
+        root_a = self._find(node_a)
+        root_b = self._find(node_b)
+        if root_a == root_b:
+            return True
+
+        if self._images[root_a] & self._images[root_b]:
+            return False
+
+        canonical_a = self._canonical_uuid[root_a]
+        canonical_b = self._canonical_uuid[root_b]
+        if canonical_a and canonical_b and canonical_a != canonical_b:
+            return False
+
+        if self._size[root_a] < self._size[root_b]:
+            root_a, root_b = root_b, root_a
+
+        self._parent[root_b] = root_a
+        self._size[root_a] += self._size.pop(root_b)
+        self._images[root_a] |= self._images.pop(root_b)
+        self._canonical_uuid[root_a] = canonical_a or canonical_b
+        del self._canonical_uuid[root_b]
+        return True
+
+    def uuid_remaps(self):
+        """Return a list of {from_uuid: to_uuid} dicts, one per image.
+
+        Each track takes its canonical uuid if it has one, otherwise the uuid
+        from the earliest image in the track. Moles that keep their uuid are
+        not included.
+
+        """
+        root_to_uuid = {}
+        for node in sorted(self._parent):
+            root = self._find(node)
+            if root not in root_to_uuid:
+                canonical_uuid = self._canonical_uuid[root]
+                root_to_uuid[root] = canonical_uuid or node[1]
+
+        remaps = [{} for _ in range(self._num_images)]
+        for node in self._parent:
+            image_index, uuid_ = node
+            new_uuid = root_to_uuid[self._find(node)]
+            if new_uuid != uuid_:
+                remaps[image_index][uuid_] = new_uuid
+        return remaps
+
+    def _find(self, node):
+        root = node
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[node] != root:
+            self._parent[node], node = root, self._parent[node]
+        return root
@@ -13,6 +13,7 @@
 # =============================================================================
 
 
+import tempfile
 import unittest
 
 import numpy
@@ -39,3 +40,223 @@ class Test(unittest.TestCase):
 
         self.assertEqual(0.0, error)
         self.assertTrue(([1.0, 2.0] == value).all(), True)
+
+    def test_c_pick_values_from_field(self):
+
+        field_points = numpy.array([[0, 0], [100, 0], [0, 100]])
+        field_values = numpy.array([[1, 2], [3, 4], [5, 6]])
+        points = numpy.array([[0, 0], [50, 50], [-10, 200]])
+
+        values, errors = mel.rotomap.relate.pick_values_from_field(
+            points, field_points, field_values)
+
+        self.assertEqual((3, 2), values.shape)
+        self.assertEqual((3,), errors.shape)
+
+        # The batched version should agree with sampling one at a time.
+        point_values = list(zip(field_points, field_values))
+        for point, value, error in zip(points, values, errors):
+            expected_value, expected_error = (
+                mel.rotomap.relate.pick_value_from_field(point, point_values))
+            self.assertTrue(numpy.allclose(expected_value, value))
+            self.assertAlmostEqual(expected_error, error)
+
+    def test_d_baseless_engines(self):
+
+        from_moles = [
+            make_mole('a', 0, 0),
+            make_mole('b', 100, 20),
+            make_mole('c', 40, 130),
+            make_mole('d', 200, 200),
+        ]
+
+        # Translate all but 'd', which is replaced by 'e' elsewhere.
+        to_moles = [
+            make_mole('A', 50, 31),
+            make_mole('B', 150, 50),
+            make_mole('C', 91, 160),
+            make_mole('E', 400, 0),
+        ]
+
+        expected = {
+            ('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', None), (None, 'E')}
+
+        for engine in mel.rotomap.relate.BASELESS_ENGINES:
+            theory = mel.rotomap.relate.best_offset_theory(
+                from_moles, to_moles, engine)
+            self.assertEqual(expected, set(theory), engine)
+
+        with self.assertRaises(ValueError):
+            mel.rotomap.relate.best_offset_theory(
+                from_moles, to_moles, 'unknown')
+
+    def test_e_field_assignment_engine(self):
+
+        from_moles = [
+            make_mole('known', 0, 0),
+            make_mole('a', 100, 0),
+            make_mole('b', 140, 0),
+            make_mole('c', 1000, 1000),
+        ]
+
+        # The field says everything moves right by 20. 'c' has no match.
+        to_moles = [
+            make_mole('known', 20, 0),
+            make_mole('B', 160, 0),
+            make_mole('A', 120, 0),
+        ]
+
+        expected = {
+            ('known', 'known'), ('a', 'A'), ('b', 'B'), ('c', None)}
+
+        # The result should not depend on the order of the moles.
+        for _ in range(2):
+            theory = mel.rotomap.relate.best_theory(
+                from_moles, to_moles, iterate=False, field_engine='assignment')
+            self.assertEqual(expected, set(theory))
+            from_moles.reverse()
+            to_moles.reverse()
+
+    def test_f_mole_tracks(self):
+
+        mole_lists = [
+            [make_mole('a', 0, 0), make_mole('b', 0, 0)],
+            [make_mole('x', 0, 0, False), make_mole('y', 0, 0, False)],
+            [make_mole('z', 0, 0, False), make_mole('b', 0, 0)],
+        ]
+
+        tracks = mel.rotomap.relate.MoleTracks(mole_lists)
+
+        # 'x' and 'z' join 'a', via 'x'.
+        self.assertTrue(tracks.merge((0, 'a'), (1, 'x')))
+        self.assertTrue(tracks.merge((1, 'x'), (2, 'z')))
+
+        # Conflict, 'y' can't join 'a' as 'x' is from the same image.
+        self.assertFalse(tracks.merge((0, 'a'), (1, 'y')))
+
+        # Conflict, 'z' can't join 'b' as it would have two canonical uuids.
+        self.assertFalse(tracks.merge((2, 'z'), (0, 'b')))
+
+        self.assertEqual(
+            [{}, {'x': 'a'}, {'z': 'a'}],
+            tracks.uuid_remaps())
+
+    def test_g_field_error(self):
+
+        from_moles = [make_mole('known', 0, 0), make_mole('a', 100, 0)]
+        to_moles = [make_mole('known', 20, 0), make_mole('A', 130, 0)]
+
+        # 'A' is 10 pixels from where the field predicts 'a' to be.
+        for field_engine in mel.rotomap.relate.FIELD_ENGINES:
+            theory = mel.rotomap.relate.best_theory(
+                from_moles,
+                to_moles,
+                iterate=False,
+                field_engine=field_engine,
+                field_error=20)
+            self.assertIn(('a', 'A'), theory)
+
+            theory = mel.rotomap.relate.best_theory(
+                from_moles,
+                to_moles,
+                iterate=False,
+                field_engine=field_engine,
+                field_error=5)
+            self.assertIn(('a', None), theory)
+            self.assertIn((None, 'A'), theory)
+
+    def test_h_relate_config(self):
+
+        with tempfile.TemporaryDirectory() as rotomap_path:
+            self.assertEqual(
+                {}, mel.rotomap.relate.load_relate_config(rotomap_path))
+
+            relate_config = {'field_error': 250, 'field_engine': 'assignment'}
+            mel.rotomap.relate.save_relate_config(rotomap_path, relate_config)
+            self.assertEqual(
+                relate_config,
+                mel.rotomap.relate.load_relate_config(rotomap_path))
+
+    def test_i_iterate(self):
+
+        # Each mole is further from where the field predicts, until the mole
+        # before it is related.
+        from_moles = [
+            make_mole('known', 0, 0),
+            make_mole('a', 100, 0),
+            make_mole('b', 250, 0),
+        ]
+        to_moles = [
+            make_mole('known', 0, 0),
+            make_mole('A', 130, 0),
+            make_mole('B', 310, 0),
+        ]
+
+        for field_engine in mel.rotomap.relate.FIELD_ENGINES:
+            theory = mel.rotomap.relate.best_theory(
+                from_moles,
+                to_moles,
+                iterate=False,
+                field_engine=field_engine,
+                field_error=50)
+            self.assertEqual(
+                {('known', 'known'), ('a', 'A'), ('b', None), (None, 'B')},
+                set(theory))
+
+            theory = mel.rotomap.relate.best_theory(
+                from_moles,
+                to_moles,
+                iterate=True,
+                field_engine=field_engine,
+                field_error=50)
+            self.assertEqual(
+                {('known', 'known'), ('a', 'A'), ('b', 'B')},
+                set(theory))
+
+    def test_j_homography_engine(self):
+
+        # A grid of moles, rotated by 30 degrees about the middle. Only the
+        # moles in one corner are known, the offsets there are no good for
+        # predicting where the moles in the other corners went.
+        angle = numpy.radians(30)
+        rotation = numpy.array([
+            [numpy.cos(angle), -numpy.sin(angle)],
+            [numpy.sin(angle), numpy.cos(angle)],
+        ])
+        centre = numpy.array([1000, 1000])
+
+        from_moles = []
+        to_moles = []
+        expected = set()
+        for i in range(5):
+            for j in range(5):
+                point = numpy.array([i * 500, j * 500])
+                to_point = rotation.dot(point - centre) + centre
+                uuid_ = '{}{}'.format(i, j)
+                to_uuid = 'to' + uuid_
+                if i < 2 and j < 2:
+                    to_uuid = uuid_
+                from_moles.append(make_mole(uuid_, *point))
+                to_moles.append(make_mole(to_uuid, *to_point.astype(int)))
+                expected.add((uuid_, to_uuid))
+
+        # The result should not depend on the order of the moles.
+        for _ in range(2):
+            theory = mel.rotomap.relate.best_theory(
+                from_moles, to_moles, iterate=False, field_engine='homography')
+            self.assertEqual(expected, set(theory))
+            from_moles.reverse()
+            to_moles.reverse()
+
+        theory = mel.rotomap.relate.best_theory(
+            from_moles, to_moles, iterate=False, field_engine='assignment')
+        self.assertNotEqual(expected, set(theory))
+
+
+def make_mole(uuid_, x, y, is_uuid_canonical=True):
+    return {
+        'uuid': uuid_,
+        'x': x,
+        'y': y,
+        'is_uuid_canonical': is_uuid_canonical,
+    }
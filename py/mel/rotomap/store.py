@@ -0,0 +1,243 @@
+"""Mirror the moles of many rotomaps into an SQLite database, for querying.
+
+Finding where a mole has appeared over time otherwise means loading the mole
+file of every image in every rotomap. The store is updated incrementally by
+sync_rotomap(), only re-reading the mole files that have changed.
+
+"""
+
+import itertools
+import os
+import re
+import sqlite3
+import urllib.request
+
+import mel.rotomap.moles
+
+
+# Rotomap directories are named like '20160101T1200', it's the time they were
+# taken and the order to present them in.
+_ROTOMAP_TIMESTAMP_RE = re.compile(r'\d{8}T\d{4}')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rotomap (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    timestamp TEXT
+);
+
+CREATE TABLE IF NOT EXISTS image (
+    id INTEGER PRIMARY KEY,
+    rotomap_id INTEGER NOT NULL REFERENCES rotomap(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    mtime_ns INTEGER,
+    size INTEGER,
+    UNIQUE (rotomap_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS mole (
+    image_id INTEGER NOT NULL REFERENCES image(id) ON DELETE CASCADE,
+    uuid TEXT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    is_uuid_canonical INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS rotomap_timestamp ON rotomap (timestamp);
+CREATE INDEX IF NOT EXISTS mole_uuid ON mole (uuid);
+CREATE INDEX IF NOT EXISTS mole_image ON mole (image_id);
+"""
+
+
+class Store():
+
+    """An SQLite database of the moles in rotomaps, indexed by uuid and time.
+
+    Rotomaps are identified by their absolute path. If 'read_only' is True
+    then the database file must already exist, and the store can only be
+    queried. This is for commands which list moles, so that they don't create
+    or change a database.
+
+    Usage example:
+
+        >>> store = Store(':memory:')
+        >>> store.uuids()
+        set()
+        >>> store.close()
+
+    """
+
+    def __init__(self, db_path, read_only=False):
+        if read_only:
+            self._connection = sqlite3.connect(
+                'file:{}?mode=ro'.format(
+                    urllib.request.pathname2url(os.path.abspath(db_path))),
+                uri=True)
+            return
+
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        with self._connection:
+            self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def sync_rotomap(self, rotomap_path):
+        """Update the store from a rotomap directory, return images changed.
+
+        Only the images with mole files that have a different modification
+        time or size to when last synced are re-read. Images that no longer
+        exist are removed.
+
+        """
+        rotomap_path = os.path.abspath(rotomap_path)
+        image_names = mel.rotomap.moles.rotomap_image_names(rotomap_path)
+
+        num_changed = 0
+        with self._connection:
+            rotomap_id = self._ensure_rotomap_id(rotomap_path)
+
+            stored_images = {
+                name: (image_id, [mtime_ns, size])
+                for image_id, name, mtime_ns, size in self._connection.execute(
+                    'SELECT id, name, mtime_ns, size FROM image '
+                    'WHERE rotomap_id = ?',
+                    (rotomap_id,))
+            }
+
+            for name in set(stored_images) - set(image_names):
+                self._delete_image(stored_images[name][0])
+                num_changed += 1
+
+            for name in image_names:
+                image_path = os.path.join(rotomap_path, name)
+                stamp = mel.rotomap.moles.mole_file_stamp(image_path)
+                if stamp is None:
+                    stamp = [None, None]
+
+                stored = stored_images.get(name)
+                if stored is not None:
+                    if stored[1] == stamp:
+                        continue
+                    self._delete_image(stored[0])
+
+                image_id = self._connection.execute(
+                    'INSERT INTO image (rotomap_id, name, mtime_ns, size) '
+                    'VALUES (?, ?, ?, ?)',
+                    (rotomap_id, name, stamp[0], stamp[1])).lastrowid
+                moles = mel.rotomap.moles.load_image_mole_list(image_path)
+                self._connection.executemany(
+                    'INSERT INTO mole '
+                    '(image_id, uuid, x, y, is_uuid_canonical) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    zip(
+                        itertools.repeat(image_id),
+                        moles.uuids.tolist(),
+                        moles.points[:, 0].tolist(),
+                        moles.points[:, 1].tolist(),
+                        moles.is_uuid_canonical.tolist()))
+                num_changed += 1
+
+        return num_changed
+
+    def prune(self):
+        """Remove rotomaps whose directories no longer exist, return them."""
+        missing = [
+            (rotomap_id, path)
+            for rotomap_id, path in self._connection.execute(
+                'SELECT id, path FROM rotomap')
+            if not os.path.isdir(path)
+        ]
+        with self._connection:
+            self._connection.executemany(
+                'DELETE FROM rotomap WHERE id = ?',
+                [(rotomap_id,) for rotomap_id, _ in missing])
+        return [path for _, path in missing]
+
+    def uuids(self, rotomap_path=None, prefix=None):
+        """Return a set of the uuids of moles, optionally filtered.
+
+        :rotomap_path: if not None, only uuids in this rotomap.
+        :prefix: if not None, only uuids starting with this.
+        :returns: a set of uuid strings.
+
+        """
+        query = (
+            'SELECT DISTINCT mole.uuid FROM mole '
+            'JOIN image ON image.id = mole.image_id '
+            'JOIN rotomap ON rotomap.id = image.rotomap_id')
+        conditions = []
+        params = []
+        if rotomap_path is not None:
+            conditions.append('rotomap.path = ?')
+            params.append(os.path.abspath(rotomap_path))
+        if prefix is not None:
+            # Use a range instead of LIKE, so that the index on uuid is used
+            # and there's no need to escape wildcards.
+            conditions.append('mole.uuid >= ? AND mole.uuid < ?')
+            params.extend([prefix, prefix + '\U0010ffff'])
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return {row[0] for row in self._connection.execute(query, params)}
+
+    def uuid_history(self, mole_uuid=None):
+        """Return a list of (timestamp, image_path, uuid, x, y) in time order.
+
+        :mole_uuid: if not None, only appearances of the mole with this uuid.
+        :returns: a list of tuples, ordered by the rotomap timestamp and then
+                  image path. The timestamp is an ISO 8601 string, or None if
+                  it couldn't be determined from the rotomap path.
+
+        """
+        query = (
+            'SELECT rotomap.timestamp, rotomap.path, image.name, '
+            'mole.uuid, mole.x, mole.y FROM mole '
+            'JOIN image ON image.id = mole.image_id '
+            'JOIN rotomap ON rotomap.id = image.rotomap_id')
+        params = []
+        if mole_uuid is not None:
+            query += ' WHERE mole.uuid = ?'
+            params.append(mole_uuid)
+        query += (
+            ' ORDER BY rotomap.timestamp, rotomap.path, image.name, mole.uuid')
+        return [
+            (timestamp, os.path.join(path, name), uuid_, x, y)
+            for timestamp, path, name, uuid_, x, y in self._connection.execute(
+                query, params)
+        ]
+
+    def _ensure_rotomap_id(self, rotomap_path):
+        row = self._connection.execute(
+            'SELECT id FROM rotomap WHERE path = ?',
+            (rotomap_path,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._connection.execute(
+            'INSERT INTO rotomap (path, timestamp) VALUES (?, ?)',
+            (
+                rotomap_path,
+                rotomap_timestamp(rotomap_path),
+            )).lastrowid
+
+    def _delete_image(self, image_id):
+        self._connection.execute('DELETE FROM image WHERE id = ?', (image_id,))
+
+
+def rotomap_timestamp(rotomap_path):
+    """Return an ISO 8601 string of when a rotomap was taken, or None.
+
+    Usage examples:
+
+        >>> rotomap_timestamp('/moles/rotomaps/parts/LeftLeg/20160101T1230')
+        '2016-01-01T12:30'
+
+        >>> rotomap_timestamp('/moles/rotomaps/parts/LeftLeg/latest')
+
+    """
+    match = _ROTOMAP_TIMESTAMP_RE.fullmatch(os.path.basename(rotomap_path))
+    if match is None:
+        return None
+    text = match.group()
+    return '{}-{}-{}T{}:{}'.format(
+        text[0:4], text[4:6], text[6:8], text[9:11], text[11:13])
@@ -0,0 +1,136 @@
+"""Test suite for mel.rotomap.store."""
+# =============================================================================
+#                                   TEST PLAN
+# -----------------------------------------------------------------------------
+# Here we detail the things we are concerned to test and specify which tests
+# cover those concerns.
+#
+# Concerns:
+# [ B] sync_rotomap() mirrors the moles, only re-reading changed images
+# [ B] uuids() filters by rotomap and prefix
+# [ B] uuid_history() orders appearances by rotomap timestamp
+# [ B] prune() removes rotomaps that no longer exist
+# [ C] A read-only store can be queried, but not changed
+# [ C] A read-only store must already exist
+# -----------------------------------------------------------------------------
+# Tests:
+# [ A] test_a_breathing
+# [ B] test_b_sync_and_query
+# [ C] test_c_read_only
+# =============================================================================
+
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import mel.rotomap.moles
+import mel.rotomap.store
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_a_breathing(self):
+        mel.rotomap.store.Store(':memory:').close()
+
+    def test_b_sync_and_query(self):
+        with tempfile.TemporaryDirectory() as root:
+            new_path = os.path.join(root, '20170101T1200')
+            old_path = os.path.join(root, '20160101T1200')
+            make_rotomap(new_path, [[('abc', 1, 2)], [('abd', 3, 4)]])
+            make_rotomap(old_path, [[('abc', 5, 6)]])
+
+            store = mel.rotomap.store.Store(':memory:')
+
+            # [ B] sync_rotomap() mirrors the moles, only re-reading changed
+            # images.
+            self.assertEqual(2, store.sync_rotomap(new_path))
+            self.assertEqual(1, store.sync_rotomap(old_path))
+            self.assertEqual(0, store.sync_rotomap(new_path))
+            moles = []
+            mel.rotomap.moles.add_mole(moles, 3, 4, 'xyz')
+            image_path = os.path.join(new_path, '1.jpg')
+            mel.rotomap.moles.save_image_moles(moles, image_path)
+
+            # The mole file is the same size as before, and may have the same
+            # mtime on filesystems with coarse timestamps, so set it.
+            os.utime(
+                mel.rotomap.moles.mole_file_path(image_path), ns=(0, 0))
+            self.assertEqual(1, store.sync_rotomap(new_path))
+
+            # [ B] uuids() filters by rotomap and prefix
+            self.assertEqual({'abc', 'xyz'}, store.uuids())
+            self.assertEqual({'abc'}, store.uuids(old_path))
+            self.assertEqual({'abc'}, store.uuids(prefix='ab'))
+            self.assertEqual(set(), store.uuids(old_path, prefix='x'))
+
+            # [ B] uuid_history() orders appearances by rotomap timestamp
+            self.assertEqual(
+                [
+                    (
+                        '2016-01-01T12:00',
+                        os.path.join(old_path, '0.jpg'),
+                        'abc',
+                        5,
+                        6,
+                    ),
+                    (
+                        '2017-01-01T12:00',
+                        os.path.join(new_path, '0.jpg'),
+                        'abc',
+                        1,
+                        2,
+                    ),
+                ],
+                store.uuid_history('abc'))
+
+            # [ B] prune() removes rotomaps that no longer exist
+            shutil.rmtree(old_path)
+            self.assertEqual([old_path], store.prune())
+            self.assertEqual(set(), store.uuids(old_path))
+
+            store.close()
+
+    def test_c_read_only(self):
+        with tempfile.TemporaryDirectory() as root:
+            rotomap_path = os.path.join(root, '20170101T1200')
+            make_rotomap(rotomap_path, [[('abc', 1, 2)]])
+            db_path = os.path.join(root, 'store.db')
+            store = mel.rotomap.store.Store(db_path)
+            store.sync_rotomap(rotomap_path)
+            store.close()
+
+            # [ C] A read-only store can be queried, but not changed
+            store = mel.rotomap.store.Store(db_path, read_only=True)
+            self.assertEqual({'abc'}, store.uuids())
+            shutil.rmtree(rotomap_path)
+            with self.assertRaises(sqlite3.OperationalError):
+                store.prune()
+            store.close()
+
+            # [ C] A read-only store must already exist
+            missing_path = os.path.join(root, 'missing.db')
+            with self.assertRaises(sqlite3.OperationalError):
+                mel.rotomap.store.Store(missing_path, read_only=True)
+            self.assertFalse(os.path.exists(missing_path))
+
+
+def make_rotomap(path, mole_specs_list):
+    """Make a rotomap of fake images, with moles from (uuid, x, y)."""
+    os.makedirs(path, exist_ok=True)
+    for i, mole_specs in enumerate(mole_specs_list):
+        image_path = os.path.join(path, '{}.jpg'.format(i))
+        with open(image_path, 'w'):
+            pass
+        moles = []
+        for uuid_, x, y in mole_specs:
+            mel.rotomap.moles.add_mole(moles, x, y, uuid_)
+        mel.rotomap.moles.save_image_moles(moles, image_path)